@@ -15,8 +15,19 @@ __version__ = '0.1.7'
 
 from barrister.runtime import contract_from_file, idgen_uuid, idgen_seq
 from barrister.runtime import RpcException, Server, Filter, HttpTransport, InProcTransport
-from barrister.runtime import Client, Batch
+from barrister.runtime import ResultCache, SingleFlight, IdempotencyStore
+from barrister.runtime import ServerMetrics, PrometheusExporter, StatsdExporter
+from barrister.runtime import MethodProfiler, SlowRequestLog
+from barrister.runtime import Tracer, InMemorySpanExporter, FileSpanExporter
+from barrister.runtime import Deadline, current_deadline, AdmissionController, Bulkheads
+from barrister.runtime import NotificationExecutor, ResultStream
+from barrister.runtime import PooledHttpTransport, LockedTransport, LoadBalancedTransport
+from barrister.runtime import HedgingPolicy, CircuitBreaker, CircuitBreakerTransport
+from barrister.runtime import Client, Batch, ResponseCache
 from barrister.runtime import Contract, Interface, Enum, Struct, Function
 from barrister.runtime import WebsocketTransport, TwistedClient, TwistedServer
+from barrister.runtime import UnixSocketTransport, UnixHttpTransport, UnixSocketServer
+from barrister.runtime import TcpTransport, TcpServer, FramedRpcFactory
+from barrister.runtime import PendingCalls, TwistedHttpResource
 from barrister.docco import docco_html
 from barrister.graphviz import to_dotfile
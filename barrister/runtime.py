@@ -5,21 +5,47 @@
     :license: MIT, see LICENSE for more details.
 """
 
-from twisted.internet import defer
-
+from twisted.internet import defer, protocol
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.python import failure as twisted_failure
+from twisted.web import resource as web_resource, server as web_server
+
+import os
+import stat
+import time
+import random
+import bisect
+import codecs
+import collections
+import cProfile
+import pstats
+import re
 import uuid
 import itertools
 import logging
 import json
+import socket
+import struct
+import sys
+import threading
+import signal
+import weakref
 import six
 
+from six.moves import queue, socketserver, http_client, BaseHTTPServer
+
 if six.PY2:
     import urllib2 as urllib
 else:
     import urllib.request as urllib
     import urllib.error, urllib.parse
 
-from cachetools import TTLCache
+from cachetools import TTLCache, LRUCache
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - not available on Windows
+    resource = None
 
 # JSON-RPC standard error codes
 ERR_PARSE = -32700
@@ -31,6 +57,26 @@ ERR_INTERNAL = -32603
 # Our extensions
 ERR_UNKNOWN = -32000
 ERR_INVALID_RESP = -32001
+ERR_CIRCUIT_OPEN = -32002
+ERR_IN_PROGRESS = -32003
+ERR_DEADLINE_EXCEEDED = -32004
+ERR_OVERLOADED = -32005
+ERR_BULKHEAD_FULL = -32006
+
+# Largest frame accepted by the length-prefixed socket transports, in bytes
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# Content type of streamed responses: one JSON-RPC response per line
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+# Histogram bucket upper bounds used by ServerMetrics
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+BATCH_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+# High resolution timer used to measure request phases
+perf_timer = getattr(time, "perf_counter", time.time)
 
 def contract_from_file(fname):
     """
@@ -73,7 +119,8 @@ def idgen_uuid():
 idgen_seq_counter = itertools.count()
 def idgen_seq():
     """
-    Generates an ID using itertools.count() and returns it as a string
+    Generates an ID using itertools.count() and returns it as a string.  Safe to call
+    from multiple threads: advancing the shared counter is a single atomic operation.
     """
     return str(next(idgen_seq_counter))
 
@@ -86,6 +133,16 @@ def err_response(reqid, code, msg, data=None):
         err["data"] = data
     return { "jsonrpc": "2.0", "id": reqid, "error": err }
 
+def is_notification(req):
+    """
+    Returns True if req is a JSON-RPC notification (a request without an 'id' member),
+    or a non-empty batch made only of notifications.  The server sends no response to
+    notifications.
+    """
+    if isinstance(req, list):
+        return len(req) > 0 and all([ is_notification(r) for r in req ])
+    return isinstance(req, dict) and "id" not in req
+
 def safe_get(d, key, def_val=None):
     """
     Helper function to fetch value from a dictionary
@@ -99,6 +156,235 @@ def safe_get(d, key, def_val=None):
     else:
         return def_val
 
+def request_key(method, params):
+    """
+    Returns a string that identifies a call by method name and params.  Params are
+    serialized to JSON with sorted keys, so calls with equal params produce equal keys
+    regardless of dict ordering.
+
+    :Parameters:
+      method
+        JSON-RPC method name
+      params
+        List of params
+    """
+    return "%s:%s" % (method, json.dumps(params, sort_keys=True, separators=(",", ":")))
+
+class RawJson(object):
+    """
+    Wraps a value that has already been serialized to JSON, so that encode_response()
+    can write it out without encoding it again.  Has two properties:
+
+    * `json` - The JSON encoded value as a string
+    * `value` - The value itself, or None if not known
+    """
+
+    def __init__(self, json, value=None):
+        self.json = json
+        self.value = value
+
+def encode_response(resp):
+    """
+    Serializes a JSON-RPC response, or list of responses, to a JSON string.  Unlike
+    json.dumps, this accepts responses whose 'result' is a RawJson instance.
+
+    :Parameters:
+      resp
+        Response dict or list of response dicts
+    """
+    if isinstance(resp, list):
+        return "[" + ", ".join([ encode_response(r) for r in resp ]) + "]"
+    result = safe_get(resp, "result")
+    if isinstance(result, RawJson):
+        rest = dict(resp)
+        del rest["result"]
+        return '%s, "result": %s}' % (json.dumps(rest)[:-1], result.json)
+    return json.dumps(resp)
+
+def format_timings(timings):
+    """
+    Converts a dict of phase durations in seconds to milliseconds rounded to microseconds,
+    as returned to callers in the `timing` member of responses
+    """
+    return dict([ (phase, round(elapsed * 1000.0, 3)) for phase, elapsed in timings.items() ])
+
+def server_timing_header(timing):
+    """
+    Formats a dict of phase durations in milliseconds as a HTTP Server-Timing header value
+    """
+    return ", ".join([ "%s;dur=%s" % (phase, timing[phase]) for phase in sorted(timing) ])
+
+class ResultStream(object):
+    """
+    Result of a handler that returned an iterator, such as a generator, for a function
+    with an array return type.  Elements are validated as they are consumed, so the
+    whole array is never held in memory.  Server.call_json_chunks() encodes it
+    incrementally.  The other Server entry points turn it into a list.
+
+    The handler keeps running while the stream is read, so the request's deadline
+    applies to each element, and the slots the request holds are only given up by the
+    callbacks registered with on_close().
+    """
+
+    def __init__(self, iterable, validate=None, context=None):
+        """
+        Creates a new ResultStream
+
+        :Parameters:
+          iterable
+            Iterable of result elements
+          validate
+            Optional callable invoked with the index and value of each element.  Raises
+            RpcException if the element is invalid.
+          context
+            Optional RequestContext whose deadline applies while elements are read
+        """
+        self.iterator = iter(iterable)
+        self.validate = validate
+        self.context = context
+        self.count = 0
+        self.error = None
+        self.closed = False
+        self.callbacks = [ ]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration()
+        try:
+            deadline = None
+            if self.context is not None:
+                check_deadline(self.context)
+                deadline = self.context.deadline
+            with Deadline(at=deadline):
+                item = next(self.iterator)
+            if self.validate is not None:
+                self.validate(self.count, item)
+        except StopIteration:
+            self.close()
+            raise
+        except Exception as e:
+            self.error = e
+            self.close()
+            raise
+        self.count += 1
+        return item
+
+    next = __next__
+
+    def on_close(self, func):
+        """
+        Registers func to be called once the stream is exhausted, fails or is closed.
+        Called immediately if the stream is already closed.
+        """
+        if self.closed:
+            func()
+        else:
+            self.callbacks.append(func)
+
+    def close(self):
+        """
+        Stops reading the stream, closing the handler's generator, and runs the on_close()
+        callbacks.  Called automatically when the stream is exhausted or fails.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            close = getattr(self.iterator, "close", None)
+            if close is not None:
+                close()
+        finally:
+            callbacks = self.callbacks
+            self.callbacks = [ ]
+            for func in callbacks:
+                try:
+                    func()
+                except Exception:
+                    logging.getLogger("barrister").exception("Error closing result stream")
+
+def result_stream(resp):
+    """
+    Returns the ResultStream result of a response dict, or None
+    """
+    if isinstance(resp, dict):
+        result = safe_get(resp, "result")
+        if isinstance(result, ResultStream):
+            return result
+    return None
+
+def is_iterator_result(result):
+    """
+    Returns True if a handler result is an iterable other than a list, tuple, dict or
+    string, which Server may stream as a ResultStream
+    """
+    return hasattr(result, "__iter__") and \
+        not isinstance(result, (list, tuple, dict, six.string_types, six.binary_type))
+
+def materialize(resp):
+    """
+    Returns resp with any ResultStream result read into a list.  resp may be a single
+    response dict or a list of them.  A stream that fails part way through yields an
+    error response instead.
+    """
+    if isinstance(resp, list):
+        return [ materialize(r) for r in resp ]
+    if result_stream(resp) is None:
+        return resp
+    resp = dict(resp)
+    try:
+        resp["result"] = list(resp["result"])
+    except RpcException as e:
+        return err_response(resp["id"], e.code, e.msg, e.data)
+    except Exception as e:
+        logging.getLogger("barrister").exception("Error reading result stream")
+        return err_response(resp["id"], ERR_UNKNOWN, "Server error. Check logs for details.",
+                            data={ 'exception': str(e) })
+    return resp
+
+def iter_encode_response(resp):
+    """
+    Encodes a response dict whose result is a ResultStream, yielding JSON strings as the
+    elements are read.  Each element is on its own line, between a first line holding
+    the rest of the response and the closing line, so clients can parse the result line
+    by line (see Client.call_stream) while the whole body remains a valid JSON document.
+
+    Headers have been sent by the time an element fails, so the error is appended as an
+    'error' member after the elements read so far.
+    """
+    head = dict(resp)
+    stream = head.pop("result")
+    prefix = json.dumps(head)[:-1]
+    if head:
+        prefix += ", "
+    try:
+        for chunk in _encode_stream(prefix, stream):
+            yield chunk
+    finally:
+        # also runs if the caller stops reading, e.g. when the client disconnects
+        stream.close()
+
+def _encode_stream(prefix, stream):
+    yield prefix + '"result": [\n'
+    sep = ""
+    try:
+        for item in stream:
+            # the separator leads the line, so each element's line is complete once sent
+            yield sep + json.dumps(item) + "\n"
+            sep = ","
+    except Exception as e:
+        if isinstance(e, RpcException):
+            err = err_response(None, e.code, e.msg, e.data)["error"]
+        else:
+            logging.getLogger("barrister").exception("Error reading result stream")
+            err = err_response(None, ERR_UNKNOWN, "Server error. Check logs for details.",
+                               data={ 'exception': str(e) })["error"]
+        yield '], "error": %s}\n' % json.dumps(err)
+        return
+    yield "]}\n"
+
 class RpcException(Exception, json.JSONEncoder):
     """
     Represents a JSON-RPC style exception.  Server implementations should raise this
@@ -127,6 +413,87 @@ class RpcException(Exception, json.JSONEncoder):
             s += "%s data=%s" % (s, str(self.data))
         return s
 
+_deadline_local = threading.local()
+
+def current_deadline():
+    """
+    Returns the deadline, in seconds since the epoch, of the work being done on the current
+    thread, or None if there is no deadline.  Set by Server while a handler runs, and by
+    the Deadline context manager.  Client uses it to propagate the remaining budget to
+    downstream calls.
+    """
+    return getattr(_deadline_local, "deadline", None)
+
+class Deadline(object):
+    """
+    Context manager that limits the time available to the calls made by Clients on the
+    current thread.  Deadlines nest: the earliest one applies.
+
+    ::
+
+      with barrister.Deadline(2.0):
+          client.OrderService.getOrderStatus("order-123")
+
+    """
+
+    def __init__(self, seconds=None, at=None):
+        """
+        Creates a new Deadline
+
+        :Parameters:
+          seconds
+            Seconds from now until the deadline
+          at
+            Absolute deadline in seconds since the epoch.  Used if seconds is None.  If
+            both are None, the current deadline is left unchanged.
+        """
+        if seconds is not None:
+            at = time.time() + seconds
+        self.at = at
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = current_deadline()
+        at = self.at
+        if at is None or (self.previous is not None and self.previous < at):
+            at = self.previous
+        _deadline_local.deadline = at
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _deadline_local.deadline = self.previous
+        return False
+
+def request_deadline(req, props=None):
+    """
+    Returns the absolute deadline of a request in seconds since the epoch, or None.  The
+    request's `timeout` member is a budget in seconds counted from when the request
+    arrived (the `received_at` property, if set by the transport), which makes it immune
+    to clock skew between client and server.  Otherwise the `deadline` member is read as
+    an absolute time in seconds since the epoch.
+    """
+    if not isinstance(req, dict):
+        return None
+    timeout = req.get("timeout")
+    if isinstance(timeout, (int, float)) and not isinstance(timeout, bool):
+        now = time.time()
+        received = props.get("received_at") if props else None
+        if received is not None:
+            now -= perf_timer() - received
+        return now + timeout
+    at = req.get("deadline")
+    if isinstance(at, (int, float)) and not isinstance(at, bool):
+        return float(at)
+    return None
+
+def check_deadline(context):
+    """
+    Raises a RpcException with code ERR_DEADLINE_EXCEEDED if the request's deadline has
+    passed
+    """
+    if context.deadline is not None and time.time() >= context.deadline:
+        raise RpcException(ERR_DEADLINE_EXCEEDED, "Deadline exceeded")
+
 class RequestContext(object):
     """
     Stores state about a single request, including properties passed
@@ -147,10 +514,24 @@ class RequestContext(object):
         self.request  = req
         self.response = None
         self.error    = None
+        self.cached   = False
+        self.result_json = None
+        self.timings  = { }
+        self.span     = None
+        self.deadline = request_deadline(req, props)
 
     def func_name(self):
         return unpack_method(self.request["method"])[1]
 
+    def remaining(self):
+        """
+        Returns the number of seconds left until the request's deadline, or None if the
+        caller did not set one.  May be negative once the deadline has passed.
+        """
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
+
     def get_prop(self, key, default_val=None):
         """
         Returns a property set on the context.
@@ -212,219 +593,1598 @@ class Filter(object):
         """
         pass
 
-class Server(object):
+class Histogram(object):
     """
-    Dispatches requests to user created handler classes based on method name.
-    Also responsible for validating requests and responses to ensure they conform to the
-    IDL Contract.
+    Counts observed values in fixed buckets, and tracks their count and sum.
     """
 
-    def __init__(self, contract, validate_request=True, validate_response=True):
+    def __init__(self, bounds=LATENCY_BUCKETS):
         """
-        Creates a new Server
+        Creates a new empty Histogram
 
         :Parameters:
-          contract
-            Contract instance that this server should use
-          validate_request
-            If True, requests will be validated against the Contract and rejected if they are malformed
-          validate_response
-            If True, responses from handler methods will be validated against the Contract and rejected
-            if they are malformed
+          bounds
+            Sorted tuple of bucket upper bounds.  Values above the last bound are counted
+            in an extra overflow bucket.
         """
-        logging.basicConfig()
-        self.log = logging.getLogger("barrister")
-        self.validate_req = validate_request
-        self.validate_resp = validate_response
-        self.contract = contract
-        self.handlers = {}
-        self.filters = None
+        self.bounds = bounds
+        self.counts = [ 0 ] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
 
-    def add_handler(self, iface_name, handler):
+    def observe(self, value):
         """
-        Associates the given handler with the interface name.  If the interface does not exist in
-        the Contract, an RpcException is raised.
+        Adds a value to the histogram
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
 
-        :Parameters:
-          iface_name
-            Name of interface that this handler implements
-          handler
-            Instance of a class that implements all functions defined on the interface
+    def merge(self, other):
         """
-        if self.contract.has_interface(iface_name):
-            self.handlers[iface_name] = handler
-        else:
-            raise RpcException(ERR_INVALID_REQ, "Unknown interface: '%s'", iface_name)
+        Adds the observations of another Histogram with the same bounds to this one
+        """
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.count += other.count
+        self.sum += other.sum
 
-    def set_filters(self, filters):
+    def percentile(self, p):
         """
-        Sets the filters for the server.
+        Estimates the value below which p percent of observations fall, by interpolating
+        within the bucket that contains it.  Returns None if the histogram is empty.
 
         :Parameters:
-          filters
-            List of filters to set on this server, or None to remove all filters.
-            Elements in list should subclass Filter
+          p
+            Percentile, between 0 and 100
         """
-        if filters == None or isinstance(filters, (tuple, list)):
-            self.filters = filters
-        else:
-            self.filters = [ filters ]
+        if not self.count:
+            return None
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, c in enumerate(self.counts):
+            if c and seen + c >= rank:
+                lower = self.bounds[i - 1] if i > 0 else 0
+                if i == len(self.bounds):
+                    return lower
+                return lower + (self.bounds[i] - lower) * (rank - seen) / c
+            seen += c
+        return self.bounds[-1]
+
+def encoded_size(data):
+    """
+    Returns the size in bytes of data encoded as UTF-8
+    """
+    if isinstance(data, six.text_type):
+        return len(data.encode("utf8"))
+    return len(data)
 
-    def call_json(self, req_json, props=None):
+class _MetricsShard(object):
+    """
+    Internal class holding the metrics recorded by a single thread
+    """
+
+    def __init__(self):
+        self.requests = { }
+        self.errors = { }
+        self.in_flight = { }
+        self.phases = { }
+        self.sizes = { }
+        self.batches = Histogram(BATCH_BUCKETS)
+
+    def merge(self, other):
+        """
+        Adds the metrics of another shard to this one
+        """
+        for target, source in ((self.requests, other.requests), (self.errors, other.errors),
+                               (self.in_flight, other.in_flight)):
+            for k, v in list(source.items()):
+                target[k] = target.get(k, 0) + v
+        for target, source in ((self.phases, other.phases), (self.sizes, other.sizes)):
+            for k, h in list(source.items()):
+                if k not in target:
+                    target[k] = Histogram(h.bounds)
+                target[k].merge(h)
+        self.batches.merge(other.batches)
+
+class _ShardLease(object):
+    """
+    Internal class held in a thread local by ServerMetrics, that retires the thread's
+    shard when the thread exits and its locals are deleted
+    """
+
+    def __init__(self, metrics, shard):
+        self.metrics = weakref.ref(metrics)
+        self.shard = shard
+
+    def __del__(self):
+        metrics = self.metrics()
+        if metrics is not None:
+            metrics._retire(self.shard)
+
+class ServerMetrics(object):
+    """
+    Collects per-function metrics for a Server (see Server.set_metrics):
+
+    * request counts
+    * error counts by JSON-RPC error code
+    * latency histograms for each phase of a request: decode, filters, validate_request,
+      handler, validate_response, encode, and total
+    * request and response payload size histograms
+    * batch size histogram
+
+    Phases that happen once per payload (decode, encode, payload sizes) are attributed to
+    the method for single requests, and to "batch" for batch requests.  Requests for
+    methods that are not in the IDL are recorded as "unknown".
+
+    Each thread records into its own shard without taking a lock.  Shards are merged
+    when a snapshot is taken, usually by an exporter such as PrometheusExporter or
+    StatsdExporter.  When a thread exits its shard is merged into a single shard for
+    retired threads, so short lived threads do not accumulate shards.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = [ ]
+        self.retired = _MetricsShard()
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def _shard(self):
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = _MetricsShard()
+            self.local.shard = shard
+            self.local.lease = _ShardLease(self, shard)
+            with self.lock:
+                self.shards.append(shard)
+        return shard
+
+    def _retire(self, shard):
+        with self.lock:
+            self.shards.remove(shard)
+            self.retired.merge(shard)
+
+    def record_request(self, method, code, timings):
         """
-        Deserializes req_json as JSON, invokes self.call(), and serializes result to JSON.
-        Returns JSON encoded string.
+        Records a completed request
 
         :Parameters:
-          req_json
-            JSON-RPC request serialized as JSON string
-          props
-            Application defined properties to set on RequestContext for use with filters.
-            For example: authentication headers.  Must be a dict.
+          method
+            "Interface.function" name
+          code
+            JSON-RPC error code, or None if the request succeeded
+          timings
+            Dict mapping phase name to duration in seconds
         """
-        try:
-            req = json.loads(req_json)
-        except:
-            msg = "Unable to parse JSON: %s" % req_json
-            return json.dumps(err_response(None, -32700, msg))
-        return json.dumps(self.call(req, props))
+        shard = self._shard()
+        shard.requests[method] = shard.requests.get(method, 0) + 1
+        if code is not None:
+            key = (method, code)
+            shard.errors[key] = shard.errors.get(key, 0) + 1
+        for phase, elapsed in timings.items():
+            self._observe(shard.phases, (method, phase), elapsed, LATENCY_BUCKETS)
 
-    def call(self, req, props=None):
+    def start_request(self, method):
         """
-        Executes a Barrister request and returns a response.  If the request is a list, then the
-        response will also be a list.  If the request is an empty list, a RpcException is raised.
+        Marks a request as in flight.  Must be paired with finish_request() on the same
+        thread.
+        """
+        shard = self._shard()
+        shard.in_flight[method] = shard.in_flight.get(method, 0) + 1
 
-        :Parameters:
-          req
-            The request. Either a list of dicts, or a single dict.
-          props
-            Application defined properties to set on RequestContext for use with filters.
-            For example: authentication headers.  Must be a dict.
+    def finish_request(self, method):
         """
-        resp = None
+        Marks a request started with start_request() as complete
+        """
+        shard = self._shard()
+        shard.in_flight[method] -= 1
 
-        if self.log.isEnabledFor(logging.DEBUG):
-            self.log.debug("Request: %s" % str(req))
+    def record_phase(self, method, phase, elapsed):
+        """
+        Records the duration in seconds of a single phase
+        """
+        self._observe(self._shard().phases, (method, phase), elapsed, LATENCY_BUCKETS)
 
-        if isinstance(req, list):
-            if len(req) < 1:
-                resp = err_response(None, ERR_INVALID_REQ, "Invalid Request. Empty batch.")
-            else:
-                # run the batch call collecting the responses
-                resp = [self._call_and_format(r, props) for r in req]
-        else:
-            resp = self._call_and_format(req, props)
+    def record_size(self, method, direction, size):
+        """
+        Records a payload size in bytes.  direction is "request" or "response"
+        """
+        self._observe(self._shard().sizes, (method, direction), size, SIZE_BUCKETS)
 
-        if self.log.isEnabledFor(logging.DEBUG):
-            self.log.debug("Response: %s" % str(resp))
-        return resp
+    def record_batch(self, size):
+        """
+        Records the number of requests in a batch
+        """
+        self._shard().batches.observe(size)
 
-    def _call_and_format(self, req, props=None):
+    def _observe(self, histograms, key, value, bounds):
+        h = histograms.get(key)
+        if h is None:
+            h = Histogram(bounds)
+            histograms[key] = h
+        h.observe(value)
+
+    def snapshot(self):
         """
-        Invokes a single request against a handler using _call() and traps any errors,
-        formatting them using _err().  If the request is successful it is wrapped in a
-        JSON-RPC 2.0 compliant dict with keys: 'jsonrpc', 'id', 'result'.
+        Merges all shards and returns a dict with keys:
 
-        :Parameters:
-          req
-            A single dict representing a single JSON-RPC request
-          props
-            Application defined properties to set on RequestContext for use with filters.
-            For example: authentication headers.  Must be a dict.
+        - `requests` - dict mapping method to request count
+        - `errors` - dict mapping (method, code) to error count
+        - `in_flight` - dict mapping method to number of requests in progress
+        - `phases` - dict mapping (method, phase) to latency Histogram
+        - `sizes` - dict mapping (method, direction) to payload size Histogram
+        - `batches` - batch size Histogram
+        - `uptime` - seconds since the metrics were created
         """
-        if not isinstance(req, dict):
-            return err_response(None, ERR_INVALID_REQ,
-                                "Invalid Request. %s is not an object." % str(req))
+        total = _MetricsShard()
+        with self.lock:
+            shards = list(self.shards)
+            total.merge(self.retired)
+        for shard in shards:
+            total.merge(shard)
+        return { "requests": total.requests, "errors": total.errors,
+                 "in_flight": total.in_flight, "phases": total.phases, "sizes": total.sizes,
+                 "batches": total.batches, "uptime": time.time() - self.started }
 
-        reqid = None
-        if "id" in req:
-            reqid = req["id"]
+    def summary(self):
+        """
+        Returns a JSON serializable dict mapping each method to its request and error
+        counts, average throughput in requests per second, requests in flight, and
+        latency percentiles in milliseconds for the total and validation phases.
+        """
+        snap = self.snapshot()
+        uptime = max(snap["uptime"], 0.001)
+        errors = { }
+        for (method, code), count in snap["errors"].items():
+            errors[method] = errors.get(method, 0) + count
+        functions = { }
+        for method in set(snap["requests"]) | set(snap["in_flight"]):
+            count = snap["requests"].get(method, 0)
+            stats = { "requests": count, "errors": errors.get(method, 0),
+                      "throughput": count / uptime,
+                      "in_flight": snap["in_flight"].get(method, 0) }
+            for phase in ("total", "validate_request", "validate_response"):
+                h = snap["phases"].get((method, phase))
+                if h is not None and h.count:
+                    stats[phase + "_ms"] = {
+                        "mean": h.sum * 1000.0 / h.count,
+                        "p50": h.percentile(50) * 1000.0,
+                        "p95": h.percentile(95) * 1000.0,
+                        "p99": h.percentile(99) * 1000.0 }
+            functions[method] = stats
+        return functions
 
-        if props is None:
-            props = {}
-        context = RequestContext(props, req)
+def process_memory():
+    """
+    Returns a dict describing the memory used by this process, with keys 'rss_bytes'
+    (current resident set size, Linux only) and 'max_rss_bytes' (peak resident set size).
+    Keys are omitted if the value is not available on this platform.
+    """
+    mem = { }
+    try:
+        with open("/proc/self/statm") as f:
+            mem["rss_bytes"] = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on OS X and kilobytes elsewhere
+        if sys.platform != "darwin":
+            max_rss *= 1024
+        mem["max_rss_bytes"] = max_rss
+    return mem
+
+class PrometheusExporter(object):
+    """
+    Renders ServerMetrics in the Prometheus text exposition format, e.g. for serving
+    from a /metrics HTTP endpoint.
+    """
 
-        if self.filters:
-            for f in self.filters:
-                f.pre(context)
+    def __init__(self, metrics, prefix="barrister"):
+        """
+        Creates a new PrometheusExporter
 
-        if context.error:
-            return context.error
+        :Parameters:
+          metrics
+            ServerMetrics to export
+          prefix
+            Prefix for all metric names
+        """
+        self.metrics = metrics
+        self.prefix = prefix
+
+    def export(self):
+        """
+        Returns the current metrics as a string in Prometheus text format
+        """
+        snap = self.metrics.snapshot()
+        p = self.prefix
+        lines = [ ]
+
+        lines.append("# HELP %s_requests_total Requests handled" % p)
+        lines.append("# TYPE %s_requests_total counter" % p)
+        for method, count in sorted(snap["requests"].items()):
+            lines.append('%s_requests_total{method="%s"} %d' % (p, method, count))
+
+        lines.append("# HELP %s_errors_total Requests that returned an error" % p)
+        lines.append("# TYPE %s_errors_total counter" % p)
+        for (method, code), count in sorted(snap["errors"].items()):
+            lines.append('%s_errors_total{method="%s",code="%s"} %d' % (p, method, code, count))
+
+        lines.append("# HELP %s_phase_seconds Time spent in each phase of a request" % p)
+        lines.append("# TYPE %s_phase_seconds histogram" % p)
+        for (method, phase), h in sorted(snap["phases"].items()):
+            labels = 'method="%s",phase="%s"' % (method, phase)
+            self._histogram(lines, "%s_phase_seconds" % p, labels, h)
+
+        lines.append("# HELP %s_payload_bytes Size of request and response payloads" % p)
+        lines.append("# TYPE %s_payload_bytes histogram" % p)
+        for (method, direction), h in sorted(snap["sizes"].items()):
+            labels = 'method="%s",direction="%s"' % (method, direction)
+            self._histogram(lines, "%s_payload_bytes" % p, labels, h)
+
+        lines.append("# HELP %s_batch_size Number of requests per batch" % p)
+        lines.append("# TYPE %s_batch_size histogram" % p)
+        self._histogram(lines, "%s_batch_size" % p, "", snap["batches"])
+
+        return "\n".join(lines) + "\n"
+
+    def _histogram(self, lines, name, labels, h):
+        sep = "," if labels else ""
+        cumulative = 0
+        for bound, count in zip(h.bounds, h.counts):
+            cumulative += count
+            lines.append('%s_bucket{%s%sle="%s"} %d' % (name, labels, sep, bound, cumulative))
+        lines.append('%s_bucket{%s%sle="+Inf"} %d' % (name, labels, sep, h.count))
+        lines.append("%s_sum{%s} %s" % (name, labels, h.sum))
+        lines.append("%s_count{%s} %d" % (name, labels, h.count))
+
+class StatsdExporter(object):
+    """
+    Pushes ServerMetrics to a StatsD daemon using the StatsD line protocol over UDP.
+    Each call to export() sends request and error counts accumulated since the previous
+    call as counters, and the mean, p50, p95 and p99 of each phase in milliseconds as
+    gauges.  Call it periodically, e.g. from a timer thread.
+    """
 
-        resp = None
-        try:
-            result = self._call(context)
-            resp = { "jsonrpc": "2.0", "id": reqid, "result": result }
-        except RpcException as e:
-            resp = err_response(reqid, e.code, e.msg, e.data)
-        except Exception as e:
-            self.log.exception("Error processing request: %s" % str(req))
-            resp = err_response(reqid, ERR_UNKNOWN, "Server error. Check logs for details.",
-                                data={
-                                    'exception': str(e)
-                                })
+    def __init__(self, metrics, host="127.0.0.1", port=8125, prefix="barrister"):
+        """
+        Creates a new StatsdExporter
 
-        if self.filters:
-            context.response = resp
-            for f in self.filters:
-                f.post(context)
+        :Parameters:
+          metrics
+            ServerMetrics to export
+          host
+            StatsD host
+          port
+            StatsD UDP port
+          prefix
+            Prefix for all metric names
+        """
+        self.metrics = metrics
+        self.address = (host, port)
+        self.prefix = prefix
+        self.last = { }
+        self.sock = None
+
+    def lines(self):
+        """
+        Returns the list of StatsD lines for the metrics recorded since the previous call
+        """
+        snap = self.metrics.snapshot()
+        p = self.prefix
+        lines = [ ]
+        counters = [ ("%s.%s.requests" % (p, m), c) for m, c in snap["requests"].items() ]
+        counters += [ ("%s.%s.errors.%s" % (p, m, code), c)
+                      for (m, code), c in snap["errors"].items() ]
+        for name, count in sorted(counters):
+            delta = count - self.last.get(name, 0)
+            self.last[name] = count
+            if delta:
+                lines.append("%s:%d|c" % (name, delta))
+        for (method, phase), h in sorted(snap["phases"].items()):
+            if not h.count:
+                continue
+            name = "%s.%s.%s" % (p, method, phase)
+            lines.append("%s.mean:%.3f|g" % (name, h.sum * 1000.0 / h.count))
+            for pct in (50, 95, 99):
+                lines.append("%s.p%d:%.3f|g" % (name, pct, h.percentile(pct) * 1000.0))
+        return lines
+
+    def export(self):
+        """
+        Sends the metrics recorded since the previous call to StatsD
+        """
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        packet = [ ]
+        size = 0
+        for line in self.lines():
+            # keep datagrams below a typical MTU
+            if packet and size + len(line) > 1400:
+                self.sock.sendto("\n".join(packet).encode("utf8"), self.address)
+                packet = [ ]
+                size = 0
+            packet.append(line)
+            size += len(line) + 1
+        if packet:
+            self.sock.sendto("\n".join(packet).encode("utf8"), self.address)
+
+class SlowRequestLog(object):
+    """
+    Logs requests that take longer than a per-function threshold, for use with Server
+    (see Server.set_slow_log).  Each entry is a single line with the method, request id,
+    time spent in each phase, request and response sizes, error code, and a truncated
+    sample of the params.  Payloads are only serialized for requests that are logged.
 
-        return resp
+    Entries are rate limited with a token bucket, so a latency spike across all requests
+    cannot flood the log.  The number of entries dropped is reported on the next entry.
+    """
 
-    def _call(self, context):
+    def __init__(self, threshold=1.0, thresholds=None, max_per_second=10.0,
+                 max_param_chars=256, logger=None):
         """
-        Executes a single request against a handler.  If the req.method == 'barrister-idl', the
-        Contract IDL JSON structure is returned.  Otherwise the method is resolved to a handler
-        based on the interface name, and the appropriate function is called on the handler.
+        Creates a new SlowRequestLog
 
-        :Parameter:
-          req
-            A dict representing a valid JSON-RPC 2.0 request.  'method' must be provided.
+        :Parameters:
+          threshold
+            Seconds a request may take before it is logged
+          thresholds
+            Dict mapping "Interface.function" names to thresholds that override threshold
+          max_per_second
+            Maximum average number of entries logged per second.  Bursts of up to this many
+            entries are allowed.
+          max_param_chars
+            Params are serialized to JSON and truncated to this many characters
+          logger
+            Logger to write entries to at WARNING level.  Defaults to "barrister.slow"
+        """
+        self.threshold = threshold
+        self.thresholds = thresholds or { }
+        self.max_per_second = max_per_second
+        self.max_param_chars = max_param_chars
+        self.log = logger or logging.getLogger("barrister.slow")
+        self.tokens = max_per_second
+        self.last_refill = time.time()
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def is_slow(self, method, elapsed):
+        """
+        Returns True if a call to method that took elapsed seconds exceeds its threshold
+        """
+        return elapsed >= self.thresholds.get(method, self.threshold)
+
+    def _acquire(self):
+        """
+        Takes a token from the rate limiter.  Returns the number of entries suppressed
+        since the last entry logged, or None if this entry should be dropped.
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.max_per_second,
+                              self.tokens + (now - self.last_refill) * self.max_per_second)
+            self.last_refill = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return None
+            self.tokens -= 1
+            suppressed = self.suppressed
+            self.suppressed = 0
+            return suppressed
+
+    def record(self, method, context, resp):
+        """
+        Logs the request if context.timings['total'] exceeds the threshold for method
+
+        :Parameters:
+          method
+            "Interface.function" name of the request
+          context
+            RequestContext of the completed request
+          resp
+            Response dict
         """
+        timings = context.timings
+        if not self.is_slow(method, timings.get("total", 0)):
+            return
+        suppressed = self._acquire()
+        if suppressed is None:
+            return
+
         req = context.request
-        if "method" not in req:
-            raise RpcException(ERR_INVALID_REQ, "Invalid Request. No 'method'.")
+        phases = " ".join([ "%s=%.1fms" % (phase, timings[phase] * 1000.0)
+                            for phase in sorted(timings) ])
+        code = None
+        if "error" in resp:
+            code = resp["error"]["code"]
+        try:
+            req_size = len(json.dumps(req))
+            params = json.dumps(req.get("params"))
+        except (TypeError, ValueError):
+            req_size = -1
+            params = repr(req.get("params"))
+        if len(params) > self.max_param_chars:
+            params = params[:self.max_param_chars] + "..."
+        try:
+            resp_size = len(encode_response(resp))
+        except (TypeError, ValueError):
+            resp_size = -1
+        msg = "Slow request: method=%s id=%s %s req_bytes=%d resp_bytes=%d error=%s params=%s" % \
+            (method, json.dumps(req.get("id")), phases, req_size, resp_size, code, params)
+        if suppressed:
+            msg += " (%d slow requests not logged)" % suppressed
+        self.log.warning(msg)
+
+class MethodProfiler(object):
+    """
+    Profiles a sample of the calls to selected functions, for use with Server (see
+    Server.set_profiler).  Profiles are aggregated per function and can be dumped in
+    pstats format or as collapsed stacks for flamegraph tools.
+
+    Two modes are supported:
+
+    * `cprofile` - sampled calls run under cProfile.  Exact call counts and timings, but
+      slows the profiled call down considerably.  Only one call is profiled at a time,
+      as the interpreter supports a single active profiler; sampled calls made while
+      another is being profiled run unprofiled.
+    * `sample` - a background thread records the stack of each thread running a sampled
+      call every `interval` seconds.  Low overhead and produces full stacks, but only
+      sees calls that last longer than the interval.
+
+    Profiling can be switched on and off at runtime with toggle(), a signal (see
+    install_signal), or the 'barrister-stats' method (see Server.stats).
+    """
 
-        method = req["method"]
+    def __init__(self, mode="cprofile", interval=0.005, enabled=True):
+        """
+        Creates a new MethodProfiler
 
-        if method == "barrister-idl":
-            return self.contract.idl_parsed
+        :Parameters:
+          mode
+            "cprofile" or "sample"
+          interval
+            Seconds between stack samples when mode is "sample"
+          enabled
+            If False, no calls are profiled until toggle() is called
+        """
+        if mode not in ("cprofile", "sample"):
+            raise ValueError("Unknown profiler mode: %s" % mode)
+        self.mode = mode
+        self.interval = interval
+        self.enabled = enabled
+        self.targets = { }
+        self.calls = { }
+        self.profiles = { }
+        self.stacks = { }
+        self.active = { }
+        self.sampler = None
+        self.lock = threading.Lock()
+        self.profile_lock = threading.Lock()
+
+    def add(self, method, sample_rate=1.0):
+        """
+        Starts profiling a function
 
-        iface_name, func_name = unpack_method(method)
+        :Parameters:
+          method
+            "Interface.function" name
+          sample_rate
+            Fraction of calls to profile, between 0 and 1
+        """
+        with self.lock:
+            self.targets[method] = sample_rate
 
-        if iface_name in self.handlers:
-            iface_impl = self.handlers[iface_name]
-            func = getattr(iface_impl, func_name)
-            if func:
-                if "params" in req:
-                    params = req["params"]
-                else:
-                    params = []
+    def remove(self, method):
+        """
+        Stops profiling a function.  Profiles collected so far are kept.
+        """
+        with self.lock:
+            self.targets.pop(method, None)
 
-                if self.validate_req:
-                    self.contract.validate_request(iface_name, func_name, params)
+    def toggle(self, enabled=None):
+        """
+        Enables or disables profiling of all configured functions.  If enabled is None
+        the current state is flipped.
+        """
+        if enabled is None:
+            enabled = not self.enabled
+        self.enabled = enabled
 
-                if hasattr(iface_impl, "barrister_pre"):
-                    pre_hook = getattr(iface_impl, "barrister_pre")
-                    pre_hook(context, params)
+    def install_signal(self, signum=getattr(signal, "SIGUSR2", None)):
+        """
+        Installs a signal handler that calls toggle().  Must be called from the main thread.
 
-                if params:
-                    result = func(*params)
-                else:
-                    result = func()
+        :Parameters:
+          signum
+            Signal number.  Defaults to SIGUSR2.
+        """
+        signal.signal(signum, lambda signum, frame: self.toggle())
+
+    def should_profile(self, method):
+        """
+        Returns True if this call to method should be profiled
+        """
+        if not self.enabled:
+            return False
+        rate = self.targets.get(method)
+        return rate is not None and (rate >= 1.0 or random.random() < rate)
+
+    def run(self, method, func, params):
+        """
+        Calls func(*params), profiling it, and returns its result
+        """
+        if self.mode == "cprofile":
+            if not self.profile_lock.acquire(False):
+                # another call is being profiled
+                return func(*params)
+            try:
+                with self.lock:
+                    self.calls[method] = self.calls.get(method, 0) + 1
+                prof = cProfile.Profile()
+                try:
+                    return prof.runcall(func, *params)
+                finally:
+                    with self.lock:
+                        if method in self.profiles:
+                            self.profiles[method].add(prof)
+                        else:
+                            self.profiles[method] = pstats.Stats(prof)
+            finally:
+                self.profile_lock.release()
+
+        ident = threading.current_thread().ident
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self.active[ident] = method
+            if self.sampler is None:
+                self.sampler = threading.Thread(target=self._sample,
+                                                name="barrister-profiler")
+                self.sampler.daemon = True
+                self.sampler.start()
+        try:
+            return func(*params)
+        finally:
+            with self.lock:
+                del self.active[ident]
+
+    def _sample(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                if not self.active:
+                    self.sampler = None
+                    return
+                for ident, method in self.active.items():
+                    frame = frames.get(ident)
+                    if frame is None:
+                        continue
+                    stack = [ ]
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append("%s (%s:%d)" % (code.co_name,
+                                                     os.path.basename(code.co_filename),
+                                                     code.co_firstlineno))
+                        frame = frame.f_back
+                    key = ";".join(reversed(stack))
+                    counts = self.stacks.setdefault(method, { })
+                    counts[key] = counts.get(key, 0) + 1
+
+    def collapsed(self, method):
+        """
+        Returns the profile of method in collapsed stack format ("frame;frame;frame count"
+        per line), as read by flamegraph.pl and speedscope.  In cprofile mode stacks are
+        reconstructed from caller/callee pairs, so they are one call deep.
+        """
+        lines = [ ]
+        with self.lock:
+            if method in self.stacks:
+                for stack, count in sorted(self.stacks[method].items()):
+                    lines.append("%s %d" % (stack, count))
+            elif method in self.profiles:
+                for func, stat in sorted(self.profiles[method].stats.items()):
+                    # stat is (prim calls, calls, internal time, cumulative time, callers)
+                    for caller, caller_stat in sorted(stat[4].items()):
+                        # weight by microseconds.  Calls too short to measure count as
+                        # 1us, as flamegraph tools drop stacks with a weight of 0
+                        usec = max(int(caller_stat[2] * 1000000), 1)
+                        lines.append("%s;%s %d" % (pstats.func_std_string(caller),
+                                                   pstats.func_std_string(func), usec))
+        return "\n".join(lines)
+
+    def report(self, method, sort="cumulative", limit=30):
+        """
+        Returns the cProfile profile of method as text, sorted by sort and limited to the
+        top limit functions.  Returns None if the method has not been profiled in
+        cprofile mode.
+        """
+        with self.lock:
+            stats = self.profiles.get(method)
+            if stats is None:
+                return None
+            out = six.StringIO()
+            stats.stream = out
+            stats.sort_stats(sort).print_stats(limit)
+            return out.getvalue()
+
+    def dump(self, method, path):
+        """
+        Writes the cProfile profile of method to path in pstats format, for loading with
+        pstats or snakeviz.  Raises ValueError if the method has not been profiled in
+        cprofile mode.
+        """
+        with self.lock:
+            stats = self.profiles.get(method)
+            if stats is None:
+                raise ValueError("No cProfile profile for %s" % method)
+            stats.dump_stats(path)
+
+    def clear(self, method=None):
+        """
+        Discards collected profiles for method, or for all functions if method is None
+        """
+        with self.lock:
+            if method is None:
+                self.profiles.clear()
+                self.stacks.clear()
+                self.calls.clear()
+            else:
+                self.profiles.pop(method, None)
+                self.stacks.pop(method, None)
+                self.calls.pop(method, None)
+
+    def stats(self):
+        """
+        Returns a dict with keys: 'enabled', 'mode', 'targets' (method to sample rate) and
+        'calls' (method to number of calls profiled)
+        """
+        with self.lock:
+            return { "enabled": self.enabled, "mode": self.mode,
+                     "targets": dict(self.targets), "calls": dict(self.calls) }
+
+method_re = re.compile(r'"method"\s*:\s*"([^"\\]*)"')
+batch_re = re.compile(r"\s*\[")
+
+def peek_method(req_json):
+    """
+    Returns the method of a JSON encoded single request without decoding it, or None if
+    it cannot be found or req_json is a batch.  Used for decisions that must be made
+    before paying for decoding, so a "method" key nested in the params may be matched
+    instead.
+    """
+    if batch_re.match(req_json):
+        return None
+    m = method_re.search(req_json)
+    if m is None:
+        return None
+    return m.group(1)
+
+id_re = re.compile(r'"id"\s*:\s*("(?:[^"\\]|\\.)*"|-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?|null)')
+
+def peek_id(req_json, default=None):
+    """
+    Returns the id of a JSON encoded single request without decoding the request, or
+    default if it cannot be found for certain or req_json is a batch.  Unlike the
+    method, a wrong id would send a response to the wrong caller, so an id is only
+    returned if it is the only "id" key in the request and comes before the params,
+    where it cannot be nested inside them.
+    """
+    if batch_re.match(req_json):
+        return default
+    matches = list(id_re.finditer(req_json))
+    if len(matches) != 1:
+        return default
+    m = matches[0]
+    params = req_json.find('"params"')
+    if params != -1 and params < m.start():
+        return default
+    return json.loads(m.group(1))
+
+json_ws_re = re.compile(r"\s*")
+json_structural_re = re.compile(r'[\[\]{}"]')
+json_string_end_re = re.compile(r'["\\]')
+json_literal_end_re = re.compile(r"[,\]\s]")
+
+def iter_json_requests(source, max_body=None, max_entry=None, max_depth=None,
+                       chunk_size=65536):
+    """
+    Parses a JSON-RPC request body incrementally, yielding each request of a batch as
+    soon as it has been read, or the request itself if the body is not a batch.  Only
+    the request being read is held in memory, so a large batch can be processed while
+    the rest of it is still arriving.
+
+    Raises RpcException with code ERR_PARSE if the body is not valid JSON, or
+    ERR_INVALID_REQ if it exceeds a limit or is an empty batch.  Limits are checked as
+    the body is read, before the offending request is decoded.
+
+    :Parameters:
+      source
+        File-like object with a read(size) method, iterable of str or bytes chunks, or
+        a string
+      max_body
+        Maximum size of the body, or None for no limit
+      max_entry
+        Maximum size of a single request, or None for no limit
+      max_depth
+        Maximum nesting depth of a single request, counting the request object as 1, or
+        None for no limit
+      chunk_size
+        Number of bytes read from a file-like source at a time
+    """
+    if hasattr(source, "read"):
+        chunks = iter(lambda: source.read(chunk_size), source.read(0))
+    elif isinstance(source, (six.string_types, six.binary_type)):
+        chunks = [ source ]
+    else:
+        chunks = source
+
+    scanner = _RequestScanner(max_entry, max_depth)
+    decoder = codecs.getincrementaldecoder("utf8")()
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            if max_body is not None and size > max_body:
+                raise RpcException(ERR_INVALID_REQ,
+                                   "Invalid Request. Body exceeds %d bytes." % max_body)
+            if isinstance(chunk, six.binary_type):
+                chunk = decoder.decode(chunk)
+            for req in scanner.feed(chunk):
+                yield req
+        for req in scanner.feed(decoder.decode(b"", True), True):
+            yield req
+    except UnicodeDecodeError as e:
+        raise RpcException(ERR_PARSE, "Unable to parse JSON: %s" % str(e))
+
+class _RequestScanner(object):
+    """
+    Internal class that finds the boundaries of the requests in a JSON-RPC body fed to
+    it in pieces.  Used by iter_json_requests().
+    """
+
+    def __init__(self, max_entry=None, max_depth=None):
+        self.max_entry = max_entry
+        self.max_depth = max_depth
+        self.buf = ""
+        # while a value is being read it starts at buf[0], and pos is where to resume
+        self.pos = 0
+        self.in_value = False
+        self.depth = 0
+        self.in_string = False
+        # None until the first character of the body has been read
+        self.batch = None
+        self.count = 0
+        self.need_comma = False
+        self.after_comma = False
+        self.done = False
+
+    def feed(self, text, eof=False):
+        """
+        Adds text to the body read so far, and returns an iterator over the requests it
+        completes.  eof must be True for the last piece of the body.
+        """
+        self.buf += text
+        return self._scan(eof)
+
+    def _error(self, msg):
+        return RpcException(ERR_PARSE, "Unable to parse JSON: %s" % msg)
+
+    def _scan(self, eof):
+        while True:
+            if self.done:
+                if self.buf[self.pos:].strip():
+                    raise self._error("unexpected data after the request")
+                self.buf = ""
+                self.pos = 0
+                return
+
+            if not self.in_value:
+                self.pos = json_ws_re.match(self.buf, self.pos).end()
+                if self.pos == len(self.buf):
+                    self.buf = ""
+                    self.pos = 0
+                    if eof:
+                        raise self._error("unexpected end of input")
+                    return
+                c = self.buf[self.pos]
+                if self.batch is None:
+                    self.batch = c == "["
+                    if self.batch:
+                        self.pos += 1
+                        continue
+                elif c == "]":
+                    if self.count == 0 and not self.after_comma:
+                        raise RpcException(ERR_INVALID_REQ, "Invalid Request. Empty batch.")
+                    if self.after_comma:
+                        raise self._error("unexpected ']' after ','")
+                    self.pos += 1
+                    self.done = True
+                    continue
+                elif self.need_comma:
+                    if c != ",":
+                        raise self._error("expected ',' or ']' but found '%s'" % c)
+                    self.pos += 1
+                    self.need_comma = False
+                    self.after_comma = True
+                    continue
+                self.buf = self.buf[self.pos:]
+                self.pos = 0
+                self.in_value = True
+                self.depth = 0
+                self.in_string = False
+
+            end = self._value_end(eof)
+            if end is None:
+                if self.max_entry is not None and len(self.buf) > self.max_entry:
+                    raise self._too_large()
+                if eof:
+                    raise self._error("unexpected end of input")
+                return
+            if self.max_entry is not None and end > self.max_entry:
+                raise self._too_large()
+
+            text = self.buf[:end]
+            self.buf = self.buf[end:]
+            self.pos = 0
+            self.in_value = False
+            self.count += 1
+            self.need_comma = self.batch
+            self.after_comma = False
+            self.done = not self.batch
+            try:
+                req = json.loads(text)
+            except ValueError as e:
+                raise self._error(str(e))
+            yield req
+
+    def _too_large(self):
+        return RpcException(ERR_INVALID_REQ,
+                            "Invalid Request. Request exceeds %d bytes." % self.max_entry)
+
+    def _value_end(self, eof):
+        """
+        Returns the offset just past the end of the value at the start of buf, or None
+        if it has not been read completely yet
+        """
+        buf = self.buf
+        if buf[0] not in '{["':
+            # number, true, false or null
+            m = json_literal_end_re.search(buf)
+            if m is not None:
+                return m.start()
+            return len(buf) if eof else None
+
+        pos = self.pos
+        while pos < len(buf):
+            if self.in_string:
+                m = json_string_end_re.search(buf, pos)
+                if m is None:
+                    pos = len(buf)
+                    break
+                if m.group() == "\\":
+                    if m.end() == len(buf):
+                        # the escaped character has not been read yet
+                        pos = m.start()
+                        break
+                    pos = m.end() + 1
+                    continue
+                pos = m.end()
+                self.in_string = False
+                if self.depth == 0:
+                    return pos
+                continue
+
+            m = json_structural_re.search(buf, pos)
+            if m is None:
+                pos = len(buf)
+                break
+            c = m.group()
+            pos = m.end()
+            if c == '"':
+                self.in_string = True
+            elif c in "{[":
+                self.depth += 1
+                if self.max_depth is not None and self.depth > self.max_depth:
+                    raise RpcException(ERR_INVALID_REQ,
+                                       "Invalid Request. Nesting exceeds depth %d." %
+                                       self.max_depth)
+            else:
+                self.depth -= 1
+                if self.depth == 0:
+                    return pos
+        self.pos = pos
+        return None
+
+class AdmissionController(object):
+    """
+    Sheds load before a Server is overwhelmed, for use with Server (see
+    Server.set_admission_controller).  Rejected requests fail fast with ERR_OVERLOADED,
+    with a `retry_after` hint in seconds in the error data.
+
+    Requests are rejected when:
+
+    * `max_in_flight` requests are already executing.  The last `reserved` slots are
+      kept for priority 0 requests.
+    * Queueing delay has stayed above `target_delay` for a whole `interval`, like the
+      CoDel queue management algorithm.  While the server is in this state, requests
+      with a priority of `shed_priority` or more are rejected until a request is seen
+      that waited less than target_delay.  Queueing delay is the time between a request
+      arriving and Server.call_json starting on it, and is only known when the transport
+      sets the `received_at` property, as HttpRequestHandler and TcpServer do.
+
+    Priorities are integers where 0 is the most important.  They are assigned per
+    interface or per function via `priorities`.
+
+    Single requests passed to Server.call_json are checked before they are decoded, by
+    looking for the method and id in the raw JSON.  Each request in a batch, and single
+    requests whose id is not found, are checked after they are decoded.
+    """
+
+    def __init__(self, max_in_flight=None, reserved=0, target_delay=0.005, interval=0.1,
+                 priorities=None, default_priority=1, shed_priority=1, retry_after=1.0):
+        """
+        Creates a new AdmissionController
+
+        :Parameters:
+          max_in_flight
+            Maximum number of requests executing at once, or None for no limit
+          reserved
+            Number of the max_in_flight slots only priority 0 requests may use
+          target_delay
+            Acceptable queueing delay in seconds
+          interval
+            Seconds queueing delay must stay above target_delay before requests are shed
+          priorities
+            Dict mapping interface names or "Interface.function" names to priorities.
+            Function entries take precedence over interface entries.
+          default_priority
+            Priority of requests not matched by priorities
+          shed_priority
+            Lowest priority number shed when queueing delay is too high
+          retry_after
+            Seconds clients are told to wait before retrying
+        """
+        self.max_in_flight = max_in_flight
+        self.reserved = reserved
+        self.target_delay = target_delay
+        self.interval = interval
+        self.priorities = priorities or { }
+        self.default_priority = default_priority
+        self.shed_priority = shed_priority
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.overloaded = False
+        self.above_since = None
+        self.admitted = 0
+        self.shed = { }
+        self.lock = threading.Lock()
+
+    def priority(self, method):
+        """
+        Returns the priority of a "Interface.function" method name
+        """
+        if not isinstance(method, six.string_types):
+            return self.default_priority
+        p = self.priorities.get(method)
+        if p is None:
+            p = self.priorities.get(method.partition(".")[0], self.default_priority)
+        return p
+
+    def observe_delay(self, delay):
+        """
+        Records the queueing delay in seconds of a request that is about to be processed
+        """
+        with self.lock:
+            if delay < self.target_delay:
+                self.above_since = None
+                self.overloaded = False
+            elif self.above_since is None:
+                self.above_since = time.time()
+            elif time.time() - self.above_since >= self.interval:
+                self.overloaded = True
+
+    def _reject_reason(self, priority):
+        if self.max_in_flight is not None:
+            limit = self.max_in_flight
+            if priority > 0:
+                limit -= self.reserved
+            if self.in_flight >= limit:
+                return "in_flight"
+        if self.overloaded and priority >= self.shed_priority:
+            return "queue_delay"
+        return None
+
+    def _rejected(self, reason, priority):
+        key = "%s:%d" % (reason, priority)
+        self.shed[key] = self.shed.get(key, 0) + 1
+        return RpcException(ERR_OVERLOADED, "Server overloaded. Retry later.",
+                            { "retry_after": self.retry_after, "reason": reason })
+
+    def check(self, method):
+        """
+        Returns a RpcException if a request for method would be rejected now, or None.
+        Does not admit the request.
+        """
+        priority = self.priority(method)
+        with self.lock:
+            reason = self._reject_reason(priority)
+            if reason is not None:
+                return self._rejected(reason, priority)
+        return None
+
+    def acquire(self, method):
+        """
+        Admits a request for method, or raises a RpcException with code ERR_OVERLOADED.
+        Every admitted request must be followed by a call to release().
+        """
+        priority = self.priority(method)
+        with self.lock:
+            reason = self._reject_reason(priority)
+            if reason is not None:
+                raise self._rejected(reason, priority)
+            self.in_flight += 1
+            self.admitted += 1
+
+    def release(self):
+        """
+        Marks an admitted request as complete
+        """
+        with self.lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        """
+        Returns a dict with keys: 'in_flight', 'overloaded', 'admitted', and 'shed', which
+        maps "reason:priority" to the number of requests rejected
+        """
+        with self.lock:
+            return { "in_flight": self.in_flight, "overloaded": self.overloaded,
+                     "admitted": self.admitted, "shed": dict(self.shed) }
+
+class _BulkheadWaiter(object):
+    """
+    Internal class for a thread waiting in Bulkhead.acquire() for a slot
+    """
+
+    def __init__(self):
+        self.granted = False
+
+class Bulkhead(object):
+    """
+    Limits how many calls may run at once, with a bounded queue of calls waiting for a
+    slot.  Use from threads with acquire() or from the Twisted reactor thread with
+    acquire_deferred(), and pair each successful acquire with a release().  Waiting
+    calls get slots in the order they arrived, whichever way they wait.
+    """
+
+    def __init__(self, name, max_concurrent, max_queue=0, queue_timeout=None, clock=None):
+        """
+        Creates a new Bulkhead
+
+        :Parameters:
+          name
+            Name reported in errors and stats
+          max_concurrent
+            Maximum number of calls running at once
+          max_queue
+            Maximum number of calls waiting for a slot.  Calls beyond this are rejected
+            immediately.
+          queue_timeout
+            Maximum seconds a call waits for a slot, or None to wait indefinitely
+          clock
+            Twisted IReactorTime used to enforce queue_timeout in acquire_deferred()
+        """
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.clock = clock
+        self.active = 0
+        self.rejected = 0
+        self.timeouts = 0
+        # calls waiting for a slot in arrival order: _BulkheadWaiter instances for
+        # threads, and Deferreds for acquire_deferred()
+        self.waiters = collections.deque()
+        self.cond = threading.Condition()
+
+    def _error(self, reason):
+        return RpcException(ERR_BULKHEAD_FULL, "Bulkhead '%s' is full" % self.name,
+                            { "bulkhead": self.name, "reason": reason })
+
+    def acquire(self, timeout=None):
+        """
+        Takes a slot, waiting for one if the queue is not full.  Raises a RpcException
+        with code ERR_BULKHEAD_FULL if the queue is full or no slot frees up within the
+        bulkhead's queue_timeout, or ERR_DEADLINE_EXCEEDED if the request's deadline
+        passes first.
 
-                if self.validate_resp:
-                    self.contract.validate_response(iface_name, func_name, result)
+        :Parameters:
+          timeout
+            Seconds left until the request's deadline, or None if it has none
+        """
+        expired = RpcException(ERR_DEADLINE_EXCEEDED, "Deadline exceeded")
+        if self.queue_timeout is not None and (timeout is None or self.queue_timeout < timeout):
+            timeout = self.queue_timeout
+            expired = self._error("timeout")
+        with self.cond:
+            if self.active < self.max_concurrent and not self.waiters:
+                self.active += 1
+                return
+            if len(self.waiters) >= self.max_queue:
+                self.rejected += 1
+                raise self._error("full")
+            waiter = _BulkheadWaiter()
+            self.waiters.append(waiter)
+            expires = None
+            if timeout is not None:
+                expires = time.time() + timeout
+            while not waiter.granted:
+                remaining = None
+                if expires is not None:
+                    remaining = expires - time.time()
+                    if remaining <= 0:
+                        self.waiters.remove(waiter)
+                        self.timeouts += 1
+                        raise expired
+                self.cond.wait(remaining)
+
+    def acquire_deferred(self):
+        """
+        Twisted version of acquire().  Returns a Deferred that fires when a slot is taken,
+        or fails with a RpcException.  Must be called from the reactor thread.
+        Cancelling the Deferred gives up the place in the queue.
+        """
+        with self.cond:
+            if self.active < self.max_concurrent and not self.waiters:
+                self.active += 1
+                return defer.succeed(None)
+            if len(self.waiters) >= self.max_queue:
+                self.rejected += 1
+                return defer.fail(self._error("full"))
+
+            def cancel(d):
+                with self.cond:
+                    if d in self.waiters:
+                        self.waiters.remove(d)
+
+            d = defer.Deferred(cancel)
+            self.waiters.append(d)
+
+        if self.queue_timeout is not None and self.clock is not None:
+            def expire():
+                with self.cond:
+                    if d not in self.waiters:
+                        return
+                    self.waiters.remove(d)
+                    self.timeouts += 1
+                d.errback(self._error("timeout"))
+            call = self.clock.callLater(self.queue_timeout, expire)
+
+            def stop_timer(result):
+                if call.active():
+                    call.cancel()
                 return result
+            d.addBoth(stop_timer)
+        return d
+
+    def release(self):
+        """
+        Gives up a slot, handing it to the call that has waited longest if there is one
+        """
+        d = None
+        with self.cond:
+            if not self.waiters:
+                self.active -= 1
+                return
+            waiter = self.waiters.popleft()
+            if isinstance(waiter, _BulkheadWaiter):
+                waiter.granted = True
+                self.cond.notify_all()
             else:
-                msg = "Method '%s' not found" % (method)
-                raise RpcException(ERR_METHOD_NOT_FOUND, msg)
+                d = waiter
+        if d is not None:
+            d.callback(None)
+
+    def stats(self):
+        """
+        Returns a dict with keys: 'active', 'waiting', 'rejected', 'timeouts'
+        """
+        with self.cond:
+            return { "active": self.active, "waiting": len(self.waiters),
+                     "rejected": self.rejected, "timeouts": self.timeouts }
+
+class Bulkheads(object):
+    """
+    Per-interface and per-function concurrency limits for Server and TwistedServer (see
+    Server.set_bulkheads), so a slow interface cannot take every worker and starve the
+    other interfaces served by the same process.  A call that finds its bulkhead full
+    waits in a bounded queue, or fails fast with ERR_BULKHEAD_FULL.
+
+    A call to a function with its own limit must get a slot in both the function's and
+    its interface's bulkhead.  Cache hits and calls coalesced by SingleFlight do not
+    take a slot.
+    """
+
+    def __init__(self, limits, max_queue=0, queue_timeout=None, clock=None):
+        """
+        Creates a new Bulkheads
+
+        :Parameters:
+          limits
+            Dict mapping interface names or "Interface.function" names to the maximum
+            number of concurrent calls
+          max_queue
+            Maximum number of calls waiting for each bulkhead
+          queue_timeout
+            Maximum seconds a call waits for a slot, or None to wait indefinitely.
+            Server also stops waiting at the request's deadline.
+          clock
+            Twisted IReactorTime used to enforce queue_timeout for TwistedServer
+        """
+        self.bulkheads = dict([ (name, Bulkhead(name, limit, max_queue, queue_timeout, clock))
+                                for name, limit in limits.items() ])
+
+    def for_method(self, method):
+        """
+        Returns the list of Bulkheads a call to method must take a slot in, interface first
+        """
+        found = [ ]
+        iface = self.bulkheads.get(method.partition(".")[0])
+        if iface is not None:
+            found.append(iface)
+        func = self.bulkheads.get(method)
+        if func is not None:
+            found.append(func)
+        return found
+
+    def acquire(self, method, timeout=None):
+        """
+        Takes a slot in each bulkhead for method and returns the list of bulkheads to pass
+        to release().  Raises a RpcException with code ERR_BULKHEAD_FULL on failure, or
+        ERR_DEADLINE_EXCEEDED if timeout, the seconds left until the request's deadline,
+        runs out first.
+        """
+        held = [ ]
+        try:
+            for b in self.for_method(method):
+                b.acquire(timeout)
+                held.append(b)
+        except:
+            self.release(held)
+            raise
+        return held
+
+    def acquire_deferred(self, method):
+        """
+        Twisted version of acquire().  Returns a Deferred that fires with the list of
+        bulkheads to pass to release().
+        """
+        held = [ ]
+        d = defer.succeed(None)
+        for b in self.for_method(method):
+            def take(result, b=b):
+                got = b.acquire_deferred()
+                got.addCallback(lambda _: held.append(b))
+                return got
+            d.addCallback(take)
+
+        def failed(f):
+            self.release(held)
+            return f
+        d.addCallbacks(lambda _: held, failed)
+        return d
+
+    def release(self, held):
+        """
+        Releases the slots returned by acquire()
+        """
+        for b in reversed(held):
+            b.release()
+
+    def stats(self):
+        """
+        Returns a dict mapping each bulkhead name to its Bulkhead.stats()
+        """
+        return dict([ (name, b.stats()) for name, b in self.bulkheads.items() ])
+
+traceparent_re = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+def parse_traceparent(value):
+    """
+    Parses a W3C Trace Context `traceparent` value ("00-<trace id>-<span id>-<flags>").
+    Returns a (trace_id, span_id) tuple, or None if value is missing or malformed.
+    """
+    if not isinstance(value, six.string_types):
+        return None
+    m = traceparent_re.match(value.strip().lower())
+    if m is None:
+        return None
+    return m.group(1), m.group(2)
+
+class Span(object):
+    """
+    A timed operation in a trace.  Create spans with Tracer.start_span() or Span.child(),
+    and call finish() when the operation completes to pass the span to the exporter.
+    """
+
+    def __init__(self, tracer, name, trace_id, parent_id, perf_start=None, attributes=None):
+        """
+        Creates a new Span.  Rarely called directly.  Use Tracer.start_span() instead.
+
+        :Parameters:
+          tracer
+            Tracer that exports the span when it finishes
+          name
+            Name of the operation
+          trace_id
+            32 character hex trace id
+          parent_id
+            16 character hex id of the parent span, or None for a root span
+          perf_start
+            perf_timer() value the operation started at.  Defaults to now.
+          attributes
+            Optional dict of attributes
+        """
+        now = perf_timer()
+        if perf_start is None:
+            perf_start = now
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.perf_start = perf_start
+        self.start = time.time() - (now - perf_start)
+        self.duration = None
+        self.attributes = attributes or { }
+
+    def traceparent(self):
+        """
+        Returns the W3C `traceparent` value that makes this span the parent of the
+        receiver's spans
+        """
+        return "00-%s-%s-01" % (self.trace_id, self.span_id)
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def child(self, name, perf_start=None, attributes=None):
+        """
+        Starts a new span whose parent is this span
+        """
+        return Span(self.tracer, name, self.trace_id, self.span_id, perf_start, attributes)
+
+    def add_phase(self, name, perf_start, perf_end):
+        """
+        Records a completed child span covering perf_start to perf_end
+        """
+        self.child(name, perf_start).finish(perf_end)
+
+    def finish(self, perf_end=None):
+        """
+        Ends the span and passes it to the tracer's exporter
+        """
+        if perf_end is None:
+            perf_end = perf_timer()
+        self.duration = perf_end - self.perf_start
+        self.tracer.exporter.export(self)
+
+    def to_dict(self):
+        """
+        Returns the span as a JSON serializable dict.  Times are in seconds since the epoch.
+        """
+        return { "name": self.name, "service": self.tracer.service_name,
+                 "trace_id": self.trace_id, "span_id": self.span_id,
+                 "parent_id": self.parent_id, "start": self.start,
+                 "duration": self.duration, "attributes": self.attributes }
+
+class Tracer(object):
+    """
+    Creates Spans and passes finished spans to an exporter.  An exporter is any object
+    with an `export(span)` method, such as InMemorySpanExporter, FileSpanExporter, or an
+    adapter to a tracing system.  export() is called on the thread that finishes the span,
+    so it should be fast and thread-safe.
+
+    Client, Server and TwistedServer accept a Tracer.  Clients send the trace context in
+    each request's `traceparent` member, and servers continue the trace from it or from a
+    `traceparent` property (e.g. the HTTP header of the same name).
+    """
+
+    def __init__(self, exporter, service_name="barrister"):
+        """
+        Creates a new Tracer
+
+        :Parameters:
+          exporter
+            Object with an export(span) method
+          service_name
+            Name of the service, added to each exported span
+        """
+        self.exporter = exporter
+        self.service_name = service_name
+
+    def start_span(self, name, parent=None, perf_start=None, attributes=None):
+        """
+        Starts a new span
+
+        :Parameters:
+          name
+            Name of the operation
+          parent
+            Parent Span, (trace_id, span_id) tuple, or traceparent string.  If None, the
+            span starts a new trace.
+          perf_start
+            perf_timer() value the operation started at.  Defaults to now.
+          attributes
+            Optional dict of attributes
+        """
+        if isinstance(parent, Span):
+            return parent.child(name, perf_start, attributes)
+        if isinstance(parent, six.string_types):
+            parent = parse_traceparent(parent)
+        if parent:
+            trace_id, parent_id = parent
         else:
-            msg = "No implementation of '%s' found" % (iface_name)
-            raise RpcException(ERR_METHOD_NOT_FOUND, msg)
+            trace_id, parent_id = "%032x" % random.getrandbits(128), None
+        return Span(self, name, trace_id, parent_id, perf_start, attributes)
 
+    def extract(self, context):
+        """
+        Returns the (trace_id, span_id) the request in context continues, read from the
+        `traceparent` property or request member, or None.
+        """
+        parent = parse_traceparent(context.get_prop("traceparent"))
+        if parent is None:
+            parent = parse_traceparent(safe_get(context.request, "traceparent"))
+        return parent
 
-class TwistedServer(object):
+class InMemorySpanExporter(object):
+    """
+    Span exporter that keeps finished spans in memory as dicts (see Span.to_dict).
+    Useful for tests and offline debugging.
+    """
+
+    def __init__(self, maxlen=10000):
+        """
+        Creates a new InMemorySpanExporter
+
+        :Parameters:
+          maxlen
+            Maximum number of spans kept.  Older spans are discarded.
+        """
+        self.spans = collections.deque(maxlen=maxlen)
+
+    def export(self, span):
+        self.spans.append(span.to_dict())
+
+    def clear(self):
+        self.spans.clear()
+
+class FileSpanExporter(object):
+    """
+    Span exporter that appends each finished span to a file as a line of JSON
+    """
+
+    def __init__(self, path):
+        """
+        Creates a new FileSpanExporter
+
+        :Parameters:
+          path
+            Path of the file to append to
+        """
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict()) + "\n"
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(line)
+
+class Server(object):
     """
     Dispatches requests to user created handler classes based on method name.
     Also responsible for validating requests and responses to ensure they conform to the
@@ -451,6 +2211,19 @@ class TwistedServer(object):
         self.contract = contract
         self.handlers = {}
         self.filters = None
+        self.result_cache = None
+        self.single_flight = None
+        self.idempotency_store = None
+        self.metrics = None
+        self.stats_enabled = False
+        self.profiler = None
+        self.slow_log = None
+        self.tracer = None
+        self.timing = False
+        self.admission = None
+        self.bulkheads = None
+        self.notifications = None
+        self.request_limits = { }
 
     def add_handler(self, iface_name, handler):
         """
@@ -482,226 +2255,3624 @@ class TwistedServer(object):
         else:
             self.filters = [ filters ]
 
-    def call_json(self, req_json, props=None):
+    def set_result_cache(self, cache):
         """
-        Deserializes req_json as JSON, invokes self.call(), and serializes result to JSON.
-        Returns JSON encoded string.
+        Sets the ResultCache used to memoize results of idempotent functions.  Functions
+        annotated with @cacheable in the IDL are enabled in addition to those configured on
+        the cache.
 
         :Parameters:
-          req_json
-            JSON-RPC request serialized as JSON string
-          props
-            Application defined properties to set on RequestContext for use with filters.
-            For example: authentication headers.  Must be a dict.
+          cache
+            ResultCache instance, or None to disable caching
         """
-        try:
-            req = json.loads(req_json)
-        except:
-            msg = "Unable to parse JSON: %s" % req_json
-            return defer.fail(json.dumps(err_response(None, -32700, msg)))
-
-        d = self.call(req, props)
-        d.addBoth(json.dumps)
-        return d
+        if cache is not None:
+            cache.configure(self.contract)
+        self.result_cache = cache
 
-    def call(self, req, props=None):
+    def set_single_flight(self, single_flight):
         """
-        Executes a Barrister request and returns a response.  If the request is a list, then the
-        response will also be a list.  If the request is an empty list, a RpcException is raised.
+        Sets the SingleFlight used to collapse concurrent identical requests into a single
+        handler execution.
 
         :Parameters:
-          req
-            The request. Either a list of dicts, or a single dict.
-          props
-            Application defined properties to set on RequestContext for use with filters.
-            For example: authentication headers.  Must be a dict.
+          single_flight
+            SingleFlight instance, or None to execute every request
         """
+        self.single_flight = single_flight
 
-        if self.log.isEnabledFor(logging.DEBUG):
-            self.log.debug("Request: %s" % str(req))
+    def set_idempotency_store(self, store):
+        """
+        Sets the IdempotencyStore used to deduplicate retried requests that carry an
+        idempotency key.
 
-        if isinstance(req, list):
-            if len(req) < 1:
-                d = defer.fail(err_response(None, ERR_INVALID_REQ, "Invalid Request. Empty batch."))
-            else:
-                # run the batch call collecting the responses
-                d = defer.DeferredList([self._call_and_format(r, props) for r in req])
-        else:
-            d = self._call_and_format(req, props)
+        :Parameters:
+          store
+            IdempotencyStore instance, or None to disable deduplication
+        """
+        self.idempotency_store = store
 
-        def log_response(response):
-            if self.log.isEnabledFor(logging.DEBUG):
-                self.log.debug("Response: %s" % str(response))
-            return response
+    def set_metrics(self, metrics):
+        """
+        Sets the ServerMetrics that request counts, errors, phase timings and payload sizes
+        are recorded to.
 
-        d.addBoth(log_response)
-        return d
+        :Parameters:
+          metrics
+            ServerMetrics instance, or None to disable metrics
+        """
+        self.metrics = metrics
 
-    def _call_and_format(self, req, props=None):
+    def set_stats_enabled(self, enabled):
         """
-        Invokes a single request against a handler using _call() and traps any errors,
-        formatting them using _err().  If the request is successful it is wrapped in a
-        JSON-RPC 2.0 compliant dict with keys: 'jsonrpc', 'id', 'result'.
+        Enables or disables the reserved 'barrister-stats' method, which returns live
+        runtime statistics for this server:
+
+        - `uptime` - seconds since the server's metrics were created
+        - `functions` - per function stats from ServerMetrics.summary(), if metrics are set
+        - `caches` - stats for the result cache, single flight and idempotency store, if set
+        - `memory` - process memory usage (see process_memory())
+
+        Like any other request, 'barrister-stats' passes through the server's filters, so
+        a Filter should be used to restrict access to it.
 
         :Parameters:
-          req
-            A single dict representing a single JSON-RPC request
-          props
-            Application defined properties to set on RequestContext for use with filters.
-            For example: authentication headers.  Must be a dict.
+          enabled
+            If True, 'barrister-stats' requests are served.  Otherwise they fail with
+            ERR_METHOD_NOT_FOUND.
         """
-        if not isinstance(req, dict):
-            return err_response(None, ERR_INVALID_REQ,
-                                "Invalid Request. %s is not an object." % str(req))
+        self.stats_enabled = enabled
 
-        reqid = None
-        if "id" in req:
-            reqid = req["id"]
+    def set_profiler(self, profiler):
+        """
+        Sets the MethodProfiler used to profile a sample of handler calls
 
-        if props is None:
-            props = {}
-        context = RequestContext(props, req)
+        :Parameters:
+          profiler
+            MethodProfiler instance, or None to disable profiling
+        """
+        self.profiler = profiler
 
-        if self.filters:
-            for f in self.filters:
-                f.pre(context)
+    def set_slow_log(self, slow_log):
+        """
+        Sets the SlowRequestLog that requests exceeding their latency threshold are
+        written to
 
-        if context.error:
-            return context.error
+        :Parameters:
+          slow_log
+            SlowRequestLog instance, or None to disable the slow request log
+        """
+        self.slow_log = slow_log
 
-        d = self._call(context)
+    def set_tracer(self, tracer):
+        """
+        Sets the Tracer used to record a span for each request, with child spans for
+        decoding, filters, validation, handler execution and encoding
 
-        def makeResponse(result):
-            return { "jsonrpc": "2.0", "id": reqid, "result": result }
+        :Parameters:
+          tracer
+            Tracer instance, or None to disable tracing
+        """
+        self.tracer = tracer
 
-        def handleRpcException(failure):
-            failure.trap(RpcException)
-            e = failure.value
-            return err_response(reqid, e.code, e.msg, e.data)
+    def set_timing(self, enabled):
+        """
+        Enables or disables returning a per-request phase breakdown to callers.  When
+        enabled each response carries a `timing` member mapping phase to milliseconds:
+        filters, validate_request, handler, validate_response and total.  call_json()
+        adds decode, and queue if the transport set a `received_at` property (the
+        perf_timer() value when the request arrived).  It also stores the breakdown,
+        including encode, in the `server_timing` property so HTTP adapters can send it
+        as a Server-Timing header.
 
-        d.addCallbacks(makeResponse, handleRpcException)
+        :Parameters:
+          enabled
+            If True, timings are added to responses
+        """
+        self.timing = enabled
 
-        def handleUnexpectedExceptions(failure):
-            failure.trap(Exception)
-            self.log.exception("Error processing request: %s" % str(req))
-            return err_response(reqid, ERR_UNKNOWN,
-                                "Server error. Check logs for details.",
-                                data={'exception': str(failure.value)})
+    def set_admission_controller(self, admission):
+        """
+        Sets the AdmissionController that decides which requests to reject when the
+        server is overloaded
 
-        d.addErrback(handleUnexpectedExceptions)
+        :Parameters:
+          admission
+            AdmissionController instance, or None to accept every request
+        """
+        self.admission = admission
+
+    def set_bulkheads(self, bulkheads):
+        """
+        Sets the Bulkheads that limit how many calls to each interface or function may
+        run at once
+
+        :Parameters:
+          bulkheads
+            Bulkheads instance, or None for no limits
+        """
+        self.bulkheads = bulkheads
+
+    def set_notification_executor(self, executor):
+        """
+        Sets the NotificationExecutor that runs notifications (requests without an 'id')
+        in the background.  Once set, notifications are acknowledged as soon as they are
+        queued and get no response: call() returns None for them and call_json() returns
+        an empty string, and they are left out of batch responses.  Without an executor,
+        notifications run before the response is sent and are answered like any request.
+
+        :Parameters:
+          executor
+            NotificationExecutor instance, or None to run notifications inline
+        """
+        self.notifications = executor
+
+    def set_request_limits(self, max_body=None, max_entry=None, max_depth=None):
+        """
+        Sets the limits call_json_stream() enforces while it parses a request body.  A
+        body that exceeds one is answered with an ERR_INVALID_REQ error, and the rest of
+        it is not read.
+
+        :Parameters:
+          max_body
+            Maximum size of the body in bytes, or None for no limit
+          max_entry
+            Maximum size of a single request in a batch, or None for no limit
+          max_depth
+            Maximum nesting depth of a single request, counting the request object as 1,
+            or None for no limit
+        """
+        self.request_limits = { "max_body": max_body, "max_entry": max_entry,
+                                "max_depth": max_depth }
+
+    def stats(self, options=None):
+        """
+        Returns the dict served by the 'barrister-stats' method.
+
+        If a MethodProfiler is set, options may control it:
+
+        - `profile` - dict with keys 'method' and 'sample_rate'.  Starts profiling the
+          method, or stops if sample_rate is 0.
+        - `profile_enabled` - bool passed to MethodProfiler.toggle()
+        - `profile_report` - method name.  Its profile is returned under 'profile_report'
+          with keys 'text' (cprofile mode only) and 'collapsed'.
+
+        :Parameters:
+          options
+            Dict of options, or None
+        """
+        profiler = self.profiler
+        if options and profiler is not None:
+            profile = options.get("profile")
+            if isinstance(profile, dict) and "method" in profile:
+                rate = profile.get("sample_rate", 1.0)
+                if rate:
+                    profiler.add(profile["method"], rate)
+                else:
+                    profiler.remove(profile["method"])
+            if "profile_enabled" in options:
+                profiler.toggle(bool(options["profile_enabled"]))
+
+        stats = { "caches": { }, "memory": process_memory() }
+        if profiler is not None:
+            stats["profiler"] = profiler.stats()
+            method = options and options.get("profile_report")
+            if method:
+                stats["profile_report"] = { "text": profiler.report(method),
+                                            "collapsed": profiler.collapsed(method) }
+        if self.metrics is not None:
+            stats["uptime"] = time.time() - self.metrics.started
+            stats["functions"] = self.metrics.summary()
+        if self.result_cache is not None:
+            stats["caches"]["result_cache"] = self.result_cache.stats()
+        if self.single_flight is not None:
+            stats["caches"]["single_flight"] = self.single_flight.stats()
+        if self.idempotency_store is not None:
+            stats["caches"]["idempotency"] = self.idempotency_store.stats()
+        if self.admission is not None:
+            stats["admission"] = self.admission.stats()
+        if self.bulkheads is not None:
+            stats["bulkheads"] = self.bulkheads.stats()
+        if self.notifications is not None:
+            stats["notifications"] = self.notifications.stats()
+        return stats
+
+    def call_json(self, req_json, props=None):
+        """
+        Deserializes req_json as JSON, invokes self.call(), and serializes result to JSON.
+        Returns JSON encoded string.
+
+        :Parameters:
+          req_json
+            JSON-RPC request serialized as JSON string
+          props
+            Application defined properties to set on RequestContext for use with filters.
+            For example: authentication headers.  Must be a dict.
+        """
+        return self._call_json(req_json, props, False)
+
+    def call_json_chunks(self, req_json, props=None):
+        """
+        Like call_json(), but returns the response as a list or iterator of JSON strings
+        to write one after another.  If the request is a single call whose handler
+        returned an iterator for an array result, the response is an iterator that reads,
+        validates and encodes the elements as it is consumed (see iter_encode_response),
+        so memory use does not grow with the size of the result.  Otherwise it is a list
+        holding the call_json() response, or an empty list if there is no response.
+
+        The request's metrics, timings and span cover running the handler, not reading
+        the stream.
+
+        :Parameters:
+          req_json
+            JSON-RPC request serialized as JSON string
+          props
+            Application defined properties to set on RequestContext for use with filters.
+            For example: authentication headers.  Must be a dict.
+        """
+        resp = self._call_json(req_json, props, True)
+        if isinstance(resp, six.string_types):
+            return [ resp ] if resp else [ ]
+        return resp
+
+    def _call_json(self, req_json, props, stream):
+        """
+        Implements call_json().  If stream is True, a response with a ResultStream result
+        is returned as an iterator from iter_encode_response().
+        """
+        start = perf_timer()
+        admission = self.admission
+        if admission is not None:
+            received = (props or { }).get("received_at")
+            if received is not None:
+                admission.observe_delay(start - received)
+            # reject single requests before paying for decoding them.  Requests whose id
+            # cannot be found are decoded first, so the rejection can echo it.
+            missing = object()
+            reqid = peek_id(req_json, missing)
+            if reqid is not missing:
+                e = admission.check(peek_method(req_json))
+                if e is not None:
+                    return json.dumps(err_response(reqid, e.code, e.msg, e.data))
+
+        try:
+            req = json.loads(req_json)
+        except:
+            msg = "Unable to parse JSON: %s" % req_json
+            return json.dumps(err_response(None, -32700, msg))
+        decoded = perf_timer()
+
+        span = None
+        if self.tracer is not None:
+            parent = parse_traceparent((props or { }).get("traceparent"))
+            if parent is None:
+                first = req[0] if isinstance(req, list) and req else req
+                parent = parse_traceparent(safe_get(first, "traceparent")
+                                           if isinstance(first, dict) else None)
+            name = "barrister.batch" if isinstance(req, list) else "barrister.call_json"
+            span = self.tracer.start_span(name, parent, start)
+            span.add_phase("decode", start, decoded)
+
+        raw = self.result_cache is not None and self.result_cache.serialize
+        resp = self._dispatch(req, props, raw, span)
+        if resp is None:
+            # notifications queued on the NotificationExecutor get no response
+            if span is not None:
+                span.finish()
+            return ""
+        if stream and isinstance(resp, dict) and \
+                isinstance(safe_get(resp, "result"), ResultStream):
+            if span is not None:
+                span.finish()
+            return iter_encode_response(resp)
+        resp = materialize(resp)
+
+        timing = None
+        if self.timing:
+            timing = { "decode": decoded - start }
+            received = (props or { }).get("received_at")
+            if received is not None:
+                timing["queue"] = start - received
+            timing = format_timings(timing)
+            if isinstance(resp, dict) and "timing" in resp:
+                resp["timing"].update(timing)
+                timing = resp["timing"]
+
+        encode_start = perf_timer()
+        if raw:
+            resp_json = encode_response(resp)
+        else:
+            resp_json = json.dumps(resp)
+
+        if timing is not None and props is not None:
+            timing = dict(timing)
+            timing["encode"] = round((perf_timer() - encode_start) * 1000.0, 3)
+            timing["total"] = round((perf_timer() - start) * 1000.0, 3)
+            props["server_timing"] = timing
+
+        if span is not None:
+            encoded = perf_timer()
+            span.add_phase("encode", encode_start, encoded)
+            span.finish(encoded)
+
+        metrics = self.metrics
+        if metrics is not None:
+            if isinstance(req, list):
+                name = "batch"
+            else:
+                name = self._metric_name(req)
+            metrics.record_phase(name, "decode", decoded - start)
+            metrics.record_phase(name, "encode", perf_timer() - encode_start)
+            metrics.record_size(name, "request", encoded_size(req_json))
+            metrics.record_size(name, "response", encoded_size(resp_json))
+        return resp_json
+
+    def call_json_streaming(self, req_json, send, props=None):
+        """
+        Same as call_json_stream(), for a request body that has already been read into a
+        string
+
+        :Parameters:
+          req_json
+            JSON-RPC request serialized as JSON string
+          send
+            Callable invoked with each JSON encoded response string
+          props
+            Application defined properties to set on RequestContext for use with filters.
+            For example: authentication headers.  Must be a dict.
+        """
+        self.call_json_stream(req_json, send, props)
+
+    def call_json_stream(self, source, send, props=None):
+        """
+        Executes a request like call_json(), but instead of building the whole batch
+        response, each response is serialized and passed to `send` as soon as its request
+        completes.  The first results of a large batch reach the client without waiting
+        for the rest.  Requests run one after another, so responses are sent in request
+        order.  Notifications queued on the NotificationExecutor are not answered.
+
+        The request body is parsed incrementally from source with iter_json_requests().
+        Each request in a batch is validated and executed as soon as it has been parsed,
+        while the rest of the body is still being read, and only one request is held in
+        memory at a time.  The limits set with set_request_limits() are enforced while
+        parsing.  If the body is malformed or exceeds a limit, an error response is sent
+        after the responses to the requests before the problem, and reading stops.
+
+        :Parameters:
+          source
+            File-like object with a read(size) method, iterable of str or bytes chunks,
+            or a string
+          send
+            Callable invoked with each JSON encoded response string
+          props
+            Application defined properties to set on RequestContext for use with filters.
+            For example: authentication headers.  Must be a dict.
+        """
+        reqs = iter_json_requests(source, **self.request_limits)
+        try:
+            self._send_each(reqs, send, props)
+        except RpcException as e:
+            send(json.dumps(err_response(None, e.code, e.msg, e.data)))
+
+    def _send_each(self, reqs, send, props):
+        """
+        Executes each request from the iterable reqs and passes its JSON encoded response
+        to send
+        """
+        raw = self.result_cache is not None and self.result_cache.serialize
+        for r in reqs:
+            if self.notifications is not None and is_notification(r):
+                self._notify(r, props)
+                continue
+            resp = materialize(self._call_and_format(r, props, raw))
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug("Response: %s" % str(resp))
+            if raw:
+                send(encode_response(resp))
+            else:
+                send(json.dumps(resp))
+
+    def _metric_name(self, req):
+        """
+        Returns the method of req if it names a function in the IDL, or "unknown".  Keeps
+        the number of distinct names recorded in metrics bounded.
+        """
+        method = safe_get(req, "method") if isinstance(req, dict) else None
+        if method == "barrister-idl" or method == "barrister-stats":
+            return method
+        if isinstance(method, six.string_types):
+            iface_name, sep, func_name = method.partition(".")
+            iface = self.contract.interfaces.get(iface_name)
+            if iface is not None and func_name in iface.functions:
+                return method
+        return "unknown"
+
+    def call(self, req, props=None):
+        """
+        Executes a Barrister request and returns a response.  If the request is a list, then the
+        response will also be a list.  If the request is an empty list, a RpcException is raised.
+        If a NotificationExecutor is set, None is returned for notifications.
+
+        :Parameters:
+          req
+            The request. Either a list of dicts, or a single dict.
+          props
+            Application defined properties to set on RequestContext for use with filters.
+            For example: authentication headers.  Must be a dict.
+        """
+        return materialize(self._dispatch(req, props, False))
+
+    def _dispatch(self, req, props, raw, span=None):
+        """
+        Implements call().  If raw is True, results served from a serialized ResultCache
+        are returned as RawJson instances, and the response must be serialized with
+        encode_response().  If span is set, request spans are recorded as its children.
+        """
+        resp = None
+
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Request: %s" % str(req))
+
+        if isinstance(req, list):
+            if len(req) < 1:
+                resp = err_response(None, ERR_INVALID_REQ, "Invalid Request. Empty batch.")
+            else:
+                if self.metrics is not None:
+                    self.metrics.record_batch(len(req))
+                if self.notifications is not None:
+                    calls = [ ]
+                    for r in req:
+                        if is_notification(r):
+                            self._notify(r, props)
+                        else:
+                            calls.append(r)
+                    req = calls
+                # run the batch call collecting the responses
+                resp = [self._call_and_format(r, props, raw, span) for r in req]
+                if not resp:
+                    resp = None
+        elif self.notifications is not None and is_notification(req):
+            self._notify(req, props)
+        else:
+            resp = self._call_and_format(req, props, raw, span)
+
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Response: %s" % str(resp))
+        return resp
+
+    def _notify(self, req, props):
+        """
+        Queues the notification req on the NotificationExecutor
+        """
+        if props is not None:
+            # the transport may reuse its props once the response is sent
+            props = dict(props)
+
+        def run():
+            resp = self._call_and_format(req, props)
+            err = safe_get(resp, "error")
+            if err is not None:
+                raise RpcException(err["code"], err["message"], safe_get(err, "data"))
+        self.notifications.submit(safe_get(req, "method"), run)
+
+    def _call_and_format(self, req, props=None, raw=False, parent_span=None):
+        """
+        Invokes a single request against a handler using _call() and traps any errors,
+        formatting them using _err().  If the request is successful it is wrapped in a
+        JSON-RPC 2.0 compliant dict with keys: 'jsonrpc', 'id', 'result'.
+
+        :Parameters:
+          req
+            A single dict representing a single JSON-RPC request
+          props
+            Application defined properties to set on RequestContext for use with filters.
+            For example: authentication headers.  Must be a dict.
+          raw
+            If True, a result served from a serialized ResultCache is returned as RawJson
+          parent_span
+            Span the request's span is a child of.  If None, the trace is continued from
+            the request's traceparent, if any.
+        """
+        start = perf_timer()
+        if not isinstance(req, dict):
+            return err_response(None, ERR_INVALID_REQ,
+                                "Invalid Request. %s is not an object." % str(req))
+
+        reqid = None
+        if "id" in req:
+            reqid = req["id"]
+
+        if props is None:
+            props = {}
+        context = RequestContext(props, req)
+
+        if self.tracer is not None:
+            parent = parent_span or self.tracer.extract(context)
+            context.span = self.tracer.start_span(
+                str(safe_get(req, "method", "unknown")), parent, start,
+                { "rpc.id": reqid })
 
         if self.filters:
-            def postHook(hook, result):
-                context.response = result
-                hook(context)
-                return result
+            filter_start = perf_timer()
+            for f in self.filters:
+                f.pre(context)
+            self._phase(context, "filters", filter_start)
+
+        if context.error:
+            self._record(context, context.error, start)
+            return context.error
+
+        admission = self.admission
+        if admission is not None:
+            try:
+                admission.acquire(safe_get(req, "method"))
+            except RpcException as e:
+                resp = err_response(reqid, e.code, e.msg, e.data)
+                self._record(context, resp, start)
+                return resp
+
+        metrics = self.metrics
+        if metrics is not None:
+            name = self._metric_name(req)
+            metrics.start_request(name)
+
+        def finish():
+            if metrics is not None:
+                metrics.finish_request(name)
+            if admission is not None:
+                admission.release()
+
+        resp = None
+        try:
+            store = self.idempotency_store
+            key = None
+            if store is not None:
+                key = store.key_for(context)
+            if key is not None:
+                # stored responses are replayed to call() as well, so never store RawJson
+                # or a ResultStream
+                resp = store.execute(key, reqid,
+                                     lambda: materialize(self._execute(context, reqid, False)))
+            else:
+                resp = self._execute(context, reqid, raw)
+        finally:
+            stream = result_stream(resp)
+            if stream is not None:
+                # the handler keeps running until the stream has been read
+                stream.on_close(finish)
+            else:
+                finish()
+
+        if self.filters:
+            context.response = resp
+            if isinstance(safe_get(resp, "result"), RawJson):
+                # filters see the decoded result, whether or not it was served serialized
+                context.response = dict(resp, result=resp["result"].value)
+            for f in self.filters:
+                f.post(context)
+
+        if stream is not None:
+            stream.on_close(self._stream_recorder(context, stream, resp, start))
+        else:
+            self._record(context, resp, start)
+        if self.timing:
+            # copy, as resp may be shared with an IdempotencyStore
+            resp = dict(resp)
+            resp["timing"] = format_timings(context.timings)
+        return resp
+
+    def _stream_recorder(self, context, stream, resp, start):
+        """
+        Returns a callback that records a request whose result is a ResultStream once the
+        stream has been read, including the time spent reading it as the 'stream' phase
+        """
+        stream_start = perf_timer()
+
+        def record():
+            self._phase(context, "stream", stream_start)
+            e = stream.error
+            final = resp
+            if isinstance(e, RpcException):
+                final = err_response(resp["id"], e.code, e.msg, e.data)
+            elif e is not None:
+                final = err_response(resp["id"], ERR_UNKNOWN, str(e))
+            self._record(context, final, start)
+        return record
+
+    def _phase(self, context, name, start):
+        """
+        Records the time since start as phase name of the request, and as a child span of
+        the request's span if it is traced
+        """
+        end = perf_timer()
+        context.timings[name] = end - start
+        if context.span is not None:
+            context.span.add_phase(name, start, end)
+
+    def _record(self, context, resp, start):
+        """
+        Records a completed request in the server's metrics, slow request log and tracer,
+        if enabled
+        """
+        span = context.span
+        if span is not None:
+            if "error" in resp:
+                span.set_attribute("rpc.error_code", resp["error"]["code"])
+            span.set_attribute("rpc.cached", context.cached)
+            span.finish()
+        if self.metrics is None and self.slow_log is None and not self.timing:
+            return
+        context.timings["total"] = perf_timer() - start
+        name = self._metric_name(context.request)
+        if self.metrics is not None:
+            code = None
+            if "error" in resp:
+                code = resp["error"]["code"]
+            self.metrics.record_request(name, code, context.timings)
+        if self.slow_log is not None:
+            self.slow_log.record(name, context, resp)
+
+    def _execute(self, context, reqid, raw):
+        """
+        Runs _call() for the context and formats its result or error as a JSON-RPC response
+        """
+        try:
+            result = self._call(context)
+            if raw and context.result_json is not None:
+                result = RawJson(context.result_json, result)
+            return { "jsonrpc": "2.0", "id": reqid, "result": result }
+        except RpcException as e:
+            return err_response(reqid, e.code, e.msg, e.data)
+        except Exception as e:
+            self.log.exception("Error processing request: %s" % str(context.request))
+            return err_response(reqid, ERR_UNKNOWN, "Server error. Check logs for details.",
+                                data={
+                                    'exception': str(e)
+                                })
+
+    def _call(self, context):
+        """
+        Executes a single request against a handler.  If the req.method == 'barrister-idl', the
+        Contract IDL JSON structure is returned.  Otherwise the method is resolved to a handler
+        based on the interface name, and the appropriate function is called on the handler.
+
+        :Parameter:
+          req
+            A dict representing a valid JSON-RPC 2.0 request.  'method' must be provided.
+        """
+        req = context.request
+        if "method" not in req:
+            raise RpcException(ERR_INVALID_REQ, "Invalid Request. No 'method'.")
+
+        method = req["method"]
+        check_deadline(context)
+
+        if method == "barrister-idl":
+            return self.contract.idl_parsed
+        elif method == "barrister-stats" and self.stats_enabled:
+            options = None
+            params = req.get("params")
+            if params and isinstance(params, list) and isinstance(params[0], dict):
+                options = params[0]
+            return self.stats(options)
+
+        iface_name, func_name = unpack_method(method)
+
+        if iface_name in self.handlers:
+            iface_impl = self.handlers[iface_name]
+            func = getattr(iface_impl, func_name)
+            if func:
+                if "params" in req:
+                    params = req["params"]
+                else:
+                    params = []
+
+                if self.validate_req:
+                    start = perf_timer()
+                    self.contract.validate_request(iface_name, func_name, params)
+                    self._phase(context, "validate_request", start)
+
+                if hasattr(iface_impl, "barrister_pre"):
+                    pre_hook = getattr(iface_impl, "barrister_pre")
+                    pre_hook(context, params)
+
+                key = None
+                cache = self.result_cache
+                ttl = None
+                if cache is not None:
+                    ttl = cache.ttl_for(method)
+                    if ttl is not None:
+                        key = request_key(method, params)
+                        found, entry, stale = cache.get(key)
+                        if found:
+                            context.cached = True
+                            if cache.serialize:
+                                context.result_json = entry[1]
+                                return entry[0]
+                            return entry
+
+                profiler = self.profiler
+
+                bulkheads = self.bulkheads
+
+                flight = self.single_flight
+                shared = flight is not None and flight.applies(method)
+                function = self.contract.interface(iface_name).functions.get(func_name)
+                returns = function and function.returns
+                is_array = returns is not None and returns.is_array
+                # iterators are streamed, unless the result is cached or shared
+                streamable = is_array and ttl is None and not shared
+                validate = None
+                if self.validate_resp and function is not None:
+                    validate = function.validate_response_element
+
+                def execute():
+                    # validation and queuing behind a single flight take time too
+                    check_deadline(context)
+                    held = None
+                    if bulkheads is not None:
+                        held = bulkheads.acquire(method, context.remaining())
+                    try:
+                        start = perf_timer()
+                        with Deadline(at=context.deadline):
+                            if profiler is not None and profiler.should_profile(method):
+                                result = profiler.run(method, func, params)
+                            elif params:
+                                result = func(*params)
+                            else:
+                                result = func()
+                        self._phase(context, "handler", start)
+                        if streamable and is_iterator_result(result):
+                            result = ResultStream(result, validate, context)
+                            if held:
+                                # bulkhead slots are held until the stream has been read
+                                result.on_close(lambda held=held: bulkheads.release(held))
+                                held = None
+                            return result
+                    finally:
+                        if held:
+                            bulkheads.release(held)
+
+                    if is_array and is_iterator_result(result):
+                        result = list(ResultStream(result, validate, context))
+                    elif self.validate_resp:
+                        start = perf_timer()
+                        self.contract.validate_response(iface_name, func_name, result)
+                        self._phase(context, "validate_response", start)
+
+                    if ttl is not None:
+                        cache.put(key, result, ttl)
+                    return result
+
+                if shared:
+                    if key is None:
+                        key = request_key(method, params)
+                    return flight.do(key, execute)
+                return execute()
+            else:
+                msg = "Method '%s' not found" % (method)
+                raise RpcException(ERR_METHOD_NOT_FOUND, msg)
+        else:
+            msg = "No implementation of '%s' found" % (iface_name)
+            raise RpcException(ERR_METHOD_NOT_FOUND, msg)
+
+
+class TwistedServer(object):
+    """
+    Dispatches requests to user created handler classes based on method name.
+    Also responsible for validating requests and responses to ensure they conform to the
+    IDL Contract.
+    """
+
+    def __init__(self, contract, validate_request=True, validate_response=True):
+        """
+        Creates a new Server
+
+        :Parameters:
+          contract
+            Contract instance that this server should use
+          validate_request
+            If True, requests will be validated against the Contract and rejected if they are malformed
+          validate_response
+            If True, responses from handler methods will be validated against the Contract and rejected
+            if they are malformed
+        """
+        logging.basicConfig()
+        self.log = logging.getLogger("barrister")
+        self.validate_req = validate_request
+        self.validate_resp = validate_response
+        self.contract = contract
+        self.handlers = {}
+        self.filters = None
+        self.single_flight = None
+        self.tracer = None
+        self.bulkheads = None
+        self.timing = False
+
+    def add_handler(self, iface_name, handler):
+        """
+        Associates the given handler with the interface name.  If the interface does not exist in
+        the Contract, an RpcException is raised.
+
+        :Parameters:
+          iface_name
+            Name of interface that this handler implements
+          handler
+            Instance of a class that implements all functions defined on the interface
+        """
+        if self.contract.has_interface(iface_name):
+            self.handlers[iface_name] = handler
+        else:
+            raise RpcException(ERR_INVALID_REQ, "Unknown interface: '%s'", iface_name)
+
+    def set_filters(self, filters):
+        """
+        Sets the filters for the server.
+
+        :Parameters:
+          filters
+            List of filters to set on this server, or None to remove all filters.
+            Elements in list should subclass Filter
+        """
+        if filters == None or isinstance(filters, (tuple, list)):
+            self.filters = filters
+        else:
+            self.filters = [ filters ]
+
+    def set_single_flight(self, single_flight):
+        """
+        Sets the SingleFlight used to collapse concurrent identical requests into a single
+        handler execution.
+
+        :Parameters:
+          single_flight
+            SingleFlight instance, or None to execute every request
+        """
+        self.single_flight = single_flight
+
+    def call_json(self, req_json, props=None):
+        """
+        Deserializes req_json as JSON, invokes self.call(), and serializes result to JSON.
+        Returns JSON encoded string.
+
+        :Parameters:
+          req_json
+            JSON-RPC request serialized as JSON string
+          props
+            Application defined properties to set on RequestContext for use with filters.
+            For example: authentication headers.  Must be a dict.
+        """
+        start = perf_timer()
+        try:
+            req = json.loads(req_json)
+        except:
+            msg = "Unable to parse JSON: %s" % req_json
+            return defer.fail(json.dumps(err_response(None, -32700, msg)))
+        decoded = perf_timer()
+
+        def encode(resp):
+            if not self.timing:
+                return json.dumps(resp)
+            timing = { "decode": decoded - start }
+            received = (props or { }).get("received_at")
+            if received is not None:
+                timing["queue"] = start - received
+            timing = format_timings(timing)
+            if isinstance(resp, dict) and "timing" in resp:
+                resp["timing"].update(timing)
+                timing = resp["timing"]
+            encode_start = perf_timer()
+            resp_json = json.dumps(resp)
+            if props is not None:
+                timing = dict(timing)
+                timing["encode"] = round((perf_timer() - encode_start) * 1000.0, 3)
+                timing["total"] = round((perf_timer() - start) * 1000.0, 3)
+                props["server_timing"] = timing
+            return resp_json
+
+        d = self.call(req, props)
+        # a cancelled call fails with CancelledError, and is not encoded
+        d.addCallback(encode)
+        return d
+
+    def set_timing(self, enabled):
+        """
+        Enables or disables returning a per-request phase breakdown to callers, as
+        Server.set_timing() does.  Each response carries a `timing` member mapping phase
+        to milliseconds: filters, validate_request, handler, validate_response and total.
+        The handler phase lasts until the handler's Deferred fires.  call_json() adds
+        decode, and queue if the transport set a `received_at` property, and stores the
+        breakdown, including encode, in the `server_timing` property so
+        TwistedHttpResource can send it as a Server-Timing header.
+
+        :Parameters:
+          enabled
+            If True, timings are added to responses
+        """
+        self.timing = enabled
+
+    def set_tracer(self, tracer):
+        """
+        Sets the Tracer used to record a span for each request, with child spans for
+        filters, request validation and handler execution.  Batch requests get a batch
+        span with a child span per request.
+
+        :Parameters:
+          tracer
+            Tracer instance, or None to disable tracing
+        """
+        self.tracer = tracer
+
+    def set_bulkheads(self, bulkheads):
+        """
+        Sets the Bulkheads that limit how many calls to each interface or function may
+        be in progress at once.  Pass a clock to Bulkheads to enforce its queue_timeout.
+
+        :Parameters:
+          bulkheads
+            Bulkheads instance, or None for no limits
+        """
+        self.bulkheads = bulkheads
+
+    def call(self, req, props=None):
+        """
+        Executes a Barrister request and returns a response.  If the request is a list, then the
+        response will also be a list.  If the request is an empty list, a RpcException is raised.
+
+        :Parameters:
+          req
+            The request. Either a list of dicts, or a single dict.
+          props
+            Application defined properties to set on RequestContext for use with filters.
+            For example: authentication headers.  Must be a dict.
+        """
+
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Request: %s" % str(req))
+
+        if isinstance(req, list):
+            if len(req) < 1:
+                d = defer.fail(err_response(None, ERR_INVALID_REQ, "Invalid Request. Empty batch."))
+            else:
+                span = None
+                if self.tracer is not None:
+                    parent = parse_traceparent((props or { }).get("traceparent"))
+                    if parent is None and isinstance(req[0], dict):
+                        parent = parse_traceparent(safe_get(req[0], "traceparent"))
+                    span = self.tracer.start_span("barrister.batch", parent)
+
+                # run the batch call collecting the responses
+                d = defer.DeferredList([defer.maybeDeferred(self._call_and_format, r, props,
+                                                            span)
+                                        for r in req], consumeErrors=True)
+                d.addCallback(self._collect_batch)
+                if span is not None:
+                    def finish_batch(results):
+                        span.finish()
+                        return results
+                    d.addCallback(finish_batch)
+        else:
+            d = defer.maybeDeferred(self._call_and_format, req, props)
+
+        def log_response(response):
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug("Response: %s" % str(response))
+            return response
+
+        d.addBoth(log_response)
+        return d
+
+    def _collect_batch(self, results):
+        """
+        Returns the responses of a batch from the results of its DeferredList, or the
+        failure of the first request that failed, which only happens if the batch was
+        cancelled
+        """
+        for ok, r in results:
+            if not ok:
+                return r
+        return [r for ok, r in results]
+
+    def call_json_streaming(self, req_json, send, props=None):
+        """
+        Deserializes req_json as JSON and executes it like call_json(), but instead of
+        waiting for the whole batch to complete, each response is serialized and passed
+        to `send` as soon as its request completes.  Responses may therefore be sent in
+        a different order than the requests in the batch.  Clients correlate them using
+        the JSON-RPC request id.  Returns a deferred that fires once every response has
+        been sent.
+
+        This is the server side counterpart of WebsocketTransport in coalesce mode.
+
+        :Parameters:
+          req_json
+            JSON-RPC request serialized as JSON string
+          send
+            Callable invoked with each JSON encoded response string
+          props
+            Application defined properties to set on RequestContext for use with filters.
+            For example: authentication headers.  Must be a dict.
+        """
+        try:
+            req = json.loads(req_json)
+        except:
+            msg = "Unable to parse JSON: %s" % req_json
+            send(json.dumps(err_response(None, ERR_PARSE, msg)))
+            return defer.succeed(None)
+
+        if not isinstance(req, list):
+            req = [ req ]
+        elif len(req) < 1:
+            send(json.dumps(err_response(None, ERR_INVALID_REQ, "Invalid Request. Empty batch.")))
+            return defer.succeed(None)
+
+        def send_response(response):
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug("Response: %s" % str(response))
+            send(json.dumps(response))
+
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Request: %s" % str(req))
+
+        def unexpected_error(failure, r):
+            if failure.check(defer.CancelledError):
+                return failure
+            self.log.error("Error processing request: %s\n%s" % (str(r), failure.getTraceback()))
+            reqid = safe_get(r, "id") if isinstance(r, dict) else None
+            return err_response(reqid, ERR_UNKNOWN, "Server error. Check logs for details.",
+                                data={'exception': str(failure.value)})
+
+        ds = [ ]
+        for r in req:
+            d = defer.maybeDeferred(self._call_and_format, r, props)
+            d.addErrback(unexpected_error, r)
+            d.addCallback(send_response)
+            ds.append(d)
+        d = defer.DeferredList(ds, consumeErrors=True)
+        d.addCallback(lambda results: None)
+        return d
+
+    def _call_and_format(self, req, props=None, parent_span=None):
+        """
+        Invokes a single request against a handler using _call() and traps any errors,
+        formatting them using _err().  If the request is successful it is wrapped in a
+        JSON-RPC 2.0 compliant dict with keys: 'jsonrpc', 'id', 'result'.
+
+        :Parameters:
+          req
+            A single dict representing a single JSON-RPC request
+          props
+            Application defined properties to set on RequestContext for use with filters.
+            For example: authentication headers.  Must be a dict.
+          parent_span
+            Span the request's span is a child of.  If None, the trace is continued from
+            the request's traceparent, if any.
+        """
+        start = perf_timer()
+        if not isinstance(req, dict):
+            return err_response(None, ERR_INVALID_REQ,
+                                "Invalid Request. %s is not an object." % str(req))
+
+        reqid = None
+        if "id" in req:
+            reqid = req["id"]
+
+        if props is None:
+            props = {}
+        context = RequestContext(props, req)
+
+        span = None
+        if self.tracer is not None:
+            parent = parent_span or self.tracer.extract(context)
+            span = self.tracer.start_span(str(safe_get(req, "method", "unknown")), parent,
+                                          attributes={ "rpc.id": reqid })
+            context.span = span
+
+        if self.filters:
+            filter_start = perf_timer()
+            for f in self.filters:
+                f.pre(context)
+            self._phase(context, "filters", filter_start)
+
+        if context.error:
+            if span is not None:
+                span.set_attribute("rpc.error_code", context.error["error"]["code"])
+                span.finish()
+            return context.error
+
+        d = self._call(context)
+
+        def makeResponse(result):
+            return { "jsonrpc": "2.0", "id": reqid, "result": result }
+
+        def handleRpcException(failure):
+            failure.trap(RpcException)
+            e = failure.value
+            return err_response(reqid, e.code, e.msg, e.data)
+
+        d.addCallbacks(makeResponse, handleRpcException)
+
+        def handleUnexpectedExceptions(failure):
+            if failure.check(defer.CancelledError):
+                # the caller went away, so there is no one to send a response to
+                return failure
+            failure.trap(Exception)
+            self.log.exception("Error processing request: %s" % str(req))
+            return err_response(reqid, ERR_UNKNOWN,
+                                "Server error. Check logs for details.",
+                                data={'exception': str(failure.value)})
+
+        d.addErrback(handleUnexpectedExceptions)
+
+        if self.filters:
+            def postHook(hook, result):
+                context.response = result
+                hook(context)
+                return result
+
+            for f in self.filters:
+                d.addCallback(lambda r: postHook(f.post, r))
+
+        if self.timing:
+            def add_timing(resp):
+                context.timings["total"] = perf_timer() - start
+                # copy, as resp may be shared with other callers by SingleFlight
+                resp = dict(resp)
+                resp["timing"] = format_timings(context.timings)
+                return resp
+            d.addCallback(add_timing)
+
+        if span is not None:
+            def finish_span(resp):
+                if isinstance(resp, twisted_failure.Failure):
+                    span.set_attribute("cancelled", True)
+                elif "error" in resp:
+                    span.set_attribute("rpc.error_code", resp["error"]["code"])
+                span.finish()
+                return resp
+            d.addBoth(finish_span)
+
+        return d
+
+    def _phase(self, context, name, start):
+        """
+        Records the time since start as phase name of the request, and as a child span of
+        the request's span if it is traced
+        """
+        end = perf_timer()
+        context.timings[name] = end - start
+        if context.span is not None:
+            context.span.add_phase(name, start, end)
+
+    def _call(self, context):
+        """
+        Executes a single request against a handler.  If the req.method == 'barrister-idl', the
+        Contract IDL JSON structure is returned.  Otherwise the method is resolved to a handler
+        based on the interface name, and the appropriate function is called on the handler.
+
+        :Parameter:
+          req
+            A dict representing a valid JSON-RPC 2.0 request.  'method' must be provided.
+        """
+        req = context.request
+        if "method" not in req:
+            return defer.fail(RpcException(ERR_INVALID_REQ, "Invalid Request. No 'method'."))
+
+        method = req["method"]
+        try:
+            check_deadline(context)
+        except RpcException as e:
+            return defer.fail(e)
+
+        if method == "barrister-idl":
+            return defer.succeed(self.contract.idl_parsed)
+
+        iface_name, func_name = unpack_method(method)
+
+        if iface_name in self.handlers:
+            iface_impl = self.handlers[iface_name]
+            func = getattr(iface_impl, func_name)
+            if func:
+                if "params" in req:
+                    params = req["params"]
+                else:
+                    params = []
+
+                if self.validate_req:
+                    start = perf_timer()
+                    try:
+                        self.contract.validate_request(iface_name, func_name, params)
+                    except Exception as e:
+                        return defer.fail(e)
+                    self._phase(context, "validate_request", start)
+
+                if hasattr(iface_impl, "barrister_pre"):
+                    pre_hook = getattr(iface_impl, "barrister_pre")
+                    pre_hook(context, params)
+
+                bulkheads = self.bulkheads
+
+                def execute():
+                    try:
+                        check_deadline(context)
+                    except RpcException as e:
+                        return defer.fail(e)
+                    if bulkheads is None:
+                        return run()
+
+                    def run_held(held):
+                        d = defer.maybeDeferred(run)
+
+                        def release(result):
+                            bulkheads.release(held)
+                            return result
+                        d.addBoth(release)
+                        return d
+
+                    d = bulkheads.acquire_deferred(method)
+                    d.addCallback(run_held)
+                    return d
+
+                def run():
+                    start = perf_timer()
+                    if params:
+                        d = func(*params)
+                    else:
+                        d = func()
+
+                    def handler_done(result):
+                        self._phase(context, "handler", start)
+                        return result
+                    d.addBoth(handler_done)
+
+                    if self.validate_resp:
+                        def validate_response(result):
+                            validate_start = perf_timer()
+                            self.contract.validate_response(iface_name, func_name, result)
+                            self._phase(context, "validate_response", validate_start)
+                            return result
+                        d.addCallback(validate_response)
+                    return d
+
+                flight = self.single_flight
+                if flight is not None and flight.applies(method):
+                    return flight.do_deferred(request_key(method, params), execute)
+                return execute()
+            else:
+                msg = "Method '%s' not found" % (method)
+                return defer.fail(RpcException(ERR_METHOD_NOT_FOUND, msg))
+        else:
+            msg = "No implementation of '%s' found" % (iface_name)
+            return defer.fail(RpcException(ERR_METHOD_NOT_FOUND, msg))
+
+
+class IdempotencyStore(object):
+    """
+    Remembers the responses of requests that carry an idempotency key so that a retried
+    request gets the stored response back instead of executing the handler again.  Used
+    by Server (see Server.set_idempotency_store).
+
+    The key is read from the request's `idempotency_key` member, or from the
+    `idempotency_key` property passed to Server.call (where a HTTP adapter would put
+    e.g. an Idempotency-Key header).  Stored responses are scoped to the method and
+    params of the request, so a key sent with a batch applies to each entry separately.
+
+    A duplicate that arrives while the original is still executing waits for it, for at
+    most wait_timeout seconds, after which it gets an ERR_IN_PROGRESS error and may retry.
+
+    Responses with a ERR_UNKNOWN, ERR_INTERNAL or ERR_DEADLINE_EXCEEDED error are not
+    stored, so requests that failed because of a server fault or overload can be retried.
+    Entries expire after ttl seconds and the oldest entries are evicted once maxsize is
+    reached.
+    """
+
+    transient_errors = (ERR_UNKNOWN, ERR_INTERNAL, ERR_DEADLINE_EXCEEDED)
+
+    def __init__(self, maxsize=10000, ttl=3600, wait_timeout=30.0, prop_name="idempotency_key",
+                 field_name="idempotency_key"):
+        """
+        Creates a new IdempotencyStore
+
+        :Parameters:
+          maxsize
+            Maximum number of responses kept
+          ttl
+            Number of seconds a response is kept
+          wait_timeout
+            Seconds a duplicate waits for the original request to complete
+          prop_name
+            Name of the RequestContext property holding the key
+          field_name
+            Name of the request member holding the key
+        """
+        self.wait_timeout = wait_timeout
+        self.prop_name = prop_name
+        self.field_name = field_name
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.replays = 0
+        self.lock = threading.Lock()
+
+    def stats(self):
+        """
+        Returns a dict with keys: 'size', 'replays'
+        """
+        with self.lock:
+            return { "size": len(self.entries), "replays": self.replays }
+
+    def key_for(self, context):
+        """
+        Returns the key responses for the request are stored under, or None if the request
+        has no idempotency key.
+        """
+        req = context.request
+        ikey = safe_get(req, self.field_name)
+        if ikey is None:
+            ikey = context.get_prop(self.prop_name)
+        if ikey is None:
+            return None
+        return "%s/%s" % (ikey, request_key(safe_get(req, "method"), safe_get(req, "params", [])))
+
+    def execute(self, key, reqid, func):
+        """
+        Returns the stored response for key with its id set to reqid.  If no response is
+        stored, calls func() to produce it, and stores it.
+
+        :Parameters:
+          key
+            Key returned by key_for()
+          reqid
+            JSON-RPC id of the request being served
+          func
+            Callable that executes the request and returns its response dict
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = _Flight()
+                self.entries[key] = entry
+                leader = True
+            else:
+                self.replays += 1
+                leader = False
+
+        if not leader:
+            if not entry.event.wait(self.wait_timeout):
+                return err_response(reqid, ERR_IN_PROGRESS,
+                                    "A request with this idempotency key is in progress")
+            return dict(entry.result, id=reqid)
+
+        resp = None
+        try:
+            resp = func()
+        finally:
+            if resp is None or self._is_transient(resp):
+                with self.lock:
+                    self.entries.pop(key, None)
+            entry.result = resp
+            entry.event.set()
+        return resp
+
+    def _is_transient(self, resp):
+        if "error" in resp:
+            return resp["error"]["code"] in self.transient_errors
+        return False
+
+class SingleFlight(object):
+    """
+    Collapses concurrent identical requests to expensive functions into one handler
+    execution.  While a call with a given method and params is in progress, further calls
+    with the same method and params wait for it and receive the same result (or error)
+    instead of invoking the handler again.  Each caller still gets a response with its
+    own JSON-RPC id.
+
+    Only enable this for functions without side effects, since the collapsed calls are
+    never executed.  Results are shared between callers and must not be modified.
+
+    Works with Server (blocking callers wait on the executing thread) and with
+    TwistedServer (callers get a Deferred chained to the executing one).
+    """
+
+    def __init__(self, functions):
+        """
+        Creates a new SingleFlight
+
+        :Parameters:
+          functions
+            List of "Interface.function" names whose concurrent calls may be collapsed
+        """
+        self.functions = frozenset(functions)
+        self.flights = { }
+        self.deferreds = { }
+        self.executed = 0
+        self.coalesced = 0
+        self.lock = threading.Lock()
+
+    def applies(self, method):
+        """
+        Returns True if calls to method may be collapsed
+        """
+        return method in self.functions
+
+    def do(self, key, func):
+        """
+        Returns func() if no call for key is in progress.  Otherwise waits for the call in
+        progress and returns its result, or raises its exception.
+
+        :Parameters:
+          key
+            Identifies the call, see request_key
+          func
+            Callable that executes the call
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = _Flight()
+                self.flights[key] = flight
+                self.executed += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = func()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.event.set()
+        return flight.result
+
+    def do_deferred(self, key, func):
+        """
+        Twisted version of do().  func must return a Deferred (or a plain value).  Returns
+        a Deferred for the result of the call for key, executing func only if no call for
+        key is in progress.  Must be called from the reactor thread.
+        """
+        flight = self.deferreds.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            return self._wait(flight)
+
+        self.executed += 1
+        flight = _Flight()
+        flight.waiters = [ ]
+        self.deferreds[key] = flight
+        d = self._wait(flight)
+
+        def done(result):
+            del self.deferreds[key]
+            for w in flight.waiters:
+                w.callback(result)
+
+        flight.deferred = defer.maybeDeferred(func)
+        flight.deferred.addBoth(done)
+        return d
+
+    def _wait(self, flight):
+        """
+        Returns a Deferred that fires with the result of the flight.  Cancelling it only
+        cancels the shared call once every caller waiting for it has cancelled.
+        """
+        def cancel(d):
+            flight.waiters.remove(d)
+            if not flight.waiters and flight.deferred is not None:
+                flight.deferred.cancel()
+
+        d = defer.Deferred(cancel)
+        flight.waiters.append(d)
+        return d
+
+    def stats(self):
+        """
+        Returns a dict with keys: 'executed', 'coalesced'
+        """
+        return { "executed": self.executed, "coalesced": self.coalesced }
+
+class _Flight(object):
+    """
+    Internal class used by SingleFlight to share the outcome of a call in progress
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = None
+        self.deferred = None
+
+class HttpTransport(object):
+    """
+    A client transport that uses urllib2 to make requests against a HTTP server.
+    """
+
+    def __init__(self, url, handlers=None, headers=None):
+        """
+        Creates a new HttpTransport
+
+        :Parameters:
+          url
+            URL of the server endpoint
+          handlers
+            Optional list of handlers to pass to urllib2.build_opener()
+          headers
+            Optional list of HTTP headers to set on requests.  Note that Content-Type will always be set
+            automatically to "application/json"
+        """
+        if not headers:
+            headers = { }
+        headers['Content-Type'] = 'application/json'
+        self.url = url
+        self.headers = headers
+        if handlers:
+            self.opener = urllib.build_opener(*handlers)
+        else:
+            self.opener = urllib.build_opener()
+
+    def request(self, req):
+        """
+        Makes a request against the server and returns the deserialized result.
+
+        :Parameters:
+          req
+            List or dict representing a JSON-RPC formatted request
+        """
+        data = json.dumps(req)
+        req = urllib.Request(self.url, data, self.headers)
+        f = self.opener.open(req)
+        resp = f.read()
+        f.close()
+        if not resp:
+            # the server does not answer notifications
+            return None
+        return json.loads(resp)
+
+class PooledHttpTransport(object):
+    """
+    A thread-safe client transport that makes requests against a HTTP server using a
+    pool of keep-alive connections.  Each request borrows an idle connection from the
+    pool (or opens a new one if none is idle) and returns it when the response has
+    been read, so one instance can be shared by all threads of an application.
+
+    A request that fails on a reused connection is retried once on a new connection
+    if the server closed it without responding, or if the request carries an
+    `idempotency_key`.  Other failures are raised, as the server may have processed
+    the request.
+    """
+
+    thread_safe = True
+
+    def __init__(self, url, headers=None, pool_size=10, timeout=None):
+        """
+        Creates a new PooledHttpTransport
+
+        :Parameters:
+          url
+            URL of the server endpoint.  http and https URLs are supported.
+          headers
+            Optional dict of HTTP headers to set on requests.  Content-Type is always
+            set to "application/json"
+          pool_size
+            Maximum number of idle connections kept open.  More connections are opened
+            if more threads make requests concurrently, but only this many are reused.
+          timeout
+            Optional socket timeout in seconds
+        """
+        if not headers:
+            headers = { }
+        headers['Content-Type'] = 'application/json'
+        parsed = six.moves.urllib.parse.urlsplit(url)
+        if parsed.scheme == "https":
+            self.conn_class = http_client.HTTPSConnection
+        else:
+            self.conn_class = http_client.HTTPConnection
+        self.url = url
+        self.host = parsed.netloc
+        self.path = parsed.path or "/"
+        if parsed.query:
+            self.path += "?" + parsed.query
+        self.headers = headers
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.pool = queue.LifoQueue()
+
+    def request(self, req):
+        """
+        Makes a request against the server and returns the deserialized result.
+
+        :Parameters:
+          req
+            List or dict representing a JSON-RPC formatted request
+        """
+        data = json.dumps(req).encode("utf8")
+        conn, reused = self._get()
+        try:
+            status, body = self._post(conn, data)
+        except (http_client.HTTPException, socket.error) as e:
+            conn.close()
+            if not reused or not self._can_retry(req, e):
+                raise
+            # the server closed an idle keep-alive connection.  retry once on a new
+            # connection
+            conn = self._new()
+            try:
+                status, body = self._post(conn, data)
+            except:
+                conn.close()
+                raise
+        except:
+            conn.close()
+            raise
+        self._put(conn)
+
+        if status == 204:
+            return None
+        if status != 200:
+            raise IOError("HTTP error %d from %s" % (status, self.url))
+        return json.loads(body.decode("utf8"))
+
+    def request_stream(self, req):
+        """
+        Makes a request against the server and returns an iterator over the response
+        dicts, yielded as the server sends them.  The server is asked to stream its
+        responses as NDJSON (see HttpRequestHandler).  If it replies with a single JSON
+        document instead, its responses are yielded once it has been read.
+
+        :Parameters:
+          req
+            List or dict representing a JSON-RPC formatted request
+        """
+        conn, resp = self._start(req, NDJSON_CONTENT_TYPE)
+        return self._iter_responses(resp, self._iter_lines(conn, resp))
+
+    def request_lines(self, req):
+        """
+        Makes a request against the server and returns an iterator over the lines of the
+        response body, read as the server sends them.  Used by Client.call_stream() to
+        consume results the server streams (see Server.call_json_chunks).
+
+        :Parameters:
+          req
+            List or dict representing a JSON-RPC formatted request
+        """
+        conn, resp = self._start(req)
+        return self._iter_lines(conn, resp)
+
+    def _start(self, req, accept=None):
+        """
+        Sends req and returns the connection and its response, whose body has not been
+        read yet
+        """
+        data = json.dumps(req).encode("utf8")
+        headers = self.headers
+        if accept:
+            headers = dict(headers)
+            headers["Accept"] = accept
+        conn, reused = self._get()
+        try:
+            resp = self._open(conn, data, headers)
+        except (http_client.HTTPException, socket.error) as e:
+            conn.close()
+            if not reused or not self._can_retry(req, e):
+                raise
+            conn = self._new()
+            try:
+                resp = self._open(conn, data, headers)
+            except:
+                conn.close()
+                raise
+        except:
+            conn.close()
+            raise
+
+        if resp.status not in (200, 204):
+            conn.close()
+            raise IOError("HTTP error %d from %s" % (resp.status, self.url))
+        return conn, resp
+
+    def _open(self, conn, data, headers):
+        conn.request("POST", self.path, data, headers)
+        return conn.getresponse()
+
+    def _can_retry(self, req, e):
+        """
+        Returns True if req, which failed with e on a reused connection, may be sent again
+        on a new connection.  That is only safe if the server cannot have processed it:
+        it closed the connection without sending any of the response, as servers do with
+        idle keep-alive connections.  Requests that all carry an `idempotency_key` (see
+        IdempotencyStore) may always be sent again.
+        """
+        if isinstance(e, http_client.BadStatusLine) and e.line in ("", "''"):
+            return True
+        reqs = req if isinstance(req, list) else [ req ]
+        return all([ isinstance(r, dict) and "idempotency_key" in r for r in reqs ])
+
+    def _iter_lines(self, conn, resp):
+        try:
+            while True:
+                line = resp.readline()
+                if not line:
+                    break
+                yield line.decode("utf8")
+        except:
+            # includes the caller abandoning the iterator: the rest of the response is
+            # still on the connection, so it cannot be reused
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            self._put(conn)
+
+    def _iter_responses(self, resp, lines):
+        try:
+            if (resp.getheader("Content-Type") or "").startswith(NDJSON_CONTENT_TYPE):
+                for line in lines:
+                    line = line.strip()
+                    if line:
+                        yield json.loads(line)
+            else:
+                body = "".join(lines)
+                if body:
+                    result = json.loads(body)
+                    if not isinstance(result, list):
+                        result = [ result ]
+                    for r in result:
+                        yield r
+        finally:
+            lines.close()
+
+    def close(self):
+        """
+        Closes all idle connections in the pool
+        """
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def _post(self, conn, data):
+        conn.request("POST", self.path, data, self.headers)
+        resp = conn.getresponse()
+        body = resp.read()
+        if resp.will_close:
+            conn.close()
+        return resp.status, body
+
+    def _new(self):
+        if self.timeout is None:
+            return self.conn_class(self.host)
+        return self.conn_class(self.host, timeout=self.timeout)
+
+    def _get(self):
+        try:
+            return self.pool.get_nowait(), True
+        except queue.Empty:
+            return self._new(), False
+
+    def _put(self, conn):
+        if conn.sock is not None and self.pool.qsize() < self.pool_size:
+            self.pool.put(conn)
+        else:
+            conn.close()
+
+class LockedTransport(object):
+    """
+    Wraps a transport that is not safe to share between threads so that only one
+    request is made through it at a time.  Used by Client when thread_safe=True is
+    given with such a transport.
+    """
+
+    thread_safe = True
+
+    def __init__(self, transport):
+        """
+        Creates a new LockedTransport
+
+        :Parameters:
+          transport
+            Transport to serialize access to
+        """
+        self.transport = transport
+        self.lock = threading.Lock()
+
+    def request(self, req):
+        """
+        Makes a request through the wrapped transport while holding the lock.
+
+        :Parameters:
+          req
+            List or dict representing a JSON-RPC formatted request
+        """
+        with self.lock:
+            return self.transport.request(req)
+
+class Endpoint(object):
+    """
+    Health and load state that LoadBalancedTransport keeps for one server endpoint.
+    Has the following properties:
+
+    * `name` - URL or description of the endpoint
+    * `transport` - Transport used to reach the endpoint
+    * `outstanding` - Number of requests currently in flight
+    * `ejected_until` - Time (as returned by time.time()) until which the endpoint receives
+      no traffic, or 0 if it is in rotation
+    * `ejections` - Number of consecutive times the endpoint has been ejected
+    """
+
+    def __init__(self, name, transport, window_size):
+        self.name = name
+        self.transport = transport
+        self.outstanding = 0
+        self.outcomes = collections.deque(maxlen=window_size)
+        self.consecutive_failures = 0
+        self.ejected_until = 0
+        self.ejections = 0
+
+    def error_rate(self):
+        """
+        Returns the fraction of failed requests among the most recent requests
+        """
+        if not self.outcomes:
+            return 0.0
+        return float(self.outcomes.count(False)) / len(self.outcomes)
+
+class HedgingPolicy(object):
+    """
+    Configures hedged requests for a LoadBalancedTransport.  When a call to one of the
+    configured functions has not completed after the given latency percentile of its
+    recent calls, a duplicate request is sent to a different endpoint and whichever
+    response arrives first is used.  The slower response is ignored.
+
+    Only functions that are safe to execute twice (reads, or idempotent writes) should
+    be hedged.
+
+    Hedges are limited by a budget: every eligible call earns `budget` hedge tokens and
+    every hedge spends one, so at most that fraction of calls are duplicated.
+    """
+
+    def __init__(self, functions, percentile=95, min_samples=20, window_size=200,
+                 budget=0.05, max_tokens=10.0):
+        """
+        Creates a new HedgingPolicy
+
+        :Parameters:
+          functions
+            List of JSON-RPC method names ("Interface.function") that are safe to hedge
+          percentile
+            Latency percentile (0 - 100) of recent calls after which a hedge is sent
+          min_samples
+            Number of completed calls needed for a function before it is hedged
+          window_size
+            Number of recent call latencies kept per function
+          budget
+            Fraction of calls (0.0 - 1.0) that may be hedged
+          max_tokens
+            Maximum number of unspent hedge tokens that can accumulate
+        """
+        self.functions = frozenset(functions)
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window_size = window_size
+        self.budget = budget
+        self.max_tokens = max_tokens
+        self.tokens = 0.0
+        self.hedges = 0
+        self.latencies = { }
+        self.counts = { }
+        self.delays = { }
+        self.lock = threading.Lock()
+
+    def applies(self, req):
+        """
+        Returns True if the request may be hedged
+        """
+        return isinstance(req, dict) and safe_get(req, "method") in self.functions
+
+    def delay(self, method):
+        """
+        Returns the number of seconds to wait before hedging a call to method, or None
+        if not enough calls have been observed yet.  Also earns hedge budget for the call.
+        """
+        with self.lock:
+            self.tokens = min(self.tokens + self.budget, self.max_tokens)
+            return self.delays.get(method)
+
+    def acquire(self):
+        """
+        Spends one hedge token.  Returns False if the budget is exhausted.
+        """
+        with self.lock:
+            if self.tokens < 1.0:
+                return False
+            self.tokens -= 1.0
+            self.hedges += 1
+            return True
+
+    def record(self, method, elapsed):
+        """
+        Records the latency in seconds of a successful request to method
+        """
+        with self.lock:
+            window = self.latencies.get(method)
+            if window is None:
+                window = collections.deque(maxlen=self.window_size)
+                self.latencies[method] = window
+            window.append(elapsed)
+            count = self.counts.get(method, 0) + 1
+            self.counts[method] = count
+            # sorting the window on every call is wasteful. refresh every 10 samples
+            if len(window) >= self.min_samples and (count % 10 == 0 or method not in self.delays):
+                ordered = sorted(window)
+                pos = int(round((len(ordered) - 1) * self.percentile / 100.0))
+                self.delays[method] = ordered[pos]
+
+class LoadBalancedTransport(object):
+    """
+    A thread-safe client transport that balances requests across several endpoints
+    serving the same IDL.  Endpoints that fail are ejected from rotation and re-admitted
+    after an exponentially growing backoff.
+
+    Supported balancing policies:
+
+    * `round_robin` - endpoints are used in turn
+    * `least_outstanding` - the endpoint with the fewest requests in flight is used
+    * `power_of_two` - two random endpoints are picked and the one with fewer requests
+      in flight is used
+
+    A request fails an endpoint when the endpoint's transport raises an exception other
+    than RpcException.  JSON-RPC error responses are application errors and do not count.
+
+    An endpoint is ejected after `max_failures` consecutive failures, or once its error
+    rate over the last `window_size` requests exceeds `max_error_rate` (evaluated after at
+    least `min_requests` requests).  When its backoff has elapsed it is re-admitted.  If
+    health checks are enabled with `health_check_interval`, re-admission additionally
+    requires a successful `barrister-idl` probe.  A re-admitted endpoint that fails again
+    before succeeding is ejected for twice as long.
+
+    If every endpoint is ejected, requests are spread over all of them rather than failing
+    outright.
+
+    Tail latency can be reduced further by passing a HedgingPolicy.
+
+    For example:
+
+    ::
+
+      transport = barrister.LoadBalancedTransport([ "http://10.0.0.1:8080/orders",
+                                                    "http://10.0.0.2:8080/orders" ],
+                                                  policy="least_outstanding")
+      client = barrister.Client(transport, thread_safe=True)
+
+    """
+
+    thread_safe = True
+
+    policies = ("round_robin", "least_outstanding", "power_of_two")
+
+    def __init__(self, endpoints, policy="round_robin", transport_factory=PooledHttpTransport,
+                 max_failures=5, max_error_rate=0.5, min_requests=20, window_size=100,
+                 base_ejection_time=5.0, max_ejection_time=300.0, health_check_interval=None,
+                 hedging=None, hedge_workers=8):
+        """
+        Creates a new LoadBalancedTransport
+
+        :Parameters:
+          endpoints
+            List of endpoints.  Each element is either a URL string, which is passed to
+            transport_factory, or a transport instance.  Transports should be thread-safe.
+          policy
+            Balancing policy name.  One of: round_robin, least_outstanding, power_of_two
+          transport_factory
+            Callable that creates a transport for an endpoint URL
+          max_failures
+            Consecutive failures after which an endpoint is ejected
+          max_error_rate
+            Error rate (0.0 - 1.0) over recent requests above which an endpoint is ejected
+          min_requests
+            Minimum number of recent requests before max_error_rate is evaluated
+          window_size
+            Number of recent requests error rates are computed over
+          base_ejection_time
+            Seconds an endpoint is ejected for the first time.  Doubles on each subsequent
+            ejection, up to max_ejection_time
+          max_ejection_time
+            Upper bound in seconds for the ejection backoff
+          health_check_interval
+            If set, a background thread probes ejected endpoints with a `barrister-idl`
+            request every health_check_interval seconds once their backoff has elapsed, and
+            only re-admits them when the probe succeeds
+          hedging
+            Optional HedgingPolicy.  If set, slow calls to the functions it names are
+            duplicated to a second endpoint.
+          hedge_workers
+            Number of threads that run the attempts of hedged calls.  While every thread
+            is busy, calls are made on the calling thread without hedging, and slow calls
+            are not duplicated.
+        """
+        if policy not in self.policies:
+            raise ValueError("Unknown load balancing policy: %s" % policy)
+        if not endpoints:
+            raise ValueError("At least one endpoint is required")
+
+        logging.basicConfig()
+        self.log = logging.getLogger("barrister")
+        self.policy = policy
+        self.max_failures = max_failures
+        self.max_error_rate = max_error_rate
+        self.min_requests = min_requests
+        self.base_ejection_time = base_ejection_time
+        self.max_ejection_time = max_ejection_time
+        self.health_check_interval = health_check_interval
+        self.hedging = hedging
+        self.endpoints = [ ]
+        for e in endpoints:
+            if isinstance(e, six.string_types):
+                self.endpoints.append(Endpoint(e, transport_factory(e), window_size))
+            else:
+                self.endpoints.append(Endpoint(str(e), e, window_size))
+        self.lock = threading.Lock()
+        self.rr_counter = itertools.count()
+        self.stopped = threading.Event()
+        self.hedge_pool = None
+        if hedging is not None:
+            self.hedge_pool = WorkerPool(hedge_workers, name="barrister-hedge")
+            self.hedge_slots = threading.Semaphore(hedge_workers)
+
+        if health_check_interval:
+            t = threading.Thread(target=self._health_check_loop, name="barrister-health-check")
+            t.daemon = True
+            t.start()
+
+    def request(self, req):
+        """
+        Makes a request against one of the endpoints and returns the deserialized result.
+
+        :Parameters:
+          req
+            List or dict representing a JSON-RPC formatted request
+        """
+        if self.hedging and self.hedging.applies(req):
+            return self._hedged_request(req)
+        return self.request_endpoint(self.select(), req)
+
+    def select(self, exclude=None):
+        """
+        Chooses the endpoint for the next request according to the balancing policy.
+
+        :Parameters:
+          exclude
+            Optional Endpoint that should not be chosen if any other endpoint is available
+        """
+        now = time.time()
+        with self.lock:
+            healthy = [ e for e in self.endpoints if self._available(e, now) and e is not exclude ]
+            if not healthy:
+                # panic mode: every endpoint is ejected. spread the load over all of them
+                healthy = [ e for e in self.endpoints if e is not exclude ] or self.endpoints
+
+            if self.policy == "round_robin":
+                return healthy[next(self.rr_counter) % len(healthy)]
+            elif self.policy == "least_outstanding":
+                start = next(self.rr_counter) % len(healthy)
+                rotated = healthy[start:] + healthy[:start]
+                return min(rotated, key=lambda e: e.outstanding)
+            else:
+                if len(healthy) == 1:
+                    return healthy[0]
+                a, b = random.sample(healthy, 2)
+                return a if a.outstanding <= b.outstanding else b
+
+    def request_endpoint(self, endpoint, req):
+        """
+        Makes a request against the given endpoint and records the outcome in the
+        endpoint's health state.
+
+        :Parameters:
+          endpoint
+            Endpoint instance from this transport's `endpoints` list
+          req
+            List or dict representing a JSON-RPC formatted request
+        """
+        with self.lock:
+            endpoint.outstanding += 1
+        try:
+            resp = endpoint.transport.request(req)
+        except RpcException:
+            with self.lock:
+                endpoint.outstanding -= 1
+            raise
+        except Exception:
+            with self.lock:
+                endpoint.outstanding -= 1
+                self._record(endpoint, False)
+            raise
+        with self.lock:
+            endpoint.outstanding -= 1
+            self._record(endpoint, True)
+        return resp
+
+    def check_health(self):
+        """
+        Probes every ejected endpoint whose backoff has elapsed with a `barrister-idl`
+        request.  Endpoints that answer are re-admitted.  Others are ejected again with a
+        longer backoff.  Called periodically when health_check_interval is set, but may
+        also be called directly.
+        """
+        now = time.time()
+        with self.lock:
+            due = [ e for e in self.endpoints if e.ejected_until and e.ejected_until <= now ]
+        for e in due:
+            ok = self.probe(e)
+            with self.lock:
+                if ok:
+                    self.log.info("Endpoint %s passed health check, re-admitting" % e.name)
+                    e.ejected_until = 0
+                    e.consecutive_failures = 0
+                else:
+                    self._eject(e)
+
+    def probe(self, endpoint):
+        """
+        Returns True if the endpoint answers a `barrister-idl` request successfully
+
+        :Parameters:
+          endpoint
+            Endpoint to probe
+        """
+        req = { "jsonrpc": "2.0", "method": "barrister-idl", "id": "health-check" }
+        try:
+            resp = endpoint.transport.request(req)
+            return isinstance(resp, dict) and "result" in resp
+        except Exception:
+            return False
+
+    def endpoint_stats(self):
+        """
+        Returns a list with one dict per endpoint containing keys: 'name', 'healthy',
+        'outstanding', 'error_rate', 'ejections'
+        """
+        now = time.time()
+        with self.lock:
+            return [ { "name": e.name, "healthy": self._available(e, now),
+                       "outstanding": e.outstanding, "error_rate": e.error_rate(),
+                       "ejections": e.ejections } for e in self.endpoints ]
+
+    def close(self):
+        """
+        Stops the health check thread and the hedged call threads, if running
+        """
+        self.stopped.set()
+        if self.hedge_pool is not None:
+            self.hedge_pool.shutdown(wait=False)
+
+    def _hedged_request(self, req):
+        method = req["method"]
+        policy = self.hedging
+        delay = policy.delay(method)
+        primary = self.select()
+
+        # with not enough samples yet to know what slow looks like, or no thread free to
+        # make the call on, the call is made here without hedging
+        if delay is None or not self.hedge_slots.acquire(False):
+            start = time.time()
+            resp = self.request_endpoint(primary, req)
+            policy.record(method, time.time() - start)
+            return resp
+
+        results = queue.Queue()
+
+        def attempt(endpoint):
+            start = time.time()
+            try:
+                resp = self.request_endpoint(endpoint, req)
+            except Exception as e:
+                results.put((False, e))
+            else:
+                policy.record(method, time.time() - start)
+                results.put((True, resp))
+
+        self.hedge_pool.submit(self._run_attempt, attempt, primary)
+        attempts = 1
+        try:
+            ok, value = results.get(timeout=delay)
+        except queue.Empty:
+            if len(self.endpoints) > 1 and self.hedge_slots.acquire(False):
+                if policy.acquire():
+                    if self.log.isEnabledFor(logging.DEBUG):
+                        self.log.debug("Hedging request %s after %.4fs" % (req["id"], delay))
+                    self.hedge_pool.submit(self._run_attempt, attempt,
+                                           self.select(exclude=primary))
+                    attempts += 1
+                else:
+                    self.hedge_slots.release()
+            ok, value = results.get()
+
+        # the first attempt to finish failed. use the other one if there is one
+        if not ok and attempts > 1:
+            ok, value = results.get()
+        if not ok:
+            raise value
+        return value
+
+    def _run_attempt(self, attempt, endpoint):
+        try:
+            attempt(endpoint)
+        finally:
+            self.hedge_slots.release()
+
+    def _available(self, endpoint, now):
+        if not endpoint.ejected_until:
+            return True
+        if self.health_check_interval:
+            # wait for check_health() to re-admit the endpoint
+            return False
+        return endpoint.ejected_until <= now
+
+    def _record(self, endpoint, ok):
+        endpoint.outcomes.append(ok)
+        if ok:
+            endpoint.consecutive_failures = 0
+            if endpoint.ejected_until and endpoint.ejected_until <= time.time():
+                endpoint.ejected_until = 0
+            if not endpoint.ejected_until:
+                endpoint.ejections = 0
+            return
+
+        endpoint.consecutive_failures += 1
+        if endpoint.ejected_until:
+            # failed while on probation after re-admission, or a straggler that was
+            # sent before the endpoint was ejected
+            if endpoint.ejected_until <= time.time():
+                self._eject(endpoint)
+        elif endpoint.consecutive_failures >= self.max_failures or \
+             (len(endpoint.outcomes) >= self.min_requests and
+              endpoint.error_rate() > self.max_error_rate):
+            self._eject(endpoint)
+
+    def _eject(self, endpoint):
+        backoff = min(self.base_ejection_time * (2 ** endpoint.ejections), self.max_ejection_time)
+        self.log.warning("Ejecting endpoint %s for %.1f seconds" % (endpoint.name, backoff))
+        endpoint.ejected_until = time.time() + backoff
+        endpoint.ejections += 1
+        endpoint.consecutive_failures = 0
+        endpoint.outcomes.clear()
+
+    def _health_check_loop(self):
+        while not self.stopped.wait(self.health_check_interval):
+            try:
+                self.check_health()
+            except Exception:
+                self.log.exception("Error running endpoint health checks")
+
+class CircuitBreaker(object):
+    """
+    Tracks the outcome of calls to a dependency and stops calls to it while it is failing.
+
+    The breaker starts `closed` and lets every call through.  It trips `open` after
+    `failure_threshold` consecutive failures, or once the failure rate over the last
+    `window_size` calls exceeds `error_rate` (evaluated after at least `min_requests`
+    calls).  Calls that take longer than `slow_call_threshold` seconds count as failures.
+    While open, calls are refused.  After `reset_timeout` seconds the breaker goes
+    `half_open` and lets up to `half_open_max_calls` probe calls through: if they all
+    succeed it closes again, if any fails it re-opens.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, error_rate=0.5, min_requests=20, window_size=100,
+                 slow_call_threshold=None, reset_timeout=30.0, half_open_max_calls=1):
+        """
+        Creates a new CircuitBreaker in the closed state
+
+        :Parameters:
+          failure_threshold
+            Consecutive failures that trip the breaker
+          error_rate
+            Failure rate (0.0 - 1.0) over recent calls that trips the breaker
+          min_requests
+            Minimum number of recent calls before error_rate is evaluated
+          window_size
+            Number of recent calls the failure rate is computed over
+          slow_call_threshold
+            Optional number of seconds after which a successful call counts as a failure
+          reset_timeout
+            Seconds the breaker stays open before letting probe calls through
+          half_open_max_calls
+            Number of probe calls that must succeed before the breaker closes
+        """
+        self.failure_threshold = failure_threshold
+        self.error_rate = error_rate
+        self.min_requests = min_requests
+        self.slow_call_threshold = slow_call_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.state = self.CLOSED
+        self.outcomes = collections.deque(maxlen=window_size)
+        self.consecutive_failures = 0
+        self.opened_at = 0
+        self.probes = 0
+        self.probe_successes = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Returns True if a call may be made now.  Every allowed call must be followed by
+        exactly one call to record() or release().
+        """
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.time() - self.opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self.probes = 0
+                self.probe_successes = 0
+            if self.state == self.HALF_OPEN:
+                if self.probes >= self.half_open_max_calls:
+                    self.rejected += 1
+                    return False
+                self.probes += 1
+            return True
+
+    def release(self):
+        """
+        Gives back a call allowed by allow() that was not made, or whose outcome says
+        nothing about the health of the dependency.
+        """
+        with self.lock:
+            if self.state == self.HALF_OPEN and self.probes > 0:
+                self.probes -= 1
+
+    def record(self, ok, elapsed=None):
+        """
+        Records the outcome of a call allowed by allow()
+
+        :Parameters:
+          ok
+            True if the call succeeded
+          elapsed
+            Optional duration of the call in seconds, compared to slow_call_threshold
+        """
+        if ok and elapsed is not None and self.slow_call_threshold is not None:
+            ok = elapsed <= self.slow_call_threshold
+
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                if not ok:
+                    self._open()
+                else:
+                    self.probe_successes += 1
+                    if self.probe_successes >= self.half_open_max_calls:
+                        self.state = self.CLOSED
+                        self.consecutive_failures = 0
+                        self.outcomes.clear()
+                return
+            elif self.state == self.OPEN:
+                return
+
+            self.outcomes.append(ok)
+            if ok:
+                self.consecutive_failures = 0
+                return
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.failure_threshold:
+                self._open()
+            elif len(self.outcomes) >= self.min_requests:
+                rate = float(self.outcomes.count(False)) / len(self.outcomes)
+                if rate > self.error_rate:
+                    self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = time.time()
+        self.consecutive_failures = 0
+        self.outcomes.clear()
+
+class CircuitBreakerTransport(object):
+    """
+    Wraps a Client or TwistedClient transport with circuit breakers.  One breaker tracks
+    the endpoint as a whole and, if per_function is True, another tracks each
+    "Interface.function" called through it.  While a breaker is open, requests fail
+    immediately with a RpcException using code ERR_CIRCUIT_OPEN instead of waiting on
+    the dependency.
+
+    The endpoint breaker counts exceptions raised by the wrapped transport as failures.
+    Function breakers additionally count responses with a ERR_UNKNOWN or ERR_INTERNAL
+    error, which indicate a server side fault rather than a bad request.  Breakers with a
+    slow_call_threshold also count slow calls.  Batch requests are only tracked by the
+    endpoint breaker.
+
+    To get a breaker per endpoint when load balancing, wrap each endpoint's transport:
+
+    ::
+
+      transport = barrister.LoadBalancedTransport(
+          [ barrister.CircuitBreakerTransport(barrister.PooledHttpTransport(url))
+            for url in urls ])
+
+    """
+
+    server_errors = (ERR_UNKNOWN, ERR_INTERNAL)
+
+    def __init__(self, transport, breaker_factory=CircuitBreaker, per_function=True):
+        """
+        Creates a new CircuitBreakerTransport
+
+        :Parameters:
+          transport
+            Transport to wrap.  Its request() may return the response or a Deferred for it.
+          breaker_factory
+            Callable returning a new CircuitBreaker.  Use it to configure thresholds,
+            e.g. functools.partial(barrister.CircuitBreaker, reset_timeout=5.0)
+          per_function
+            If True, track each function with its own breaker as well
+        """
+        self.transport = transport
+        self.thread_safe = getattr(transport, "thread_safe", False)
+        self.breaker_factory = breaker_factory
+        self.per_function = per_function
+        self.endpoint_breaker = breaker_factory()
+        self.function_breakers = { }
+        self.lock = threading.Lock()
+
+    def breaker(self, method):
+        """
+        Returns the CircuitBreaker for the given "Interface.function" method, creating it if needed
+        """
+        with self.lock:
+            b = self.function_breakers.get(method)
+            if b is None:
+                b = self.breaker_factory()
+                self.function_breakers[method] = b
+            return b
+
+    def request(self, req):
+        """
+        Makes a request through the wrapped transport unless a breaker is open.
+
+        :Parameters:
+          req
+            List or dict representing a JSON-RPC formatted request
+        """
+        method = None
+        func_breaker = None
+        if self.per_function and isinstance(req, dict):
+            method = safe_get(req, "method")
+            if method and method != "barrister-idl":
+                func_breaker = self.breaker(method)
+
+        # raising is also correct for Twisted transports: TwistedClient turns exceptions
+        # raised by request() into a failed Deferred
+        if not self.endpoint_breaker.allow():
+            raise RpcException(ERR_CIRCUIT_OPEN, "Circuit breaker open for endpoint")
+        if func_breaker and not func_breaker.allow():
+            self.endpoint_breaker.release()
+            raise RpcException(ERR_CIRCUIT_OPEN, "Circuit breaker open for: %s" % method)
+
+        start = time.time()
+
+        def success(resp):
+            elapsed = time.time() - start
+            self.endpoint_breaker.record(True, elapsed)
+            if func_breaker:
+                func_breaker.record(not self._is_server_error(resp), elapsed)
+            return resp
+
+        def failure(e):
+            if isinstance(e, RpcException):
+                self.endpoint_breaker.release()
+                if func_breaker:
+                    func_breaker.release()
+            else:
+                self.endpoint_breaker.record(False)
+                if func_breaker:
+                    func_breaker.record(False)
+
+        try:
+            resp = self.transport.request(req)
+        except Exception as e:
+            failure(e)
+            raise
+
+        if isinstance(resp, defer.Deferred):
+            def errback(f):
+                failure(f.value)
+                return f
+            resp.addCallbacks(success, errback)
+            return resp
+        return success(resp)
+
+    def stats(self):
+        """
+        Returns a dict mapping "endpoint" and each tracked method name to its breaker state
+        """
+        with self.lock:
+            states = dict([ (k, b.state) for k, b in self.function_breakers.items() ])
+        states["endpoint"] = self.endpoint_breaker.state
+        return states
+
+    def _is_server_error(self, resp):
+        if isinstance(resp, dict) and "error" in resp:
+            return safe_get(resp["error"], "code") in self.server_errors
+        return False
+
+def send_frame(sock, data):
+    """
+    Writes data to the socket prefixed with its length as a 4 byte big-endian
+    unsigned int.  Header and payload are written with a single sendall() call.
+
+    :Parameters:
+      sock
+        Connected socket to write to
+      data
+        Bytes to send
+    """
+    sock.sendall(struct.pack("!I", len(data)) + data)
+
+def recv_frame(rfile, max_size=MAX_FRAME_SIZE):
+    """
+    Reads a single length-prefixed frame (see send_frame) from a buffered file object
+    created with socket.makefile('rb').  Returns the payload bytes, or None if the peer
+    closed the connection between frames.
+
+    :Parameters:
+      rfile
+        Buffered binary file object wrapping the socket
+      max_size
+        Frames announcing a larger payload raise an IOError without being read
+    """
+    header = rfile.read(4)
+    if not header:
+        return None
+    if len(header) < 4:
+        raise IOError("Connection closed while reading frame header")
+    size = struct.unpack("!I", header)[0]
+    if size > max_size:
+        raise IOError("Frame of %d bytes exceeds limit of %d bytes" % (size, max_size))
+    data = rfile.read(size)
+    if len(data) < size:
+        raise IOError("Connection closed while reading frame")
+    return data
+
+class UnixSocketTransport(object):
+    """
+    A client transport that sends length-prefixed JSON frames over a Unix domain socket
+    to a UnixSocketServer.  A single connection is opened lazily and reused for all
+    requests, which avoids the TCP and HTTP overhead of HttpTransport for servers
+    running on the same host.
+
+    Requests made from several threads are serialized on the connection.
+    """
+
+    thread_safe = True
+
+    def __init__(self, path, timeout=None):
+        """
+        Creates a new UnixSocketTransport
+
+        :Parameters:
+          path
+            Filesystem path of the server's Unix domain socket
+          timeout
+            Optional socket timeout in seconds
+        """
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+        self.rfile = None
+        self.lock = threading.Lock()
+
+    def request(self, req):
+        """
+        Makes a request against the server and returns the deserialized result.
+
+        :Parameters:
+          req
+            List or dict representing a JSON-RPC formatted request
+        """
+        data = json.dumps(req).encode("utf8")
+        with self.lock:
+            try:
+                if self.sock is None:
+                    self._connect()
+                send_frame(self.sock, data)
+                resp = recv_frame(self.rfile)
+                if resp is None:
+                    raise IOError("Connection closed by server: %s" % self.path)
+            except:
+                self._close()
+                raise
+        if not resp:
+            return None
+        return json.loads(resp.decode("utf8"))
+
+    def close(self):
+        """
+        Closes the connection to the server.  It is reopened by the next request.
+        """
+        with self.lock:
+            self._close()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        self.sock = sock
+        self.rfile = sock.makefile("rb")
+
+    def _close(self):
+        if self.sock is not None:
+            self.rfile.close()
+            self.sock.close()
+        self.sock = None
+        self.rfile = None
+
+class UnixHTTPConnection(http_client.HTTPConnection):
+    """
+    HTTPConnection that connects to a Unix domain socket instead of a TCP host.
+    """
+
+    def __init__(self, path, timeout=None):
+        http_client.HTTPConnection.__init__(self, "localhost")
+        self.unix_path = path
+        self.unix_timeout = timeout
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.unix_timeout is not None:
+            sock.settimeout(self.unix_timeout)
+        sock.connect(self.unix_path)
+        self.sock = sock
+
+class UnixHttpTransport(object):
+    """
+    A client transport that speaks HTTP over a Unix domain socket.  Use this with a
+    UnixSocketServer created with http=True, or with any HTTP server listening on a
+    Unix domain socket (e.g. behind a local proxy).  The HTTP connection is kept alive
+    between requests.  Requests made from several threads are serialized on the
+    connection.
+    """
+
+    thread_safe = True
+
+    def __init__(self, path, url_path="/", headers=None, timeout=None):
+        """
+        Creates a new UnixHttpTransport
+
+        :Parameters:
+          path
+            Filesystem path of the server's Unix domain socket
+          url_path
+            Path portion of the URL to POST requests to
+          headers
+            Optional dict of HTTP headers to set on requests.  Content-Type is always
+            set to "application/json"
+          timeout
+            Optional socket timeout in seconds
+        """
+        if not headers:
+            headers = { }
+        headers['Content-Type'] = 'application/json'
+        self.path = path
+        self.url_path = url_path
+        self.headers = headers
+        self.timeout = timeout
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def request(self, req):
+        """
+        Makes a request against the server and returns the deserialized result.
+
+        :Parameters:
+          req
+            List or dict representing a JSON-RPC formatted request
+        """
+        data = json.dumps(req).encode("utf8")
+        with self.lock:
+            if self.conn is None:
+                self.conn = UnixHTTPConnection(self.path, self.timeout)
+            try:
+                self.conn.request("POST", self.url_path, data, self.headers)
+                resp = self.conn.getresponse()
+                body = resp.read()
+            except:
+                self.conn.close()
+                self.conn = None
+                raise
+        if resp.status == 204:
+            return None
+        if resp.status != 200:
+            raise IOError("HTTP error %d from %s" % (resp.status, self.path))
+        return json.loads(body.decode("utf8"))
+
+class TcpTransport(object):
+    """
+    A client transport that multiplexes requests over one persistent TCP connection
+    using length-prefixed JSON frames (see send_frame).  Many threads may have requests
+    in flight at the same time.  A background thread reads responses, which the server
+    may send in any order, and matches them to the waiting callers by JSON-RPC id.
+    Batch requests are matched by the first non-null id among their entries.
+
+    Request ids must therefore be unique among in-flight requests, which the default
+    Client id generator (idgen_uuid) guarantees.
+
+    Servers without a NotificationExecutor answer notifications with a null id.  While
+    notifications sent on the connection may still be answered, responses with a null
+    id are taken to be those answers and discarded.  Otherwise a response with a null
+    id, which the server sends when it cannot read a request, is given to the only
+    request in flight.  If several are in flight it cannot be matched, so they all fail
+    with an IOError rather than wait for a response that will never come.  Responses
+    with any other id that is not in flight are logged and discarded.
+    """
+
+    thread_safe = True
+
+    def __init__(self, host, port, timeout=60.0):
+        """
+        Creates a new TcpTransport.  The connection is opened by the first request and
+        reopened automatically after it is lost.
+
+        :Parameters:
+          host
+            Server host name or address
+          port
+            Server port
+          timeout
+            Number of seconds to wait for each response, or None to wait forever.  If
+            exceeded, an IOError is raised and the late response is discarded.
+        """
+        logging.basicConfig()
+        self.log = logging.getLogger("barrister")
+        self.address = (host, port)
+        self.timeout = timeout
+        self.sock = None
+        self.pending = { }
+        # notifications sent on the connection that the server may still answer
+        self.notifications = 0
+        # ids of requests that timed out, whose late responses are expected
+        self.abandoned = TTLCache(maxsize=1000, ttl=600)
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+
+    def request(self, req):
+        """
+        Makes a request against the server and returns the deserialized result.
+
+        :Parameters:
+          req
+            List or dict representing a JSON-RPC formatted request
+        """
+        data = json.dumps(req).encode("utf8")
+        if is_notification(req):
+            self._send_notification(data)
+            return None
+
+        key = self._key(req)
+        slot = _ResponseSlot()
+
+        with self.lock:
+            if key in self.pending:
+                raise RpcException(ERR_INVALID_REQ, "Request id already in flight: %s" % key)
+            if self.sock is None:
+                self._connect()
+            sock = self.sock
+            self.pending[key] = slot
+
+        try:
+            with self.write_lock:
+                send_frame(sock, data)
+        except:
+            self._remove(key)
+            self._disconnect(sock)
+            raise
+
+        if not slot.event.wait(self.timeout):
+            with self.lock:
+                self.pending.pop(key, None)
+                self.abandoned[key] = True
+            raise IOError("Timed out waiting for response to request: %s" % key)
+        if slot.error:
+            raise slot.error
+        return slot.response
+
+    def close(self):
+        """
+        Closes the connection to the server.  Requests still in flight fail with an IOError.
+        """
+        with self.lock:
+            sock = self.sock
+        if sock is not None:
+            self._disconnect(sock)
+
+    def _send_notification(self, data):
+        """
+        Sends a notification.  Servers without a NotificationExecutor answer it, and
+        _deliver() discards the answer.
+        """
+        with self.lock:
+            if self.sock is None:
+                self._connect()
+            sock = self.sock
+            self.notifications += 1
+        try:
+            with self.write_lock:
+                send_frame(sock, data)
+        except:
+            self._disconnect(sock)
+            raise
+
+    def _key(self, msg):
+        if isinstance(msg, list):
+            # notifications in a batch are answered with a null id, if at all, so use
+            # the first non-null id of the batch or of its response
+            for m in msg:
+                if isinstance(m, dict) and safe_get(m, "id") is not None:
+                    return m["id"]
+            return None
+        if isinstance(msg, dict):
+            return safe_get(msg, "id")
+        return None
+
+    def _remove(self, key):
+        with self.lock:
+            return self.pending.pop(key, None)
+
+    def _connect(self):
+        sock = socket.create_connection(self.address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        self.notifications = 0
+        t = threading.Thread(target=self._read_loop, args=(sock,))
+        t.daemon = True
+        t.start()
+
+    def _disconnect(self, sock, error=None):
+        with self.lock:
+            if self.sock is not sock:
+                return
+            self.sock = None
+            pending = self.pending
+            self.pending = { }
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        sock.close()
+        if error is None:
+            error = IOError("Connection to %s:%d closed" % self.address)
+        for slot in pending.values():
+            slot.fail(error)
+
+    def _read_loop(self, sock):
+        rfile = sock.makefile("rb")
+        error = None
+        try:
+            while True:
+                data = recv_frame(rfile)
+                if data is None:
+                    break
+                resp = json.loads(data.decode("utf8"))
+                self._deliver(resp)
+        except Exception as e:
+            error = e
+        finally:
+            rfile.close()
+        self._disconnect(sock, error)
+
+    def _deliver(self, resp):
+        key = self._key(resp)
+        unmatched = [ ]
+        with self.lock:
+            slot = self.pending.pop(key, None)
+            if slot is not None or key is not None:
+                pass
+            elif self.notifications:
+                # the answer to a notification
+                self.notifications -= 1
+                return
+            elif len(self.pending) == 1:
+                # only one request could have caused it
+                slot = self.pending.pop(list(self.pending.keys())[0])
+            else:
+                unmatched = list(self.pending.values())
+                self.pending = { }
+            late = key is not None and self.abandoned.pop(key, None)
+        if slot:
+            slot.succeed(resp)
+        elif unmatched:
+            self.log.error("Response for unknown request, failing %d requests in flight: %s"
+                           % (len(unmatched), str(resp)))
+            error = IOError("Unable to match response to request: %s" % str(resp))
+            for slot in unmatched:
+                slot.fail(error)
+        elif key is not None and not late:
+            self.log.warning("Discarding response for unknown request: %s" % str(resp))
+        elif self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Discarding late response: %s" % str(resp))
+
+class _ResponseSlot(object):
+    """
+    Internal class used by TcpTransport to hand a response from the reader thread to
+    the thread that made the request.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+        self.error = None
+
+    def succeed(self, response):
+        self.response = response
+        self.event.set()
+
+    def fail(self, error):
+        self.error = error
+        self.event.set()
+
+class WorkerPool(object):
+    """
+    Fixed size pool of daemon threads that run submitted callables in FIFO order.
+    """
+
+    def __init__(self, num_workers, name="barrister-worker"):
+        """
+        Creates a new WorkerPool and starts its threads
+
+        :Parameters:
+          num_workers
+            Number of threads in the pool
+          name
+            Name prefix for the pool's threads
+        """
+        self.log = logging.getLogger("barrister")
+        self.queue = queue.Queue()
+        self.threads = [ ]
+        for i in range(num_workers):
+            t = threading.Thread(target=self._run, name="%s-%d" % (name, i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, func, *args):
+        """
+        Queues func(*args) to be run by the next free worker thread
+        """
+        self.queue.put((func, args))
+
+    def shutdown(self, wait=True):
+        """
+        Stops the worker threads once the already queued work has been run.
+
+        :Parameters:
+          wait
+            If True, block until all worker threads have exited
+        """
+        for t in self.threads:
+            self.queue.put(None)
+        if wait:
+            for t in self.threads:
+                t.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            func, args = item
+            try:
+                func(*args)
+            except Exception:
+                self.log.exception("Error in worker thread")
+
+class NotificationExecutor(object):
+    """
+    Runs JSON-RPC notifications for a Server on a fixed size pool of daemon threads (see
+    Server.set_notification_executor), so the caller does not wait for them and their
+    latency is kept off the request path.
+
+    Queued notifications are bounded by max_queue.  When the queue is full the
+    overflow policy decides what happens to a new notification:
+
+    - `drop` - the new notification is discarded
+    - `drop_oldest` - the notification that has waited longest is discarded to make room
+    - `caller_runs` - the new notification runs on the calling thread, which slows the
+      connection it arrived on down to the rate the workers keep up with
+    """
+
+    def __init__(self, num_workers=2, max_queue=1000, overflow="drop",
+                 name="barrister-notify"):
+        """
+        Creates a new NotificationExecutor and starts its threads
+
+        :Parameters:
+          num_workers
+            Number of threads running notifications
+          max_queue
+            Maximum number of notifications waiting for a thread
+          overflow
+            Policy applied when the queue is full: 'drop', 'drop_oldest' or 'caller_runs'
+          name
+            Name prefix for the executor's threads
+        """
+        if overflow not in ("drop", "drop_oldest", "caller_runs"):
+            raise ValueError("Unknown overflow policy: %s" % overflow)
+        self.log = logging.getLogger("barrister")
+        self.overflow = overflow
+        self.queue = queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.executed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.delay = Histogram(LATENCY_BUCKETS)
+        self.threads = [ ]
+        for i in range(num_workers):
+            t = threading.Thread(target=self._run, name="%s-%d" % (name, i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, name, func):
+        """
+        Queues func() to be run by the next free worker thread.  Returns False if it was
+        dropped because the queue is full.
+
+        :Parameters:
+          name
+            Name of the notification, used in log messages
+          func
+            Callable to run.  Exceptions it raises are logged and counted as failures.
+        """
+        with self.lock:
+            self.submitted += 1
+        item = (name, func, perf_timer())
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+
+        if self.overflow == "caller_runs":
+            self._execute(item)
+            return True
+        if self.overflow == "drop_oldest":
+            try:
+                oldest = self.queue.get_nowait()
+                self._drop(oldest[0])
+                self.queue.put_nowait(item)
+                return True
+            except (queue.Empty, queue.Full):
+                pass
+        self._drop(name)
+        return False
+
+    def shutdown(self, wait=True):
+        """
+        Stops the worker threads once the already queued notifications have been run.
+
+        :Parameters:
+          wait
+            If True, block until all worker threads have exited
+        """
+        for t in self.threads:
+            self.queue.put(None)
+        if wait:
+            for t in self.threads:
+                t.join()
+
+    def stats(self):
+        """
+        Returns a dict with keys: 'submitted', 'executed', 'dropped', 'failed', 'queued',
+        and 'queue_delay_p50' and 'queue_delay_p99' in seconds (None until a notification
+        has run)
+        """
+        with self.lock:
+            return { "submitted": self.submitted, "executed": self.executed,
+                     "dropped": self.dropped, "failed": self.failed,
+                     "queued": self.queue.qsize(),
+                     "queue_delay_p50": self.delay.percentile(50),
+                     "queue_delay_p99": self.delay.percentile(99) }
+
+    def _drop(self, name):
+        with self.lock:
+            self.dropped += 1
+        self.log.warning("Notification queue full. Dropped: %s" % name)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self._execute(item)
+
+    def _execute(self, item):
+        name, func, queued_at = item
+        delay = perf_timer() - queued_at
+        try:
+            func()
+            failed = 0
+        except Exception:
+            failed = 1
+            self.log.exception("Error running notification: %s" % name)
+        with self.lock:
+            self.executed += 1
+            self.failed += failed
+            self.delay.observe(delay)
+
+class FramedRequestHandler(socketserver.StreamRequestHandler):
+    """
+    socketserver request handler that reads length-prefixed JSON-RPC frames from a
+    connection and writes back one response frame per request frame, using the
+    Server instance stored on the socketserver's `rpc_server` attribute.
+    """
+
+    def handle(self):
+        server = self.server
+        while True:
+            data = recv_frame(self.rfile, server.max_frame_size)
+            if data is None:
+                break
+            # notifications are acknowledged with an empty frame, to keep the client in step
+            resp = server.rpc_server.call_json(data.decode("utf8"))
+            send_frame(self.connection, resp.encode("utf8"))
+
+class MultiplexedRequestHandler(socketserver.StreamRequestHandler):
+    """
+    socketserver request handler used by TcpServer.  Request frames are read as fast as
+    they arrive and executed on the socketserver's WorkerPool, so a slow request does
+    not hold up the ones behind it.  Each response frame is written as soon as its
+    request completes, which means responses may be sent out of order.
+    """
+
+    def handle(self):
+        server = self.server
+        write_lock = threading.Lock()
+        in_flight = threading.Semaphore(server.max_in_flight)
+
+        def process(data, received_at):
+            try:
+                props = { "received_at": received_at }
+                resp = server.rpc_server.call_json(data.decode("utf8"), props).encode("utf8")
+                if resp:
+                    with write_lock:
+                        send_frame(self.connection, resp)
+            except socket.error:
+                pass
+            finally:
+                in_flight.release()
+
+        try:
+            while True:
+                data = recv_frame(self.rfile, server.max_frame_size)
+                if data is None:
+                    break
+                in_flight.acquire()
+                server.workers.submit(process, data, perf_timer())
+        finally:
+            # let in flight requests finish before the connection is closed
+            for i in range(server.max_in_flight):
+                in_flight.acquire()
+
+class _LimitedReader(object):
+    """
+    Internal file-like object that reads at most length bytes from a file
+    """
+
+    def __init__(self, f, length):
+        self.f = f
+        self.remaining = length
+
+    def read(self, size):
+        data = self.f.read(min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+class HttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Minimal HTTP/1.1 request handler that passes POST bodies to the Server instance
+    stored on the socketserver's `rpc_server` attribute.  Connections are kept alive.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def parse_request(self):
+        # the request line has arrived.  Time spent reading the headers and body counts
+        # towards the request's queueing delay and deadline
+        self.received_at = perf_timer()
+        return BaseHTTPServer.BaseHTTPRequestHandler.parse_request(self)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if NDJSON_CONTENT_TYPE in (self.headers.get("Accept") or ""):
+            self._post_streaming(_LimitedReader(self.rfile, length))
+            return
+        body = self.rfile.read(length)
+        props = self._props()
+        chunks = self.server.rpc_server.call_json_chunks(body.decode("utf8"), props)
+        if not isinstance(chunks, list):
+            self._write_chunked("application/json", chunks)
+            return
+        resp = "".join(chunks).encode("utf8")
+        if not resp:
+            # notifications get no response body
+            self.send_response(204)
+            self.end_headers()
+            return
+        self.send_response(200)
+        if "server_timing" in props:
+            self.send_header("Server-Timing", server_timing_header(props["server_timing"]))
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(resp)))
+        self.end_headers()
+        self.wfile.write(resp)
+
+    def _props(self):
+        props = { "received_at": self.received_at }
+        traceparent = self.headers.get("traceparent")
+        if traceparent:
+            props["traceparent"] = traceparent
+        return props
+
+    def _post_streaming(self, body):
+        """
+        Parses the requests from the body as it is read, and sends each response as a
+        line of a chunked NDJSON body as soon as its request completes (see
+        Server.call_json_stream)
+        """
+        self._start_chunked(NDJSON_CONTENT_TYPE)
+
+        def send(resp_json):
+            self._write_chunk((resp_json + "\n").encode("utf8"))
+        self.server.rpc_server.call_json_stream(body, send, self._props())
+        self._write_chunk(b"")
+        if body.remaining:
+            # parsing stopped at an error, and the rest of the body is still unread
+            self.close_connection = True
+
+    def _write_chunked(self, content_type, chunks):
+        """
+        Sends the strings from the iterator chunks as a chunked body as they are produced
+        """
+        self._start_chunked(content_type)
+        try:
+            for chunk in chunks:
+                self._write_chunk(chunk.encode("utf8"))
+            self._write_chunk(b"")
+        finally:
+            # stops the handler if the client went away before the end
+            chunks.close()
+
+    def _start_chunked(self, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _write_chunk(self, data):
+        self.wfile.write(("%x\r\n" % len(data)).encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def address_string(self):
+        return str(self.server.server_address)
+
+    def log_message(self, format, *args):
+        log = logging.getLogger("barrister")
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%s - %s" % (self.address_string(), format % args))
+
+class UnixSocketServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Listens on a Unix domain socket and dispatches requests to a Server via
+    Server.call_json.  Each connection is served by its own thread.  By default requests
+    use the length-prefixed framing understood by UnixSocketTransport.  Pass http=True
+    to speak HTTP/1.1 instead, for use with UnixHttpTransport.
+
+    For example:
+
+    ::
+
+      listener = barrister.UnixSocketServer(server, "/var/run/orders.sock")
+      listener.serve_forever()
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, server, path, http=False, max_frame_size=MAX_FRAME_SIZE):
+        """
+        Creates a new UnixSocketServer and binds it to path.  A stale socket file
+        left at path by a previous process is removed first.
+
+        :Parameters:
+          server
+            Barrister Server instance to dispatch requests to
+          path
+            Filesystem path to bind the Unix domain socket to
+          http
+            If True, speak HTTP/1.1 instead of length-prefixed frames
+          max_frame_size
+            Largest request frame accepted, in bytes
+        """
+        self.rpc_server = server
+        self.max_frame_size = max_frame_size
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        handler = HttpRequestHandler if http else FramedRequestHandler
+        socketserver.UnixStreamServer.__init__(self, path, handler)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+class TcpServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    Listens on a TCP port and serves the length-prefixed, multiplexed framing used by
+    TcpTransport.  Each connection is read by its own thread, and requests are executed
+    concurrently on a shared WorkerPool that calls Server.call_json.
+
+    For use with TwistedServer, see FramedRpcFactory.
+
+    For example:
+
+    ::
+
+      listener = barrister.TcpServer(server, "0.0.0.0", 9234)
+      listener.serve_forever()
+
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server, host, port, num_workers=16, max_in_flight=64,
+                 max_frame_size=MAX_FRAME_SIZE):
+        """
+        Creates a new TcpServer and binds it to host and port
+
+        :Parameters:
+          server
+            Barrister Server instance to dispatch requests to
+          host
+            Address to bind to
+          port
+            Port to bind to.  Use 0 to pick a free port, then read it from server_address
+          num_workers
+            Number of threads executing requests, shared by all connections
+          max_in_flight
+            Maximum number of requests executing or queued per connection.  Once reached,
+            the connection is not read from until a request completes.
+          max_frame_size
+            Largest request frame accepted, in bytes
+        """
+        self.rpc_server = server
+        self.max_in_flight = max_in_flight
+        self.max_frame_size = max_frame_size
+        self.workers = WorkerPool(num_workers)
+        socketserver.TCPServer.__init__(self, (host, port), MultiplexedRequestHandler)
+
+    def server_close(self):
+        socketserver.TCPServer.server_close(self)
+        self.workers.shutdown(wait=False)
+
+class FramedRpcProtocol(Int32StringReceiver):
+    """
+    Twisted protocol that serves the length-prefixed, multiplexed framing used by
+    TcpTransport with a TwistedServer.  Every frame is dispatched as soon as it is
+    received and its response is written when its deferred fires, so responses are
+    sent in completion order.
+    """
+
+    MAX_LENGTH = MAX_FRAME_SIZE
 
-            for f in self.filters:
-                d.addBoth(lambda r: postHook(f.post, r))
+    def connectionMade(self):
+        self.pending = PendingCalls()
 
-        return d
+    def connectionLost(self, reason=protocol.connectionDone):
+        self.pending.cancel_all()
 
-    def _call(self, context):
-        """
-        Executes a single request against a handler.  If the req.method == 'barrister-idl', the
-        Contract IDL JSON structure is returned.  Otherwise the method is resolved to a handler
-        based on the interface name, and the appropriate function is called on the handler.
+    def stringReceived(self, data):
+        d = self.factory.server.call_json(data.decode("utf8"))
+        d.addErrback(parse_error)
+        d.addCallback(lambda resp: self.sendString(resp.encode("utf8")))
+        self.pending.track(d)
 
-        :Parameter:
-          req
-            A dict representing a valid JSON-RPC 2.0 request.  'method' must be provided.
-        """
-        req = context.request
-        if "method" not in req:
-            return defer.fail(RpcException(ERR_INVALID_REQ, "Invalid Request. No 'method'."))
+def parse_error(failure):
+    """
+    Errback that returns the encoded error TwistedServer.call_json fails with on invalid
+    JSON, and passes any other failure on
+    """
+    if isinstance(failure.value, six.string_types):
+        return failure.value
+    return failure
 
-        method = req["method"]
+class PendingCalls(object):
+    """
+    Tracks the Deferreds returned by TwistedServer for the requests received on a single
+    connection, so they can be cancelled when the connection closes.  Cancellation
+    propagates CancelledError into the handlers' Deferreds, and skips response validation
+    and encoding.  Cancelled calls are not reported as errors.
 
-        if method == "barrister-idl":
-            return defer.succeed(self.contract.idl_parsed)
+    FramedRpcProtocol and TwistedHttpResource use this.  A Websocket protocol would use
+    it like so:
 
-        iface_name, func_name = unpack_method(method)
+    ::
 
-        if iface_name in self.handlers:
-            iface_impl = self.handlers[iface_name]
-            func = getattr(iface_impl, func_name)
-            if func:
-                if "params" in req:
-                    params = req["params"]
-                else:
-                    params = []
+      def onOpen(self):
+          self.pending = barrister.PendingCalls()
 
-                if self.validate_req:
-                    try:
-                        self.contract.validate_request(iface_name, func_name, params)
-                    except Exception as e:
-                        return defer.fail(e)
+      def onMessage(self, payload, isBinary):
+          d = server.call_json_streaming(payload.decode("utf8"), self.send)
+          self.pending.track(d)
 
-                if hasattr(iface_impl, "barrister_pre"):
-                    pre_hook = getattr(iface_impl, "barrister_pre")
-                    pre_hook(context, params)
+      def onClose(self, wasClean, code, reason):
+          self.pending.cancel_all()
 
-                if params:
-                    d = func(*params)
-                else:
-                    d = func()
+    """
 
-                if self.validate_resp:
-                    def validate_response(result):
-                        self.contract.validate_response(iface_name, func_name, result)
-                        return result
-                    d.addCallback(validate_response)
-                return d
-            else:
-                msg = "Method '%s' not found" % (method)
-                return defer.fail(RpcException(ERR_METHOD_NOT_FOUND, msg))
+    def __init__(self):
+        self.deferreds = set()
+        self.closed = False
+
+    def track(self, d):
+        """
+        Tracks d until it fires.  If the connection has already closed, d is cancelled.
+        Returns d.
+        """
+        if self.closed:
+            d.cancel()
         else:
-            msg = "No implementation of '%s' found" % (iface_name)
-            return defer.fail(RpcException(ERR_METHOD_NOT_FOUND, msg))
+            self.deferreds.add(d)
+
+            def untrack(result):
+                self.deferreds.discard(d)
+                return result
+            d.addBoth(untrack)
+        d.addErrback(self._ignore_cancelled)
+        return d
 
+    def _ignore_cancelled(self, failure):
+        failure.trap(defer.CancelledError)
 
-class HttpTransport(object):
+    def cancel_all(self):
+        """
+        Cancels every call still in progress, and any call tracked from now on
+        """
+        self.closed = True
+        for d in list(self.deferreds):
+            d.cancel()
+
+class TwistedHttpResource(web_resource.Resource):
     """
-    A client transport that uses urllib2 to make requests against a HTTP server.
+    twisted.web resource that serves POSTed JSON-RPC requests with a TwistedServer.
+    Calls still in progress when the client disconnects are cancelled.  Requests that
+    accept NDJSON get each response as a line as soon as its request completes (see
+    TwistedServer.call_json_streaming).  Other responses carry a Server-Timing header
+    if timing is enabled on the server (see TwistedServer.set_timing).
+
+    For example:
+
+    ::
+
+      site = twisted.web.server.Site(barrister.TwistedHttpResource(twisted_server))
+      reactor.listenTCP(8080, site)
+
     """
 
-    def __init__(self, url, handlers=None, headers=None):
+    isLeaf = True
+
+    def __init__(self, server):
         """
-        Creates a new HttpTransport
+        Creates a new TwistedHttpResource
 
         :Parameters:
-          url
-            URL of the server endpoint
-          handlers
-            Optional list of handlers to pass to urllib2.build_opener()
-          headers
-            Optional list of HTTP headers to set on requests.  Note that Content-Type will always be set
-            automatically to "application/json"
+          server
+            TwistedServer instance to dispatch requests to
         """
-        if not headers:
-            headers = { }
-        headers['Content-Type'] = 'application/json'
-        self.url = url
-        self.headers = headers
-        if handlers:
-            self.opener = urllib.build_opener(*handlers)
+        web_resource.Resource.__init__(self)
+        self.server = server
+
+    def render_POST(self, request):
+        # twisted.web calls render once the whole body has been received
+        props = { "received_at": perf_timer() }
+        traceparent = request.getHeader("traceparent")
+        if traceparent:
+            props["traceparent"] = traceparent
+        body = request.content.read().decode("utf8")
+        pending = PendingCalls()
+        disconnected = [ ]
+
+        def lost(f):
+            disconnected.append(f)
+            pending.cancel_all()
+        request.notifyFinish().addErrback(lost)
+
+        ndjson = NDJSON_CONTENT_TYPE in (request.getHeader("Accept") or "")
+        if ndjson:
+            request.setHeader("Content-Type", NDJSON_CONTENT_TYPE)
+
+            def send(resp_json):
+                if not disconnected:
+                    request.write((resp_json + "\n").encode("utf8"))
+
+            def finish(result):
+                if not disconnected:
+                    request.finish()
+
+            d = self.server.call_json_streaming(body, send, props)
+            d.addCallback(finish)
         else:
-            self.opener = urllib.build_opener()
+            d = self.server.call_json(body, props)
+
+            def write(resp):
+                if "server_timing" in props:
+                    request.setHeader("Server-Timing",
+                                      server_timing_header(props["server_timing"]))
+                request.setHeader("Content-Type", "application/json")
+                request.write(resp.encode("utf8"))
+                request.finish()
+
+            d.addErrback(parse_error)
+            d.addCallback(write)
+
+        def failed(failure):
+            if failure.check(defer.CancelledError):
+                return failure
+            self.server.log.error("Error serving request: %s" % failure.getTraceback())
+            if disconnected or request.finished:
+                return None
+            resp = json.dumps(err_response(None, ERR_UNKNOWN,
+                                           "Server error. Check logs for details.",
+                                           data={'exception': str(failure.value)}))
+            if ndjson:
+                request.write((resp + "\n").encode("utf8"))
+            else:
+                request.setResponseCode(500)
+                request.setHeader("Content-Type", "application/json")
+                request.write(resp.encode("utf8"))
+            request.finish()
+        d.addErrback(failed)
+        pending.track(d)
+        return web_server.NOT_DONE_YET
+
+class FramedRpcFactory(protocol.ServerFactory):
+    """
+    Twisted factory for FramedRpcProtocol.
 
-    def request(self, req):
+    For example:
+
+    ::
+
+      reactor.listenTCP(9234, barrister.FramedRpcFactory(twisted_server))
+
+    """
+
+    protocol = FramedRpcProtocol
+
+    def __init__(self, server):
         """
-        Makes a request against the server and returns the deserialized result.
+        Creates a new FramedRpcFactory
 
         :Parameters:
-          req
-            List or dict representing a JSON-RPC formatted request
+          server
+            TwistedServer instance to dispatch requests to
         """
-        data = json.dumps(req)
-        req = urllib.Request(self.url, data, self.headers)
-        f = self.opener.open(req)
-        resp = f.read()
-        f.close()
-        return json.loads(resp)
+        self.server = server
 
 class WebsocketTransport(object):
     """
@@ -709,18 +5880,31 @@ class WebsocketTransport(object):
     Websocket server.
     """
 
-    def __init__(self, protocol):
+    def __init__(self, protocol, coalesce=False, clock=None):
         """
         Creates a new Websocket transport
 
         :Parameters:
           protocol
             The Twisted protocol instance to use for communication
+          coalesce
+            If True, requests issued during the same reactor turn are queued and sent
+            together as a single JSON-RPC batch frame instead of one frame per request.
+            Responses are still delivered to each request's deferred individually, so
+            this works with servers that reply with a batch list or that stream back
+            single responses (see TwistedServer.call_json_streaming)
+          clock
+            Optional IReactorTime provider used to schedule the coalesced flush.
+            Defaults to the global Twisted reactor.
         """
         logging.basicConfig()
         self.log = logging.getLogger("barrister")
         self.protocol = protocol
         self.reqs = TTLCache(maxsize=100, ttl=60)  # TTL in seconds
+        self.coalesce = coalesce
+        self.clock = clock
+        self.pending = [ ]
+        self.flush_call = None
 
     def request(self, req):
         """
@@ -736,26 +5920,67 @@ class WebsocketTransport(object):
 
         if self.log.isEnabledFor(logging.DEBUG):
             self.log.debug("RPC --> {!r}".format(req))
-        payload = json.dumps(req, ensure_ascii=False).encode('utf8')
-        self.protocol.sendMessage(payload, isBinary=False)
+
+        if self.coalesce:
+            self.pending.append(req)
+            if self.flush_call is None:
+                if self.clock is None:
+                    from twisted.internet import reactor
+                    self.clock = reactor
+                self.flush_call = self.clock.callLater(0, self.flush)
+        else:
+            self._send(req)
 
         return d
 
+    def flush(self):
+        """
+        Sends all requests queued in coalesce mode.  A single queued request is sent
+        as is, several are sent as one JSON-RPC batch frame.  Called automatically at
+        the end of the reactor turn, but may also be called directly.
+        """
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+
+        pending = self.pending
+        self.pending = [ ]
+        if len(pending) == 1:
+            self._send(pending[0])
+        elif pending:
+            self._send(pending)
+
+    def _send(self, message):
+        payload = json.dumps(message, ensure_ascii=False).encode('utf8')
+        self.protocol.sendMessage(payload, isBinary=False)
+
     def response_received(self, payload):
         """
         Callback invoked when a response is received from the server.
 
         :Parameters:
           payload
-            The raw bytes received
+            The raw bytes received. Either a single JSON-RPC response or a batch
+            list of them.
         """
         message = json.loads(payload.decode('utf8'))
         if self.log.isEnabledFor(logging.DEBUG):
             self.log.debug("<-- RPC {!r}".format(message))
 
+        if isinstance(message, list):
+            for m in message:
+                # one stray response must not keep the rest of the batch from their callers
+                try:
+                    self._dispatch(m)
+                except RpcException:
+                    self.log.warning("Discarding response without request: {!r}".format(m))
+        else:
+            self._dispatch(message)
+
+    def _dispatch(self, message):
         try:
             d = self.reqs.pop(message['id'])
-        except KeyError as e:
+        except (KeyError, TypeError) as e:
             raise RpcException(
                 ERR_INVALID_RESP, "Received response without request")
 
@@ -777,7 +6002,7 @@ class TwistedClient(object):
     """
 
     def __init__(self, transport, validate_request=True, validate_response=True,
-                 id_gen=idgen_uuid):
+                 id_gen=idgen_uuid, timeout=None):
         """
         Creates a new Client for the given transport.
 
@@ -795,6 +6020,9 @@ class TwistedClient(object):
             to correlate requests with responses when using a batch, but your application may use them
             for logging or other purposes.  UUIDs are used by default, but you can substitute another
             function if you prefer something shorter.
+          timeout
+            Optional number of seconds the server may spend on each request, sent in the
+            request's `timeout` member
         """
         logging.basicConfig()
         self.log = logging.getLogger("barrister")
@@ -802,6 +6030,7 @@ class TwistedClient(object):
         self.validate_req = validate_request
         self.validate_resp = validate_response
         self.id_gen = id_gen
+        self.timeout = timeout
 
     def get_api(self):
         """
@@ -883,7 +6112,10 @@ class TwistedClient(object):
 
         method = "%s.%s" % (iface_name, func_name)
         reqid = self.id_gen()
-        return { "jsonrpc": "2.0", "id": reqid, "method": method, "params": params }
+        req = { "jsonrpc": "2.0", "id": reqid, "method": method, "params": params }
+        if self.timeout is not None:
+            req["timeout"] = self.timeout
+        return req
 
     def to_result(self, iface_name, func_name, resp):
         """
@@ -921,6 +6153,9 @@ class InProcTransport(object):
     A client transport that invokes calls directly against a Server instance in process.
     This is useful for quickly unit testing services without having to go over the network.
     """
+
+    thread_safe = True
+
     def __init__(self, server):
         """
         Creates a new InProcTransport for the given Server
@@ -941,6 +6176,216 @@ class InProcTransport(object):
         """
         return self.server.call(req)
 
+class ResponseCache(object):
+    """
+    LRU cache of results for idempotent functions, used by Client.  Entries are keyed
+    on method name and params (see request_key) and expire after a per-function TTL.
+    Cache hits skip request validation, serialization and the network entirely.
+
+    Functions are made cacheable either by listing them in `functions`, or by adding an
+    annotation to their comment in the IDL:
+
+    ::
+
+      interface ConfigService {
+          // @cacheable(ttl=30)
+          get(key string) string
+      }
+
+    `@cacheable` without a ttl uses the cache's default ttl.
+
+    With stale_while_revalidate > 0, an expired entry is still returned for that many
+    extra seconds while a single background request refreshes it.
+
+    Cached results are shared between callers and must not be modified.
+    """
+
+    annotation_re = re.compile(r"@cacheable(?:\(\s*ttl\s*=\s*([0-9.]+)\s*\))?")
+
+    def __init__(self, maxsize=1024, ttl=60, functions=None, stale_while_revalidate=0):
+        """
+        Creates a new ResponseCache
+
+        :Parameters:
+          maxsize
+            Maximum number of cached results.  The least recently used entry is evicted
+            when full.
+          ttl
+            Default number of seconds a result is cached for
+          functions
+            Optional list of "Interface.function" names to cache with the default ttl, or
+            dict mapping names to their ttl in seconds
+          stale_while_revalidate
+            Number of seconds past expiry during which a stale result is returned while
+            it is refreshed in the background
+        """
+        self.ttl = ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        self.ttls = { }
+        if isinstance(functions, dict):
+            self.ttls.update(functions)
+        elif functions:
+            for f in functions:
+                self.ttls[f] = ttl
+        self.entries = LRUCache(maxsize=maxsize)
+        self.refreshing = set()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.lock = threading.Lock()
+
+    def configure(self, contract):
+        """
+        Enables caching for functions whose IDL comment contains a @cacheable annotation.
+        Functions already listed explicitly keep their configured ttl.  Called by Client
+        once the IDL has been loaded.
+
+        :Parameters:
+          contract
+            Contract to scan
+        """
+        for iface in contract.interfaces.values():
+            for func in iface.functions.values():
+                m = self.annotation_re.search(func.comment)
+                if m and func.full_name not in self.ttls:
+                    self.ttls[func.full_name] = float(m.group(1)) if m.group(1) else self.ttl
+
+    def ttl_for(self, method):
+        """
+        Returns the ttl in seconds for method, or None if it is not cacheable
+        """
+        return self.ttls.get(method)
+
+    def get(self, key):
+        """
+        Looks up key.  Returns a tuple: (found, result, stale)
+
+        - `found` - True if a fresh or stale entry exists
+        - `result` - Cached result, or None if not found
+        - `stale` - True if the entry has expired and should be refreshed.  Only returned
+          once per expiry, for the caller that should perform the refresh.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                result, expires = entry
+                if now < expires:
+                    self.hits += 1
+                    return True, result, False
+                if now < expires + self.stale_while_revalidate:
+                    self.stale_hits += 1
+                    refresh = key not in self.refreshing
+                    self.refreshing.add(key)
+                    return True, result, refresh
+                del self.entries[key]
+            self.misses += 1
+            return False, None, False
+
+    def put(self, key, result, ttl):
+        """
+        Stores a result for key for ttl seconds
+        """
+        with self.lock:
+            self.entries[key] = (result, time.time() + ttl)
+            self.refreshing.discard(key)
+
+    def refresh_failed(self, key):
+        """
+        Allows another refresh of key after a failed background refresh
+        """
+        with self.lock:
+            self.refreshing.discard(key)
+
+    def invalidate(self, key=None):
+        """
+        Removes the entry for key, or all entries if key is None
+        """
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def stats(self):
+        """
+        Returns a dict with keys: 'size', 'hits', 'stale_hits', 'misses', 'hit_ratio'
+        """
+        with self.lock:
+            total = self.hits + self.stale_hits + self.misses
+            ratio = 0.0
+            if total:
+                ratio = float(self.hits + self.stale_hits) / total
+            return { "size": len(self.entries), "hits": self.hits,
+                     "stale_hits": self.stale_hits, "misses": self.misses,
+                     "hit_ratio": ratio }
+
+class ResultCache(ResponseCache):
+    """
+    LRU cache of handler results for idempotent functions, used by Server (see
+    Server.set_result_cache).  Entries are keyed on method name and params and expire
+    after a per-function TTL.  A cache hit skips the handler and response validation.
+    Functions are enabled the same way as for ResponseCache: explicitly, or with a
+    @cacheable annotation in the IDL.
+
+    With serialize=True, the JSON encoding of each result is stored alongside it, and
+    Server.call_json writes cached results out without encoding them again.
+
+    Handlers that change data should invalidate affected entries, e.g.:
+
+    ::
+
+      cache.invalidate_method("ConfigService.get", [ key ])
+
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, functions=None, serialize=False):
+        """
+        Creates a new ResultCache
+
+        :Parameters:
+          maxsize
+            Maximum number of cached results.  The least recently used entry is evicted
+            when full.
+          ttl
+            Default number of seconds a result is cached for
+          functions
+            Optional list of "Interface.function" names to cache with the default ttl, or
+            dict mapping names to their ttl in seconds
+          serialize
+            If True, also store each result serialized as JSON
+        """
+        ResponseCache.__init__(self, maxsize, ttl, functions)
+        self.serialize = serialize
+
+    def put(self, key, result, ttl):
+        """
+        Stores a result for key for ttl seconds.  With serialize=True, the stored entry is
+        a (result, json) tuple.
+        """
+        if self.serialize:
+            result = (result, json.dumps(result))
+        ResponseCache.put(self, key, result, ttl)
+
+    def invalidate_method(self, method, params=None):
+        """
+        Removes cached results for a function.  Safe to call from handlers.
+
+        :Parameters:
+          method
+            "Interface.function" name
+          params
+            List of params of the entry to remove.  If None, all entries for the
+            function are removed.
+        """
+        if params is not None:
+            self.invalidate(request_key(method, params))
+        else:
+            prefix = method + ":"
+            with self.lock:
+                for key in [ k for k in self.entries.keys() if k.startswith(prefix) ]:
+                    del self.entries[key]
+
 class Client(object):
     """
     Main class for consuming a server implementation.  Given a transport it loads the IDL from
@@ -957,10 +6402,20 @@ class Client(object):
       client = barrister.Client(barrister.HttpTransport("http://localhost:8080/OrderManagement"))
       status = client.OrderService.getOrderStatus("order-123")
 
+    A single Client may be shared by many threads if it is created with thread_safe=True.
+    Pair it with a thread-safe transport such as PooledHttpTransport or TcpTransport so
+    that concurrent calls do not wait on each other:
+
+    ::
+
+      transport = barrister.PooledHttpTransport("http://localhost:8080/OrderManagement")
+      client = barrister.Client(transport, thread_safe=True)
+
     """
 
     def __init__(self, transport, validate_request=True, validate_response=True,
-                 id_gen=idgen_uuid):
+                 id_gen=idgen_uuid, thread_safe=False, cache=None, idempotency_keys=False,
+                 tracer=None, timeout=None):
         """
         Creates a new Client for the given transport. When the constructor is called the
         client immediately makes a request to the server to load the IDL.  It then creates
@@ -980,19 +6435,50 @@ class Client(object):
             A callable to use to create request IDs.  JSON-RPC request IDs are only used by Barrister
             to correlate requests with responses when using a batch, but your application may use them
             for logging or other purposes.  UUIDs are used by default, but you can substitute another
-            function if you prefer something shorter.
+            function if you prefer something shorter.  With thread_safe=True the function must
+            be safe to call from several threads, as idgen_uuid and idgen_seq are.
+          thread_safe
+            If True, the client may be used from many threads at once.  Transports that do not
+            declare themselves thread-safe (with a true `thread_safe` attribute) are wrapped in a
+            LockedTransport, which serializes requests.
+          cache
+            Optional ResponseCache.  Calls to the functions it caches are answered from the
+            cache when possible.
+          idempotency_keys
+            If True, every request carries a random `idempotency_key` member.  A transport
+            that resends the same request dict after a failure can then rely on servers
+            with an IdempotencyStore not to execute it twice.
+          tracer
+            Optional Tracer.  Each call is recorded as a span with a child span for the
+            transport round trip, and the span's trace context is sent to the server in
+            the request's `traceparent` member.
+          timeout
+            Optional number of seconds the server may spend on each request.  Sent in the
+            request's `timeout` member, so the server can give up on requests the caller no
+            longer waits for.  If the call is made inside a Deadline, or from a handler of
+            a request that has a deadline, the remaining budget is sent instead when it is
+            shorter.
         """
         logging.basicConfig()
         self.log = logging.getLogger("barrister")
+        if thread_safe and not getattr(transport, "thread_safe", False):
+            transport = LockedTransport(transport)
         self.transport = transport
         self.validate_req  = validate_request
         self.validate_resp = validate_response
         self.id_gen = id_gen
+        self.cache = cache
+        self.idempotency_keys = idempotency_keys
+        self.tracer = tracer
+        self.timeout = timeout
+        self.local = threading.local()
         req = {"jsonrpc": "2.0", "method": "barrister-idl", "id": "1"}
         resp = transport.request(req)
         self.contract = Contract(resp["result"])
         for k, v in list(self.contract.interfaces.items()):
             setattr(self, k, InterfaceClientProxy(self, v))
+        if cache:
+            cache.configure(self.contract)
 
     def get_meta(self):
         """
@@ -1002,7 +6488,86 @@ class Client(object):
 
     def call(self, iface_name, func_name, params):
         """
-        Makes a single RPC request and returns the result.
+        Makes a single RPC request and returns the result.  If the function is cached by
+        the Client's ResponseCache, a cached result may be returned instead.
+
+        :Parameters:
+          iface_name
+            Interface name to call
+          func_name
+            Function to call on the interface
+          params
+            List of parameters to pass to the function
+        """
+        if self.cache:
+            ttl = self.cache.ttl_for("%s.%s" % (iface_name, func_name))
+            if ttl is not None:
+                return self._cached_call(iface_name, func_name, params, ttl)
+        return self._call(iface_name, func_name, params)
+
+    def call_stream(self, iface_name, func_name, params):
+        """
+        Makes a single RPC request to a function with an array return type, and returns an
+        iterator over the elements of the result.  If the transport has a request_lines()
+        method (such as PooledHttpTransport) and the server streams the result (see
+        Server.call_json_chunks), elements are parsed and validated as they arrive, so
+        the whole array is never held in memory.  Otherwise the response is read first.
+
+        :Parameters:
+          iface_name
+            Interface name to call
+          func_name
+            Function to call on the interface
+          params
+            List of parameters to pass to the function
+        """
+        req = self.to_request(iface_name, func_name, params)
+        if not hasattr(self.transport, "request_lines"):
+            resp = self.transport.request(req)
+            return iter(self.to_result(iface_name, func_name, resp))
+        return self._iter_result(iface_name, func_name, self.transport.request_lines(req))
+
+    def _iter_result(self, iface_name, func_name, lines):
+        """
+        Parses the lines of a response encoded by iter_encode_response(), yielding the
+        result elements
+        """
+        head = next(lines, "")
+        if not head.rstrip().endswith("["):
+            # not streamed: the whole response is one JSON document
+            resp = json.loads(head + "".join(lines))
+            for item in self.to_result(iface_name, func_name, resp):
+                yield item
+            return
+
+        function = self.contract.interface(iface_name).function(func_name)
+        index = 0
+        for line in lines:
+            line = line.strip()
+            if line.startswith("]"):
+                # the closing line may carry an error raised part way through the stream
+                self.to_result(iface_name, func_name, json.loads('{"result": [' + line))
+                return
+            if not line:
+                continue
+            item = json.loads(line.lstrip(","))
+            if self.validate_resp:
+                function.validate_response_element(index, item)
+            index += 1
+            yield item
+        raise IOError("Connection closed before the end of the result stream")
+
+    def notify(self, iface_name, func_name, params):
+        """
+        Sends a JSON-RPC notification: a request without an id, which the server does not
+        answer.  Returns None as soon as the transport has delivered the request.  Servers
+        with a NotificationExecutor (see Server.set_notification_executor) run it in the
+        background.  Other servers run it before replying with a null id, and the reply is
+        discarded: HTTP transports drop the response body, and TcpTransport drops null-id
+        responses while a notification sent on its connection may still be answered.
+
+        Functions declared without a return type in the IDL are called this way by the
+        interface proxies.
 
         :Parameters:
           iface_name
@@ -1012,14 +6577,97 @@ class Client(object):
           params
             List of parameters to pass to the function
         """
+        req = self.to_request(iface_name, func_name, params)
+        del req["id"]
+        if self.tracer is not None:
+            span = self.tracer.start_span("%s.%s" % (iface_name, func_name))
+            req["traceparent"] = span.traceparent()
+            try:
+                self.transport.request(req)
+            finally:
+                span.finish()
+        else:
+            self.transport.request(req)
+
+    def _cached_call(self, iface_name, func_name, params, ttl):
+        key = request_key("%s.%s" % (iface_name, func_name), params)
+        found, result, stale = self.cache.get(key)
+        if stale:
+            t = threading.Thread(target=self._refresh, args=(iface_name, func_name, params,
+                                                             key, ttl))
+            t.daemon = True
+            t.start()
+        if found:
+            return result
+
+        result = self._call(iface_name, func_name, params)
+        self.cache.put(key, result, ttl)
+        return result
+
+    def _refresh(self, iface_name, func_name, params, key, ttl):
+        try:
+            self.cache.put(key, self._call(iface_name, func_name, params), ttl)
+        except Exception:
+            self.cache.refresh_failed(key)
+            self.log.exception("Error refreshing cached result for: %s" % key)
+
+    def _call(self, iface_name, func_name, params):
+        if self.tracer is not None:
+            return self._traced_call(iface_name, func_name, params)
         req  = self.to_request(iface_name, func_name, params)
         if self.log.isEnabledFor(logging.DEBUG):
             self.log.debug("Request: %s" % str(req))
+        start = perf_timer()
         resp = self.transport.request(req)
+        self._note_timing(resp, perf_timer() - start)
         if self.log.isEnabledFor(logging.DEBUG):
             self.log.debug("Response: %s" % str(resp))
         return self.to_result(iface_name, func_name, resp)
 
+    def _note_timing(self, resp, elapsed):
+        """
+        Remembers the server's timing breakdown for the response on this thread, and
+        derives the time spent outside the server from the round trip time
+        """
+        timing = safe_get(resp, "timing") if isinstance(resp, dict) else None
+        if timing:
+            timing = dict(timing)
+            timing["round_trip"] = round(elapsed * 1000.0, 3)
+            if "total" in timing:
+                server = timing["total"] + timing.get("decode", 0) + timing.get("queue", 0)
+                timing["network"] = round(max(timing["round_trip"] - server, 0), 3)
+        self.local.timing = timing
+
+    def last_timing(self):
+        """
+        Returns the timing breakdown of the last call made by the current thread, or None
+        if the server did not return one (see Server.set_timing).  Contains the server's
+        phases in milliseconds, plus 'round_trip' as measured by the client and 'network',
+        the part of the round trip not accounted for by the server.
+        """
+        return getattr(self.local, "timing", None)
+
+    def _traced_call(self, iface_name, func_name, params):
+        span = self.tracer.start_span("%s.%s" % (iface_name, func_name))
+        try:
+            req = self.to_request(iface_name, func_name, params)
+            span.set_attribute("rpc.id", req["id"])
+            req["traceparent"] = span.traceparent()
+            start = perf_timer()
+            resp = self.transport.request(req)
+            end = perf_timer()
+            span.add_phase("transport", start, end)
+            self._note_timing(resp, end - start)
+            return self.to_result(iface_name, func_name, resp)
+        except RpcException as e:
+            span.set_attribute("rpc.error_code", e.code)
+            raise
+        except Exception as e:
+            span.set_attribute("error", str(e))
+            raise
+        finally:
+            span.finish()
+
     def to_request(self, iface_name, func_name, params):
         """
         Converts the arguments to a JSON-RPC request dict.  The 'id' field is populated
@@ -1042,7 +6690,21 @@ class Client(object):
 
         method = "%s.%s" % (iface_name, func_name)
         reqid = self.id_gen()
-        return { "jsonrpc": "2.0", "id": reqid, "method": method, "params": params }
+        req = { "jsonrpc": "2.0", "id": reqid, "method": method, "params": params }
+        if self.idempotency_keys:
+            req["idempotency_key"] = uuid.uuid4().hex
+        timeout = self.timeout
+        at = current_deadline()
+        if at is not None:
+            remaining = at - time.time()
+            if remaining <= 0:
+                raise RpcException(ERR_DEADLINE_EXCEEDED,
+                                   "Deadline exceeded before calling %s" % method)
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        if timeout is not None:
+            req["timeout"] = timeout
+        return req
 
     def to_result(self, iface_name, func_name, resp):
         """
@@ -1102,23 +6764,30 @@ class InterfaceClientProxy(object):
         self.client = client
         iface_name = iface.name
         for func_name, func in list(iface.functions.items()):
-            setattr(self, func_name, self._caller(iface_name, func_name))
+            setattr(self, func_name, self._caller(iface_name, func_name, func))
 
-    def _caller(self, iface_name, func_name):
+    def _caller(self, iface_name, func_name, func):
         """
         Returns a function for the given interface and function name.  When invoked it
-        calls client.call() with the correct arguments.
+        calls client.call() with the correct arguments, or client.notify() if the
+        function is a notification (has no return type in the IDL).
 
         :Parameters:
           iface_name
             Name of interface to call when invoked
           func_name
             Name of function to call when invoked
+          func
+            Function instance from the Contract
           params
             Params pass to function from the calling application
         """
-        def caller(*params):
-            return self.client.call(iface_name, func_name, params)
+        if func.returns is None:
+            def caller(*params):
+                return self.client.notify(iface_name, func_name, params)
+        else:
+            def caller(*params):
+                return self.client.call(iface_name, func_name, params)
         return caller
 
 class Batch(object):
@@ -1158,13 +6827,25 @@ class Batch(object):
             req = self.client.to_request(iface_name, func_name, params)
             self.req_list.append(req)
 
+    def notify(self, iface_name, func_name, params):
+        """
+        Implements the notify() function with same signature as Client.notify().  The
+        notification is sent with the batch, but has no RpcResponse.
+        """
+        if self.sent:
+            raise Exception("Batch already sent. Cannot add more calls.")
+        else:
+            req = self.client.to_request(iface_name, func_name, params)
+            del req["id"]
+            self.req_list.append(req)
+
     def send(self):
         """
         Sends the batch request to the server and returns a list of RpcResponse
         objects.  The list will be in the order that the requests were made to
         the batch.  Note that the RpcResponse objects may contain an error or a
         successful result.  When you iterate through the list, you must test for
-        response.error.
+        response.error.  Notifications added with notify() have no RpcResponse.
 
         send() may not be called more than once.
         """
@@ -1172,31 +6853,109 @@ class Batch(object):
             raise Exception("Batch already sent. Cannot send() again.")
         else:
             self.sent = True
+            tracer = self.client.tracer
+            if tracer is not None:
+                return self._traced_send(tracer)
             results = self.client.transport.request(self.req_list)
+            return self._to_responses(results)
 
-            id_to_method = { }
-            by_id = { }
-            for res in results:
-                reqid = res["id"]
-                by_id[reqid] = res
-
-            in_req_order = [ ]
-            for req in self.req_list:
-                reqid  = req["id"]
-                result = None
-                error  = None
-                resp   = safe_get(by_id, reqid)
-                if resp == None:
-                    msg = "Batch response missing result for request id: %s" % reqid
-                    error = RpcException(ERR_INVALID_RESP, msg)
-                else:
-                    r_err = safe_get(resp, "error")
-                    if r_err == None:
-                        result = resp["result"]
-                    else:
-                        error = RpcException(r_err["code"], r_err["message"], safe_get(r_err, "data"))
-                in_req_order.append(RpcResponse(req, result, error))
-            return in_req_order
+    def stream(self):
+        """
+        Sends the batch request like send(), but returns an iterator that yields each
+        RpcResponse as soon as it arrives, in the order the server completes them.
+        Requests the server did not answer are yielded last, with an error.
+
+        Transports with a request_stream() method (such as PooledHttpTransport) receive
+        the responses incrementally.  With other transports the iterator waits for the
+        whole batch response.
+
+        stream() and send() may only be called once per batch.
+        """
+        if self.sent:
+            raise Exception("Batch already sent. Cannot send() again.")
+        self.sent = True
+        transport = self.client.transport
+        if hasattr(transport, "request_stream"):
+            results = transport.request_stream(self.req_list)
+        else:
+            results = transport.request(self.req_list)
+        return self._stream(results)
+
+    def _stream(self, results):
+        waiting = collections.OrderedDict([ (req["id"], req) for req in self.req_list
+                                            if "id" in req ])
+        for res in results or [ ]:
+            req = waiting.pop(safe_get(res, "id"), None)
+            if req is not None:
+                yield self._to_response(req, res)
+        for req in waiting.values():
+            yield self._to_response(req, None)
+
+    def _traced_send(self, tracer):
+        span = tracer.start_span("barrister.batch")
+        children = [ ]
+        for req in self.req_list:
+            child = span.child(req["method"], attributes={ "rpc.id": safe_get(req, "id") })
+            req["traceparent"] = child.traceparent()
+            children.append(child)
+        try:
+            start = perf_timer()
+            results = self.client.transport.request(self.req_list)
+            span.add_phase("transport", start, perf_timer())
+            responses = self._to_responses(results)
+        except Exception as e:
+            span.set_attribute("error", str(e))
+            raise
+        finally:
+            span.finish()
+        calls = [ ]
+        for child, req in zip(children, self.req_list):
+            if "id" in req:
+                calls.append(child)
+            else:
+                child.finish()
+        for child, resp in zip(calls, responses):
+            if resp.error is not None:
+                child.set_attribute("rpc.error_code", resp.error.code)
+            child.finish()
+        return responses
+
+    def _to_responses(self, results):
+        """
+        Matches the responses to a batch request with the requests by id, and returns a
+        list of RpcResponse objects in request order
+        """
+        by_id = { }
+        for res in results or [ ]:
+            reqid = res["id"]
+            by_id[reqid] = res
+
+        in_req_order = [ ]
+        for req in self.req_list:
+            if "id" not in req:
+                continue
+            in_req_order.append(self._to_response(req, safe_get(by_id, req["id"])))
+        return in_req_order
+
+    def _to_response(self, req, resp):
+        """
+        Returns a RpcResponse for req from its JSON-RPC response dict, or from None if
+        the server did not answer it
+        """
+        result = None
+        error  = None
+        timing = None
+        if resp == None:
+            msg = "Batch response missing result for request id: %s" % req["id"]
+            error = RpcException(ERR_INVALID_RESP, msg)
+        else:
+            r_err = safe_get(resp, "error")
+            if r_err == None:
+                result = resp["result"]
+            else:
+                error = RpcException(r_err["code"], r_err["message"], safe_get(r_err, "data"))
+            timing = safe_get(resp, "timing")
+        return RpcResponse(req, result, error, timing)
 
 
 class RpcResponse(object):
@@ -1206,12 +6965,15 @@ class RpcResponse(object):
     * `request` - JSON-RPC request dict
     * `result`  - Result from this call. Set to None if there was an error.
     * `error`   - RpcException instance.  Set to None if call was successful.
+    * `timing`  - Dict mapping server phase to milliseconds, if the server returns timings
+      (see Server.set_timing).  Otherwise None.
     """
 
-    def __init__(self, request, result, error):
+    def __init__(self, request, result, error, timing=None):
         self.request = request
         self.result  = result
         self.error   = error
+        self.timing  = timing
 
 class Contract(object):
     """
@@ -1547,7 +7309,8 @@ class Function(object):
           iface_name
             Name of interface this function belongs to
           f
-            Dict from parsed IDL representing this function. keys: 'name', 'params', 'returns'
+            Dict from parsed IDL representing this function. keys: 'name', 'params', 'returns'.
+            'returns' is omitted for notification functions.
           contract
             Contract to associate this Function with
         """
@@ -1556,7 +7319,10 @@ class Function(object):
         self.params = []
         for p in f["params"]:
             self.params.append(Type(p))
-        self.returns = Type(f["returns"])
+        self.returns = None
+        if f.get("returns"):
+            self.returns = Type(f["returns"])
+        self.comment = safe_get(f, "comment") or ""
         self.full_name = "%s.%s" % (iface_name, self.name)
 
     def validate_params(self, params):
@@ -1577,8 +7343,11 @@ class Function(object):
     def validate_response(self, resp):
         """
         Validates resp against expected return type for this function.
-        Raises RpcException if the response is invalid.
+        Raises RpcException if the response is invalid.  Notification functions
+        return nothing, so any response is accepted.
         """
+        if self.returns is None:
+            return
         ok, msg = self.contract.validate(self.returns,
                                          self.returns.is_array, resp)
         if not ok:
@@ -1586,6 +7355,25 @@ class Function(object):
             msg = "Function '%s' invalid response: '%s'. %s" % vals
             raise RpcException(ERR_INVALID_RESP, msg)
 
+    def validate_response_element(self, index, item):
+        """
+        Validates one element of the array returned by this function, for results that
+        are validated as they are streamed.  Raises RpcException if the element is invalid.
+
+        :Parameters:
+          index
+            Position of the element in the array, used in the error message
+          item
+            Element to validate
+        """
+        if self.returns is None:
+            return
+        ok, msg = self.contract.validate(self.returns, False, item)
+        if not ok:
+            vals = (self.full_name, index, str(item), msg)
+            msg = "Function '%s' invalid response element %d: '%s'. %s" % vals
+            raise RpcException(ERR_INVALID_RESP, msg)
+
     def _validate_param(self, expected, param):
         """
         Validates a single param against its expected type.
@@ -11,12 +11,26 @@
     :license: MIT, see LICENSE for more details.
 """
 
+import os
+import json
 import uuid
 import time
+import shutil
+import socket
+import struct
+import tempfile
+import logging
+import threading
 import unittest
 import barrister
+import barrister.runtime
 import six
 
+from six.moves import BaseHTTPServer, socketserver
+
+from twisted.internet import defer, task
+from twisted.web.test.requesthelper import DummyRequest
+
 def newUser(userId=u"abc123", email=None):
     return { "userId" : userId, "password" : u"pw", "email" : email,
       "emailVerified" : False, "dateCreated" : 1, "age" : 3.3 }
@@ -64,6 +78,63 @@ class UserServiceImpl(object):
     def _resp(self, status, message):
         return { "status" : status, "message" : message }
 
+class TwistedUserServiceImpl(object):
+
+    def __init__(self):
+        self.impl = UserServiceImpl()
+
+    def __getattr__(self, name):
+        func = getattr(self.impl, name)
+        def wrapper(*params):
+            return defer.maybeDeferred(func, *params)
+        return wrapper
+
+class FakeWebsocketProtocol(object):
+
+    def __init__(self):
+        self.sent = [ ]
+
+    def sendMessage(self, payload, isBinary=False):
+        self.sent.append(payload)
+
+class FlakyTransport(object):
+
+    thread_safe = True
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.fail = False
+        self.requests = 0
+
+    def request(self, req):
+        self.requests += 1
+        if self.fail:
+            raise IOError("connection refused")
+        return self.transport.request(req)
+
+class SlowTransport(object):
+
+    thread_safe = True
+
+    def __init__(self, transport, delay):
+        self.transport = transport
+        self.delay = delay
+        self.requests = 0
+
+    def request(self, req):
+        self.requests += 1
+        time.sleep(self.delay)
+        return self.transport.request(req)
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, server):
+        self.rpc_server = server
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                                           barrister.runtime.HttpRequestHandler)
+
 class RuntimeTest(unittest.TestCase):
 
     def setUp(self):
@@ -150,6 +221,1253 @@ class RuntimeTest(unittest.TestCase):
         self.assertEqual(results[1].result["message"], u"user created")
         self.assertEqual(2, results[2].result["count"])
 
+    def test_websocket_coalesce(self):
+        contract = barrister.contract_from_file('./barrister/test/idl/runtime.json')
+        server = barrister.TwistedServer(contract)
+        server.add_handler("UserService", TwistedUserServiceImpl())
+
+        clock = task.Clock()
+        proto = FakeWebsocketProtocol()
+        transport = barrister.WebsocketTransport(proto, coalesce=True, clock=clock)
+        results = [ ]
+        for i in range(3):
+            req = { "jsonrpc": "2.0", "id": str(i), "method": "UserService.countUsers",
+                    "params": [] }
+            transport.request(req).addCallback(results.append)
+        self.assertEqual(0, len(proto.sent))
+
+        clock.advance(0)
+        self.assertEqual(1, len(proto.sent))
+
+        sent = [ ]
+        server.call_json_streaming(proto.sent[0].decode('utf8'), sent.append)
+        self.assertEqual(3, len(sent))
+        for s in sent:
+            transport.response_received(s.encode('utf8'))
+        self.assertEqual(["0", "1", "2"], sorted([r["id"] for r in results]))
+        self.assertEqual(0, results[0]["result"]["count"])
+
+        # responses without a request are skipped, and the rest of the batch delivered
+        transport.request(dict(req, id="3")).addCallback(results.append)
+        clock.advance(0)
+        batch = [ { "jsonrpc": "2.0", "id": "unknown", "result": 1 },
+                  { "jsonrpc": "2.0", "id": "3", "result": 2 } ]
+        transport.response_received(json.dumps(batch).encode('utf8'))
+        self.assertEqual(("3", 2), (results[-1]["id"], results[-1]["result"]))
+
+    def test_unix_socket_transport(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for http, transport_class in [ (False, barrister.UnixSocketTransport),
+                                           (True, barrister.UnixHttpTransport) ]:
+                path = os.path.join(tmpdir, "rpc.sock")
+                listener = barrister.UnixSocketServer(self.server, path, http=http)
+                t = threading.Thread(target=listener.serve_forever)
+                t.start()
+                try:
+                    client = barrister.Client(transport_class(path))
+                    client.UserService.create(newUser(email=u"foo@example.com"))
+                    client.UserService.create(newUser(email=u"foo@example.com"))
+                    self.assertEqual(2, client.UserService.countUsers()["count"])
+                    self.user_svc.users = { }
+                finally:
+                    listener.shutdown()
+                    listener.server_close()
+                    t.join()
+                self.assertFalse(os.path.exists(path))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_tcp_transport_out_of_order(self):
+        def slow_validate(userId):
+            time.sleep(0.3)
+            return self.user_svc._resp(u"ok", u"slow")
+        self.user_svc.validateEmail = slow_validate
+
+        listener = barrister.TcpServer(self.server, "127.0.0.1", 0)
+        t = threading.Thread(target=listener.serve_forever)
+        t.start()
+        try:
+            client = barrister.Client(barrister.TcpTransport(*listener.server_address))
+            done = [ ]
+            def slow():
+                client.UserService.validateEmail(u"123")
+                done.append("slow")
+            slow_thread = threading.Thread(target=slow)
+            slow_thread.start()
+            time.sleep(0.05)
+            self.assertEqual(0, client.UserService.countUsers()["count"])
+            done.append("fast")
+            slow_thread.join()
+            self.assertEqual(["fast", "slow"], done)
+
+            # without a notification executor the server answers notifications in a
+            # batch with a null id, which must not be mistaken for the batch's key
+            batch = [ { "jsonrpc": "2.0", "method": "UserService.countUsers" },
+                      { "jsonrpc": "2.0", "id": "b1", "method": "UserService.countUsers" } ]
+            resp = client.transport.request(batch)
+            self.assertEqual("b1", [ r for r in resp if r.get("id") ][0]["id"])
+
+            # nor is the answer to a notification given to a call in flight
+            results = [ ]
+            slow_thread = threading.Thread(
+                target=lambda: results.append(client.UserService.validateEmail(u"123")))
+            slow_thread.start()
+            time.sleep(0.05)
+            client.notify("UserService", "countUsers", [ ])
+            slow_thread.join()
+            self.assertEqual(u"slow", results[0]["message"])
+            self.assertEqual(0, client.transport.notifications)
+            client.transport.close()
+        finally:
+            listener.shutdown()
+            listener.server_close()
+            t.join()
+
+    def test_tcp_transport_unmatched_response(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        received = [ ]
+        def serve():
+            conn, addr = listener.accept()
+            rfile = conn.makefile("rb")
+            while True:
+                data = barrister.runtime.recv_frame(rfile)
+                if data is None:
+                    break
+                received.append(json.loads(data.decode("utf8"))["id"])
+                if received == [ "1" ] or len(received) == 3:
+                    # a response the server could not give an id
+                    resp = barrister.runtime.err_response(None, -32700, "Unable to parse JSON")
+                    barrister.runtime.send_frame(conn, json.dumps(resp).encode("utf8"))
+                elif received[-1] == "4":
+                    for reqid in ("stray", "4"):
+                        resp = { "jsonrpc": "2.0", "id": reqid, "result": reqid }
+                        barrister.runtime.send_frame(conn, json.dumps(resp).encode("utf8"))
+            rfile.close()
+            conn.close()
+        t = threading.Thread(target=serve)
+        t.start()
+        try:
+            transport = barrister.TcpTransport(*listener.getsockname(), timeout=5)
+            # with a single request in flight, it must be the one that was not read
+            self.assertEqual(-32700, transport.request({ "id": "1" })["error"]["code"])
+
+            # with several in flight it cannot be matched, so they all fail
+            errors = [ ]
+            def call(reqid):
+                try:
+                    transport.request({ "id": reqid })
+                except IOError as e:
+                    errors.append(e)
+            threads = [ threading.Thread(target=call, args=(reqid,)) for reqid in ("2", "3") ]
+            for thread in threads:
+                thread.start()
+                time.sleep(0.1)
+            for thread in threads:
+                thread.join()
+            self.assertEqual(2, len(errors))
+
+            # a response for an id that is not in flight is discarded
+            self.assertEqual("4", transport.request({ "id": "4" })["result"])
+            transport.close()
+        finally:
+            t.join()
+            listener.close()
+
+    def test_pooled_http_transport_retries(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(5)
+        body = json.dumps({ "jsonrpc": "2.0", "id": "1", "result": 1 }).encode("utf8")
+        ok = b"HTTP/1.1 200 OK\r\nContent-Length: " + str(len(body)).encode("utf8") + \
+             b"\r\n\r\n" + body
+        # what each connection answers to its requests, in order
+        replies = [ [ ok, b"" ], [ ok, ok[:-5] ] ]
+        received = [ ]
+        def serve():
+            for answers in replies:
+                conn, addr = listener.accept()
+                rfile = conn.makefile("rb")
+                for answer in answers:
+                    while rfile.readline().strip():
+                        pass
+                    rfile.read(len(json.dumps({ "id": "1" })))
+                    received.append(1)
+                    conn.sendall(answer)
+                rfile.close()
+                conn.close()
+        t = threading.Thread(target=serve)
+        t.start()
+        try:
+            url = "http://127.0.0.1:%d/" % listener.getsockname()[1]
+            transport = barrister.PooledHttpTransport(url, timeout=5)
+            self.assertEqual(1, transport.request({ "id": "1" })["result"])
+            # closed without responding, so retried on a new connection
+            self.assertEqual(1, transport.request({ "id": "1" })["result"])
+            self.assertEqual(3, len(received))
+            # closed part way through the response, so the request may have run
+            self.assertRaises(Exception, transport.request, { "id": "1" })
+            self.assertEqual(4, len(received))
+            transport.close()
+        finally:
+            t.join()
+            listener.close()
+
+    def test_thread_safe_client(self):
+        httpd = ThreadingHTTPServer(self.server)
+        t = threading.Thread(target=httpd.serve_forever)
+        t.start()
+        try:
+            url = "http://127.0.0.1:%d/" % httpd.server_address[1]
+            transport = barrister.PooledHttpTransport(url, pool_size=4)
+            client = barrister.Client(transport, thread_safe=True, id_gen=barrister.idgen_seq)
+            self.assertTrue(client.transport is transport)
+
+            errors = [ ]
+            def worker():
+                try:
+                    for i in range(20):
+                        client.UserService.create(newUser(email=u"foo@example.com"))
+                except Exception as e:
+                    errors.append(e)
+            workers = [ threading.Thread(target=worker) for i in range(8) ]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            self.assertEqual([ ], errors)
+            self.assertEqual(160, client.UserService.countUsers()["count"])
+            self.assertTrue(transport.pool.qsize() <= 4)
+            transport.close()
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            t.join()
+
+        client = barrister.Client(barrister.InProcTransport(self.server), thread_safe=True)
+        self.assertTrue(isinstance(client.transport, barrister.InProcTransport))
+
+    def test_load_balanced_transport(self):
+        good = FlakyTransport(barrister.InProcTransport(self.server))
+        bad = FlakyTransport(barrister.InProcTransport(self.server))
+        bad.fail = True
+        transport = barrister.LoadBalancedTransport([ good, bad ], max_failures=2,
+                                                    base_ejection_time=0.1)
+        client = barrister.Client(transport)
+
+        errors = 0
+        for i in range(20):
+            try:
+                client.UserService.countUsers()
+            except IOError:
+                errors += 1
+        self.assertEqual(2, errors)
+        self.assertEqual(2, bad.requests)
+        self.assertEqual([True, False], [e["healthy"] for e in transport.endpoint_stats()])
+
+        # re-admitted after the backoff, and kept once it succeeds
+        bad.fail = False
+        time.sleep(0.15)
+        for i in range(4):
+            client.UserService.countUsers()
+        self.assertEqual(4, bad.requests)
+        self.assertEqual([0, 0], [e["ejections"] for e in transport.endpoint_stats()])
+
+    def test_load_balanced_policies(self):
+        for policy in barrister.LoadBalancedTransport.policies:
+            transports = [ FlakyTransport(barrister.InProcTransport(self.server))
+                           for i in range(3) ]
+            transport = barrister.LoadBalancedTransport(transports, policy=policy)
+            for i in range(30):
+                transport.request({ "jsonrpc": "2.0", "id": "1", "method": "barrister-idl" })
+            self.assertEqual(30, sum([ t.requests for t in transports ]))
+            if policy != "power_of_two":
+                self.assertEqual([10, 10, 10], [ t.requests for t in transports ])
+
+    def test_hedged_requests(self):
+        fast = SlowTransport(barrister.InProcTransport(self.server), 0)
+        slow = SlowTransport(barrister.InProcTransport(self.server), 0)
+        policy = barrister.HedgingPolicy([ "UserService.countUsers" ], min_samples=10,
+                                         budget=0.5)
+        transport = barrister.LoadBalancedTransport([ slow, fast ], hedging=policy)
+        client = barrister.Client(transport)
+        for i in range(20):
+            client.UserService.countUsers()
+        self.assertEqual(0, policy.hedges)
+
+        slow.delay = 1.0
+        start = time.time()
+        for i in range(4):
+            client.UserService.countUsers()
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertTrue(policy.hedges >= 2)
+
+        # functions that are not listed are never hedged
+        hedges = policy.hedges
+        slow.delay = 0.05
+        for i in range(2):
+            client.UserService.getAll([])
+        self.assertEqual(hedges, policy.hedges)
+
+        # attempts run on a bounded pool.  Without a free thread calls are not hedged
+        transport = barrister.LoadBalancedTransport([ slow, fast ], hedging=policy,
+                                                    hedge_workers=1)
+        policy.tokens = policy.max_tokens
+        slow.delay = fast.delay = 0.3
+        hedges = policy.hedges
+        threads = [ threading.Thread(target=transport.request,
+                                     args=({ "jsonrpc": "2.0", "id": str(i),
+                                             "method": "UserService.countUsers" },))
+                    for i in range(2) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(transport.hedge_pool.threads))
+        self.assertEqual(hedges, policy.hedges)
+        transport.close()
+
+    def test_circuit_breaker(self):
+        flaky = FlakyTransport(barrister.InProcTransport(self.server))
+        factory = lambda: barrister.CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+        transport = barrister.CircuitBreakerTransport(flaky, breaker_factory=factory)
+        client = barrister.Client(transport)
+
+        # handler errors trip only that function's breaker
+        def broken(userId):
+            raise Exception("database down")
+        self.user_svc.validateEmail = broken
+        for i in range(4):
+            try:
+                client.UserService.validateEmail(u"123")
+                self.fail("Expected RpcException")
+            except barrister.RpcException as e:
+                self.assertEqual(barrister.runtime.ERR_UNKNOWN if i < 2 else
+                                 barrister.runtime.ERR_CIRCUIT_OPEN, e.code)
+        self.assertEqual(3, flaky.requests)
+        self.assertEqual(0, client.UserService.countUsers()["count"])
+
+        # transport errors trip the endpoint breaker
+        flaky.fail = True
+        for i in range(2):
+            self.assertRaises(IOError, client.UserService.countUsers)
+        flaky.fail = False
+        requests = flaky.requests
+        self.assertRaises(barrister.RpcException, client.UserService.countUsers)
+        self.assertEqual(requests, flaky.requests)
+        self.assertEqual("open", transport.stats()["endpoint"])
+
+        # half open after the reset timeout, closed again after a successful probe
+        time.sleep(0.15)
+        self.assertEqual(0, client.UserService.countUsers()["count"])
+        self.assertEqual("closed", transport.stats()["endpoint"])
+
+    def test_client_response_cache(self):
+        counter = FlakyTransport(barrister.InProcTransport(self.server))
+        cache = barrister.ResponseCache(functions={ "UserService.countUsers": 0.1 },
+                                        stale_while_revalidate=10)
+        client = barrister.Client(counter, cache=cache)
+        for i in range(5):
+            self.assertEqual(0, client.UserService.countUsers()["count"])
+        self.assertEqual(2, counter.requests)
+        self.assertEqual({ "size": 1, "hits": 4, "stale_hits": 0, "misses": 1,
+                           "hit_ratio": 0.8 }, cache.stats())
+
+        # once expired, the stale result is returned while it is refreshed in the background
+        client.UserService.create(newUser(email=u"foo@example.com"))
+        time.sleep(0.15)
+        self.assertEqual(0, client.UserService.countUsers()["count"])
+        for i in range(50):
+            if not cache.refreshing:
+                break
+            time.sleep(0.01)
+        self.assertEqual(1, client.UserService.countUsers()["count"])
+        self.assertEqual(1, cache.stats()["stale_hits"])
+        self.assertEqual(4, counter.requests)
+
+    def test_client_response_cache_annotation(self):
+        idl = json.loads(open('./barrister/test/idl/runtime.json').read())
+        for e in idl:
+            if e["type"] == "interface":
+                for f in e["functions"]:
+                    if f["name"] == "getAll":
+                        f["comment"] = "Loads users\n@cacheable(ttl=30)"
+        server = barrister.Server(barrister.Contract(idl))
+        server.add_handler("UserService", self.user_svc)
+        cache = barrister.ResponseCache(ttl=5, functions=[ "UserService.get" ])
+        client = barrister.Client(barrister.InProcTransport(server), cache=cache)
+        self.assertEqual(30, cache.ttl_for("UserService.getAll"))
+        self.assertEqual(5, cache.ttl_for("UserService.get"))
+        self.assertEqual(None, cache.ttl_for("UserService.create"))
+
+    def test_server_result_cache(self):
+        calls = [ ]
+        count_users = self.user_svc.countUsers
+        def counting_count_users():
+            calls.append(1)
+            return count_users()
+        self.user_svc.countUsers = counting_count_users
+
+        results = [ ]
+        class ResultFilter(barrister.Filter):
+            def post(self, context):
+                results.append(context.response["result"])
+
+        cache = barrister.ResultCache(functions=[ "UserService.countUsers" ], serialize=True)
+        self.server.set_result_cache(cache)
+        self.server.set_filters([ ResultFilter() ])
+        req = { "jsonrpc": "2.0", "id": "1", "method": "UserService.countUsers", "params": [] }
+        first = json.loads(self.server.call_json(json.dumps(req)))
+        req["id"] = "2"
+        second = json.loads(self.server.call_json(json.dumps([ req, req ])))
+        self.assertEqual(1, len(calls))
+        # post filters see decoded results, also when served serialized from the cache
+        self.assertEqual([ first["result"] ] * 3, results)
+        self.assertEqual([ "2", "2" ], [ r["id"] for r in second ])
+        self.assertEqual(first["result"], second[0]["result"])
+        self.assertEqual(first["result"], self.client.UserService.countUsers())
+        self.assertEqual(1, len(calls))
+
+        cache.invalidate_method("UserService.countUsers")
+        self.client.UserService.countUsers()
+        self.assertEqual(2, len(calls))
+        self.assertEqual(3, cache.stats()["hits"])
+
+    def test_single_flight(self):
+        calls = [ ]
+        def slow_count_users():
+            calls.append(1)
+            time.sleep(0.2)
+            return self.user_svc._resp(u"ok", u"ok")
+        self.user_svc.countUsers = lambda: dict(slow_count_users(), count=len(calls))
+
+        flight = barrister.SingleFlight([ "UserService.countUsers" ])
+        self.server.set_single_flight(flight)
+        responses = [ ]
+        def worker(reqid):
+            req = { "jsonrpc": "2.0", "id": reqid, "method": "UserService.countUsers",
+                    "params": [] }
+            responses.append(self.server.call(req))
+        workers = [ threading.Thread(target=worker, args=(str(i),)) for i in range(5) ]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        self.assertEqual(1, len(calls))
+        self.assertEqual([ "0", "1", "2", "3", "4" ], sorted([ r["id"] for r in responses ]))
+        self.assertEqual([ 1 ] * 5, [ r["result"]["count"] for r in responses ])
+        self.assertEqual({ "executed": 1, "coalesced": 4 }, flight.stats())
+
+        # other functions are unaffected
+        self.client.UserService.create(newUser(email=u"foo@example.com"))
+        self.assertEqual({ "executed": 1, "coalesced": 4 }, flight.stats())
+
+    def test_single_flight_twisted(self):
+        contract = barrister.contract_from_file('./barrister/test/idl/runtime.json')
+        server = barrister.TwistedServer(contract)
+        pending = [ ]
+        class Handler(object):
+            def countUsers(self):
+                d = defer.Deferred()
+                pending.append(d)
+                return d
+        server.add_handler("UserService", Handler())
+        server.set_single_flight(barrister.SingleFlight([ "UserService.countUsers" ]))
+
+        results = [ ]
+        for i in range(3):
+            req = { "jsonrpc": "2.0", "id": str(i), "method": "UserService.countUsers",
+                    "params": [] }
+            server.call(req).addCallback(results.append)
+        self.assertEqual(1, len(pending))
+        pending[0].callback({ "status": u"ok", "message": u"ok", "count": 7 })
+        self.assertEqual([ "0", "1", "2" ], sorted([ r["id"] for r in results ]))
+        self.assertEqual([ 7 ] * 3, [ r["result"]["count"] for r in results ])
+
+    def test_twisted_cancel_on_disconnect(self):
+        from twisted.test import proto_helpers
+        contract = barrister.contract_from_file('./barrister/test/idl/runtime.json')
+        server = barrister.TwistedServer(contract)
+        cancelled = [ ]
+        class Handler(object):
+            def countUsers(self):
+                return defer.Deferred(lambda d: cancelled.append(d))
+        server.add_handler("UserService", Handler())
+        server.set_single_flight(barrister.SingleFlight([ "UserService.countUsers" ]))
+
+        proto = barrister.FramedRpcFactory(server).buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+        req = { "jsonrpc": "2.0", "id": "1", "method": "UserService.countUsers" }
+        data = json.dumps(req).encode("utf8")
+        proto.dataReceived(struct.pack("!I", len(data)) + data)
+
+        # a coalesced call from another connection keeps the shared call alive
+        other = server.call_json(json.dumps(dict(req, id="2")))
+        proto.dataReceived(struct.pack("!I", len(data)) + data)
+        proto.connectionLost(None)
+        self.assertEqual([ ], cancelled)
+        self.assertEqual(b"", transport.value())
+
+        other.cancel()
+        self.assertEqual(1, len(cancelled))
+        failures = [ ]
+        other.addErrback(failures.append)
+        self.assertTrue(failures[0].check(defer.CancelledError))
+
+    def test_twisted_http_resource_errors(self):
+        contract = barrister.contract_from_file('./barrister/test/idl/runtime.json')
+        server = barrister.TwistedServer(contract)
+        server.add_handler("UserService", TwistedUserServiceImpl())
+        class BrokenFilter(barrister.Filter):
+            def pre(self, context):
+                if context.request["id"] == "2":
+                    raise ValueError("broken filter")
+        server.set_filters([ BrokenFilter() ])
+        reqs = [ { "jsonrpc": "2.0", "id": str(i), "method": "UserService.countUsers" }
+                 for i in range(1, 3) ]
+
+        # the request is finished with an error instead of left hanging
+        request = DummyRequest([ ])
+        request.method = b"POST"
+        request.content = six.BytesIO(json.dumps(reqs[1]).encode("utf8"))
+        barrister.TwistedHttpResource(server).render(request)
+        self.assertEqual(1, request.finished)
+        self.assertEqual(500, request.responseCode)
+        resp = json.loads(b"".join(request.written).decode("utf8"))
+        self.assertEqual(barrister.runtime.ERR_UNKNOWN, resp["error"]["code"])
+
+        # a streamed batch gets an error line for the failed request
+        request = DummyRequest([ ])
+        request.method = b"POST"
+        request.requestHeaders.setRawHeaders(b"accept", [ b"application/x-ndjson" ])
+        request.content = six.BytesIO(json.dumps(reqs).encode("utf8"))
+        barrister.TwistedHttpResource(server).render(request)
+        self.assertEqual(1, request.finished)
+        lines = [ json.loads(l) for l in b"".join(request.written).decode("utf8").splitlines() ]
+        self.assertEqual(0, lines[0]["result"]["count"])
+        self.assertEqual("2", lines[1]["id"])
+        self.assertEqual(barrister.runtime.ERR_UNKNOWN, lines[1]["error"]["code"])
+
+    def test_idempotency_store(self):
+        store = barrister.IdempotencyStore()
+        self.server.set_idempotency_store(store)
+        user = newUser(email=u"foo@example.com")
+        req = { "jsonrpc": "2.0", "id": "1", "method": "UserService.create",
+                "params": [ user ], "idempotency_key": "abc" }
+        first = self.server.call(json.loads(json.dumps(req)))
+        retry = self.server.call(json.loads(json.dumps(dict(req, id="2"))))
+        self.assertEqual("2", retry["id"])
+        self.assertEqual(first["result"], retry["result"])
+        self.assertEqual(1, len(self.user_svc.users))
+
+        # key passed as a property, e.g. from a HTTP header
+        del req["idempotency_key"]
+        props = { "idempotency_key": "def" }
+        self.server.call(json.loads(json.dumps(req)), props)
+        self.server.call(json.loads(json.dumps(req)), props)
+        self.assertEqual(2, len(self.user_svc.users))
+        self.assertEqual(2, store.replays)
+
+        # server faults are not stored, so the retry executes again
+        calls = [ ]
+        def broken(user):
+            calls.append(1)
+            raise Exception("database down")
+        self.user_svc.update = broken
+        req = { "jsonrpc": "2.0", "id": "1", "method": "UserService.update",
+                "params": [ user ], "idempotency_key": "ghi" }
+        self.server.call(req)
+        self.server.call(req)
+        self.assertEqual(2, len(calls))
+
+        client = barrister.Client(barrister.InProcTransport(self.server), idempotency_keys=True)
+        self.assertTrue(client.to_request("UserService", "countUsers", [])["idempotency_key"])
+
+    def test_server_metrics(self):
+        metrics = barrister.ServerMetrics()
+        self.server.set_metrics(metrics)
+        count = { "jsonrpc": "2.0", "id": "1", "method": "UserService.countUsers" }
+        bogus = { "jsonrpc": "2.0", "id": "2", "method": "Nope.nope" }
+        self.server.call_json(json.dumps(count))
+        self.server.call_json(json.dumps([ count, bogus ]))
+        t = threading.Thread(target=self.server.call_json, args=(json.dumps(count),))
+        t.start()
+        t.join()
+
+        snap = metrics.snapshot()
+        self.assertEqual({ "UserService.countUsers": 3, "unknown": 1 }, snap["requests"])
+        self.assertEqual({ ("unknown", -32601): 1 }, snap["errors"])
+        self.assertEqual(3, snap["phases"][("UserService.countUsers", "handler")].count)
+        self.assertEqual(2, snap["phases"][("UserService.countUsers", "decode")].count)
+        self.assertEqual(1, snap["sizes"][("batch", "response")].count)
+        self.assertEqual(1, snap["batches"].count)
+        # the shard of the thread that exited was retired into a single shard
+        self.assertEqual(1, len(metrics.shards))
+
+        # payload sizes are measured in encoded bytes
+        metrics.record_size("x", "request", barrister.runtime.encoded_size(u"\u00e9"))
+        self.assertEqual(2, metrics.snapshot()["sizes"][("x", "request")].sum)
+
+        text = barrister.PrometheusExporter(metrics).export()
+        self.assertTrue('barrister_requests_total{method="UserService.countUsers"} 3' in text)
+        self.assertTrue('barrister_errors_total{method="unknown",code="-32601"} 1' in text)
+        self.assertTrue('barrister_batch_size_bucket{le="2"} 1' in text)
+
+        statsd = barrister.StatsdExporter(metrics)
+        self.assertTrue("barrister.UserService.countUsers.requests:3|c" in statsd.lines())
+        self.server.call_json(json.dumps(count))
+        self.assertTrue("barrister.UserService.countUsers.requests:1|c" in statsd.lines())
+
+        h = barrister.runtime.Histogram((1, 2, 4))
+        for v in (0.5, 1.5, 1.5, 3):
+            h.observe(v)
+        self.assertEqual(1.5, h.percentile(50))
+
+    def test_stats_method(self):
+        req = { "jsonrpc": "2.0", "id": "1", "method": "barrister-stats" }
+        self.assertEqual(-32601, self.server.call(req)["error"]["code"])
+
+        class AdminFilter(barrister.Filter):
+            def pre(self, context):
+                if (context.request.get("method") == "barrister-stats" and
+                        not context.get_prop("admin")):
+                    context.set_error(-32010, "Forbidden")
+
+        self.server.set_filters([ AdminFilter() ])
+        self.server.set_stats_enabled(True)
+        self.server.set_metrics(barrister.ServerMetrics())
+        self.server.set_result_cache(barrister.ResultCache(functions={ "UserService.countUsers": 5 }))
+        self.client.UserService.countUsers()
+        self.client.UserService.countUsers()
+        self.assertEqual(-32010, self.server.call(req)["error"]["code"])
+
+        stats = json.loads(self.server.call_json(json.dumps(req), { "admin": True }))["result"]
+        func = stats["functions"]["UserService.countUsers"]
+        self.assertEqual(2, func["requests"])
+        self.assertEqual(0, func["in_flight"])
+        self.assertTrue(func["total_ms"]["p99"] >= func["total_ms"]["p50"])
+        self.assertEqual(0.5, stats["caches"]["result_cache"]["hit_ratio"])
+        self.assertTrue("uptime" in stats)
+        self.assertTrue("memory" in stats)
+
+    def test_method_profiler(self):
+        profiler = barrister.MethodProfiler()
+        self.server.set_profiler(profiler)
+        self.server.set_stats_enabled(True)
+        req = { "jsonrpc": "2.0", "id": "1", "method": "barrister-stats",
+                "params": [ { "profile": { "method": "UserService.countUsers" } } ] }
+        self.server.call(req)
+        self.client.UserService.countUsers()
+        self.client.UserService.countUsers()
+        self.client.UserService.getAll([])
+
+        req["params"] = [ { "profile_report": "UserService.countUsers" } ]
+        stats = self.server.call(req)["result"]
+        self.assertEqual({ "UserService.countUsers": 2 }, stats["profiler"]["calls"])
+        self.assertTrue("countUsers" in stats["profile_report"]["text"])
+        self.assertTrue("countUsers" in stats["profile_report"]["collapsed"])
+        # every stack has a weight, however fast the call
+        for line in stats["profile_report"]["collapsed"].splitlines():
+            self.assertTrue(int(line.rsplit(" ", 1)[1]) >= 1)
+
+        # calls made while another is being profiled run unprofiled
+        with profiler.profile_lock:
+            self.client.UserService.countUsers()
+        self.assertEqual(2, profiler.calls["UserService.countUsers"])
+        self.assertRaises(ValueError, profiler.dump, "UserService.getAll", "unused.prof")
+
+        profiler.toggle()
+        self.client.UserService.countUsers()
+        self.assertEqual(2, profiler.calls["UserService.countUsers"])
+
+        sampler = barrister.MethodProfiler(mode="sample", interval=0.001)
+        sampler.add("UserService.countUsers")
+        self.server.set_profiler(sampler)
+        self.user_svc.countUsers = lambda: time.sleep(0.05) or { "status": u"ok",
+                                                                  "message": u"ok", "count": 0 }
+        self.client.UserService.countUsers()
+        self.assertTrue("<lambda>" in sampler.collapsed("UserService.countUsers"))
+
+    def test_slow_request_log(self):
+        messages = [ ]
+        class Collector(logging.Handler):
+            def emit(self, record):
+                messages.append(record.getMessage())
+        logger = logging.getLogger("barrister.test.slow")
+        logger.addHandler(Collector())
+        logger.propagate = False
+
+        slow_log = barrister.SlowRequestLog(threshold=10, max_per_second=2, max_param_chars=20,
+                                            thresholds={ "UserService.create": 0 },
+                                            logger=logger)
+        self.server.set_slow_log(slow_log)
+        self.client.UserService.countUsers()
+        self.assertEqual([ ], messages)
+
+        for i in range(3):
+            self.client.UserService.create(newUser(email=u"foo@example.com"))
+        self.assertEqual(2, len(messages))
+        msg = messages[0]
+        self.assertTrue("method=UserService.create" in msg)
+        self.assertTrue("handler=" in msg and "total=" in msg)
+        self.assertTrue('params=[{"' in msg and msg.endswith("..."))
+
+        slow_log.last_refill -= 1
+        self.client.UserService.create(newUser(email=u"foo@example.com"))
+        self.assertTrue(messages[-1].endswith("(1 slow requests not logged)"))
+
+    def test_tracing(self):
+        exporter = barrister.InMemorySpanExporter()
+        tracer = barrister.Tracer(exporter)
+        self.server.set_tracer(tracer)
+        transport = barrister.InProcTransport(self.server)
+        client = barrister.Client(transport, tracer=tracer)
+        exporter.clear()
+
+        client.UserService.countUsers()
+        spans = dict([ (s["name"], s) for s in exporter.spans ])
+        call = spans["UserService.countUsers"]
+        self.assertEqual(1, len(set([ s["trace_id"] for s in exporter.spans ])))
+        self.assertEqual(call["span_id"], spans["transport"]["parent_id"])
+        server_spans = [ s for s in exporter.spans
+                         if s["name"] == "UserService.countUsers" and s["parent_id"] ]
+        self.assertEqual(1, len(server_spans))
+        self.assertEqual(server_spans[0]["span_id"], spans["handler"]["parent_id"])
+        self.assertTrue("validate_request" in spans)
+
+        exporter.clear()
+        batch = client.start_batch()
+        batch.UserService.countUsers()
+        batch.UserService.getAll([])
+        batch.send()
+        by_id = dict([ (s["span_id"], s) for s in exporter.spans ])
+        root = [ s for s in exporter.spans if s["parent_id"] is None ]
+        self.assertEqual([ "barrister.batch" ], [ s["name"] for s in root ])
+        server_getall = [ s for s in exporter.spans if s["name"] == "UserService.getAll" and
+                          by_id[s["parent_id"]]["name"] == "UserService.getAll" ]
+        self.assertEqual(1, len(server_getall))
+
+        exporter.clear()
+        traceparent = "00-%s-%s-01" % ("a" * 32, "b" * 16)
+        req = { "jsonrpc": "2.0", "id": "1", "method": "UserService.countUsers" }
+        self.server.call_json(json.dumps(req), { "traceparent": traceparent })
+        names = set([ s["name"] for s in exporter.spans ])
+        self.assertEqual(set([ "barrister.call_json", "decode", "encode", "handler",
+                               "UserService.countUsers", "validate_request",
+                               "validate_response" ]), names)
+        self.assertTrue(all([ s["trace_id"] == "a" * 32 for s in exporter.spans ]))
+
+        exporter.clear()
+        contract = barrister.contract_from_file('./barrister/test/idl/runtime.json')
+        server = barrister.TwistedServer(contract)
+        server.add_handler("UserService", TwistedUserServiceImpl())
+        server.set_tracer(tracer)
+        server.call([ req, dict(req, id="2") ], { "traceparent": traceparent })
+        batch = [ s for s in exporter.spans if s["name"] == "barrister.batch" ][0]
+        self.assertEqual("b" * 16, batch["parent_id"])
+        calls = [ s for s in exporter.spans if s["name"] == "UserService.countUsers" ]
+        self.assertEqual([ batch["span_id"] ] * 2, [ s["parent_id"] for s in calls ])
+
+    def test_deadlines(self):
+        calls = [ ]
+        self.user_svc.countUsers = lambda: calls.append(1) or { "status": u"ok",
+                                                                "message": u"ok", "count": 0 }
+        req = { "jsonrpc": "2.0", "id": "1", "method": "UserService.countUsers",
+                "deadline": time.time() - 1 }
+        self.assertEqual(barrister.runtime.ERR_DEADLINE_EXCEEDED,
+                         self.server.call(req)["error"]["code"])
+        del req["deadline"]
+        req["timeout"] = 0
+        self.assertTrue("error" in self.server.call(req))
+        self.assertEqual([ ], calls)
+
+        # the remaining budget is propagated to calls made by the handler
+        downstream = [ ]
+        class RecordingTransport(object):
+            def __init__(self, transport):
+                self.transport = transport
+            def request(self, req):
+                downstream.append(req)
+                return self.transport.request(req)
+        client = barrister.Client(RecordingTransport(barrister.InProcTransport(self.server)),
+                                  timeout=60)
+        budgets = [ ]
+        def getAll(userIds):
+            budgets.append(barrister.current_deadline() - time.time())
+            client.UserService.countUsers()
+            return { "status": u"ok", "message" : u"users here", "users": [] }
+        self.user_svc.getAll = getAll
+        req = { "jsonrpc": "2.0", "id": "1", "method": "UserService.getAll",
+                "params": [ [] ], "timeout": 5 }
+        self.assertTrue("result" in self.server.call(req))
+        self.assertTrue(0 < budgets[0] <= 5)
+        self.assertTrue(0 < downstream[-1]["timeout"] <= 5)
+        self.assertEqual(None, barrister.current_deadline())
+
+        client.UserService.countUsers()
+        self.assertEqual(60, downstream[-1]["timeout"])
+        with barrister.Deadline(-1):
+            try:
+                client.UserService.countUsers()
+                self.fail("Expected RpcException")
+            except barrister.RpcException as e:
+                self.assertEqual(barrister.runtime.ERR_DEADLINE_EXCEEDED, e.code)
+
+    def test_admission_control(self):
+        admission = barrister.AdmissionController(max_in_flight=2, reserved=1,
+                                                  priorities={ "UserService.countUsers": 0 })
+        self.server.set_admission_controller(admission)
+        count = json.dumps({ "jsonrpc": "2.0", "id": "1", "method": "UserService.countUsers" })
+        get_all = json.dumps({ "jsonrpc": "2.0", "id": "2", "method": "UserService.getAll",
+                               "params": [ [] ] })
+
+        admission.acquire("UserService.get")
+        resp = json.loads(self.server.call_json(get_all))
+        self.assertEqual(barrister.runtime.ERR_OVERLOADED, resp["error"]["code"])
+        self.assertEqual(1.0, resp["error"]["data"]["retry_after"])
+        self.assertEqual("2", resp["id"])
+        # a request whose id is not found is decoded before it is rejected
+        escaped = '{ "jsonrpc": "2.0", "method": "UserService.getAll", "params": [ [] ], ' \
+                  '"\\u0069d": 7 }'
+        self.assertEqual(None, barrister.runtime.peek_id(escaped))
+        self.assertEqual(7, json.loads(self.server.call_json(escaped))["id"])
+        self.assertEqual(7, barrister.runtime.peek_id('{ "id" : 7 }'))
+        # ids that may be nested in the params are not trusted
+        for body in ('{"method": "A.b", "params": [{"id": "user-1"}], "id": 7}',
+                     '{"id": 7, "method": "A.b", "params": [{"id": "user-1"}]}',
+                     '{"method": "A.b", "params": [{"id": "user-1"}]}'):
+            self.assertEqual(None, barrister.runtime.peek_id(body))
+        self.assertEqual(7, barrister.runtime.peek_id('{"id": 7, "params": [{"name": "x"}]}'))
+        nested = '{"jsonrpc": "2.0", "method": "UserService.getAll", ' \
+                 '"params": [[{"id": "user-1"}]], "id": 8}'
+        self.assertEqual(8, json.loads(self.server.call_json(nested))["id"])
+        self.assertEqual(None, barrister.runtime.peek_id('{ "id": null }', 1))
+        self.assertEqual("a\\\"b", barrister.runtime.peek_id(json.dumps({ "id": "a\\\"b" })))
+        self.assertEqual(1, barrister.runtime.peek_id("[ { \"id\": 2 } ]", 1))
+        self.assertTrue("result" in json.loads(self.server.call_json(count)))
+        batch = json.loads(self.server.call_json("[%s, %s]" % (count, get_all)))
+        self.assertEqual([ False, True ], [ "error" in r for r in batch ])
+        admission.release()
+        self.assertTrue("result" in json.loads(self.server.call_json(get_all)))
+
+        # sustained queueing delay sheds everything but priority 0
+        admission.interval = 0
+        slow = { "received_at": barrister.runtime.perf_timer() - 1 }
+        self.server.call_json(get_all, dict(slow))
+        resp = json.loads(self.server.call_json(get_all, dict(slow)))
+        self.assertEqual("queue_delay", resp["error"]["data"]["reason"])
+        self.assertTrue("result" in json.loads(self.server.call_json(count, dict(slow))))
+        fast = { "received_at": barrister.runtime.perf_timer() }
+        self.assertTrue("result" in json.loads(self.server.call_json(get_all, fast)))
+
+        stats = admission.stats()
+        self.assertEqual({ "in_flight:1": 4, "queue_delay:1": 1 }, stats["shed"])
+        self.assertEqual(0, stats["in_flight"])
+
+    def test_bulkheads(self):
+        bulkheads = barrister.Bulkheads({ "UserService": 1 }, max_queue=1, queue_timeout=0.05)
+        self.server.set_bulkheads(bulkheads)
+        req = { "jsonrpc": "2.0", "id": "1", "method": "UserService.countUsers" }
+        held = bulkheads.acquire("UserService.get")
+        resp = self.server.call(req)
+        self.assertEqual(barrister.runtime.ERR_BULKHEAD_FULL, resp["error"]["code"])
+        self.assertEqual("timeout", resp["error"]["data"]["reason"])
+
+        bulkheads.bulkheads["UserService"].max_queue = 0
+        resp = self.server.call(req)
+        self.assertEqual("full", resp["error"]["data"]["reason"])
+        self.assertTrue("result" in self.server.call(dict(req, method="barrister-idl")))
+        bulkheads.release(held)
+        self.assertTrue("result" in self.server.call(req))
+        self.assertEqual({ "active": 0, "waiting": 0, "rejected": 1, "timeouts": 1 },
+                         bulkheads.stats()["UserService"])
+
+        # waiting stops at the request's deadline
+        bulkheads = barrister.Bulkheads({ "UserService": 1 }, max_queue=1)
+        self.server.set_bulkheads(bulkheads)
+        held = bulkheads.acquire("UserService.get")
+        resp = self.server.call(dict(req, timeout=0.05))
+        self.assertEqual(barrister.runtime.ERR_DEADLINE_EXCEEDED, resp["error"]["code"])
+
+        # slots go to waiting threads and Deferreds in the order they arrived
+        bulkhead = bulkheads.bulkheads["UserService"]
+        bulkhead.max_queue = 2
+        order = [ ]
+        bulkhead.acquire_deferred().addCallback(lambda _: order.append("deferred"))
+        def wait():
+            bulkhead.acquire()
+            order.append("thread")
+        thread = threading.Thread(target=wait)
+        thread.start()
+        while bulkhead.stats()["waiting"] < 2:
+            time.sleep(0.01)
+        bulkhead.release()
+        self.assertEqual([ "deferred" ], order)
+        bulkhead.release()
+        thread.join()
+        self.assertEqual([ "deferred", "thread" ], order)
+        bulkhead.release()
+        self.assertEqual(0, bulkhead.stats()["active"])
+        self.server.set_bulkheads(None)
+
+        contract = barrister.contract_from_file('./barrister/test/idl/runtime.json')
+        server = barrister.TwistedServer(contract)
+        pending = [ ]
+        class Handler(object):
+            def countUsers(self):
+                d = defer.Deferred()
+                pending.append(d)
+                return d
+        server.add_handler("UserService", Handler())
+        server.set_bulkheads(barrister.Bulkheads({ "UserService.countUsers": 1 }, max_queue=1))
+        results = [ ]
+        for i in range(3):
+            server.call(dict(req, id=str(i))).addCallback(results.append)
+        self.assertEqual(1, len(pending))
+        self.assertEqual([ ("2", barrister.runtime.ERR_BULKHEAD_FULL) ],
+                         [ (r["id"], r["error"]["code"]) for r in results ])
+        pending[0].callback({ "status": u"ok", "message": u"ok", "count": 1 })
+        self.assertEqual(2, len(pending))
+        pending[1].callback({ "status": u"ok", "message": u"ok", "count": 2 })
+        self.assertEqual([ "2", "0", "1" ], [ r["id"] for r in results ])
+
+    def test_notifications(self):
+        idl = [ { "type": "interface", "name": "AuditService", "comment": "", "functions": [
+                    { "name": "log", "comment": "",
+                      "params": [ { "type": "string", "name": "msg", "is_array": False } ] },
+                    { "name": "count", "comment": "", "params": [ ],
+                      "returns": { "type": "int", "is_array": False, "optional": False } } ] } ]
+        logged = [ ]
+        started = threading.Event()
+        release = threading.Event()
+        class AuditImpl(object):
+            def log(self, msg):
+                started.set()
+                release.wait(5)
+                logged.append(msg)
+            def count(self):
+                return len(logged)
+        server = barrister.Server(barrister.Contract(idl))
+        server.add_handler("AuditService", AuditImpl())
+        executor = barrister.NotificationExecutor(num_workers=1, max_queue=1)
+        server.set_notification_executor(executor)
+        client = barrister.Client(barrister.InProcTransport(server))
+
+        # notifications return before the handler runs
+        self.assertEqual(None, client.AuditService.log(u"a"))
+        started.wait(5)
+        batch = client.start_batch()
+        batch.AuditService.log(u"b")
+        batch.AuditService.count()
+        self.assertEqual([ 0 ], [ r.result for r in batch.send() ])
+        self.assertEqual("", server.call_json(json.dumps(
+            { "jsonrpc": "2.0", "method": "AuditService.log", "params": [ u"c" ] })))
+        release.set()
+        executor.shutdown()
+        self.assertEqual([ u"a", u"b" ], logged)
+        stats = server.stats()["notifications"]
+        self.assertEqual((3, 2, 1), (stats["submitted"], stats["executed"], stats["dropped"]))
+
+        executor = barrister.NotificationExecutor(num_workers=1, max_queue=1,
+                                                  overflow="caller_runs")
+        server.set_notification_executor(executor)
+        httpd = ThreadingHTTPServer(server)
+        t = threading.Thread(target=httpd.serve_forever)
+        t.start()
+        try:
+            url = "http://127.0.0.1:%d/" % httpd.server_address[1]
+            transport = barrister.PooledHttpTransport(url)
+            req = { "jsonrpc": "2.0", "method": "AuditService.log", "params": [ u"d" ] }
+            self.assertEqual(None, transport.request(req))
+            self.assertEqual(None, transport.request([ req, dict(req, params=[ 1 ]) ]))
+            transport.close()
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            t.join()
+        executor.shutdown()
+        self.assertEqual(u"d", logged[-1])
+        self.assertEqual(1, executor.stats()["failed"])
+
+        # without an executor the server answers notifications, and the answer is dropped
+        server.set_notification_executor(None)
+        listener = barrister.TcpServer(server, "127.0.0.1", 0)
+        t = threading.Thread(target=listener.serve_forever)
+        t.start()
+        try:
+            client = barrister.Client(barrister.TcpTransport(*listener.server_address))
+            self.assertEqual(None, client.AuditService.log(u"e"))
+            self.assertEqual(None, client.AuditService.log(u"f"))
+            while client.transport.notifications:
+                time.sleep(0.01)
+            self.assertEqual(len(logged), client.AuditService.count())
+            self.assertEqual(set([ u"e", u"f" ]), set(logged[-2:]))
+            client.transport.close()
+        finally:
+            listener.shutdown()
+            listener.server_close()
+            t.join()
+
+        self.assertRaises(ValueError, barrister.NotificationExecutor, overflow="block")
+
+    def test_streaming_batch(self):
+        gate = threading.Event()
+        def get(userId):
+            gate.wait(5)
+            raise barrister.RpcException(1000, "no such user")
+        self.user_svc.get = get
+        httpd = ThreadingHTTPServer(self.server)
+        t = threading.Thread(target=httpd.serve_forever)
+        t.start()
+        try:
+            url = "http://127.0.0.1:%d/" % httpd.server_address[1]
+            transport = barrister.PooledHttpTransport(url)
+            client = barrister.Client(transport)
+            batch = client.start_batch()
+            batch.UserService.countUsers()
+            batch.UserService.get(u"1")
+            responses = batch.stream()
+            # the first response arrives while the second request is still running
+            self.assertEqual(0, next(responses).result["count"])
+            gate.set()
+            self.assertEqual([ 1000 ], [ r.error.code for r in responses ])
+            self.assertEqual(0, client.UserService.countUsers()["count"])
+            self.assertEqual(1, transport.pool.qsize())
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            t.join()
+
+        batch = self.client.start_batch()
+        batch.UserService.countUsers()
+        batch.UserService.countUsers()
+        self.assertEqual([ 0, 0 ], [ r.result["count"] for r in batch.stream() ])
+
+        contract = barrister.contract_from_file('./barrister/test/idl/runtime.json')
+        server = barrister.TwistedServer(contract)
+        server.add_handler("UserService", TwistedUserServiceImpl())
+        request = DummyRequest([ ])
+        request.method = b"POST"
+        request.requestHeaders.setRawHeaders(b"accept", [ b"application/x-ndjson" ])
+        reqs = [ { "jsonrpc": "2.0", "id": str(i), "method": "UserService.countUsers" }
+                 for i in range(2) ]
+        request.content = six.BytesIO(json.dumps(reqs).encode("utf8"))
+        barrister.TwistedHttpResource(server).render(request)
+        lines = b"".join(request.written).decode("utf8").splitlines()
+        self.assertEqual([ "0", "1" ], [ json.loads(l)["id"] for l in lines ])
+        self.assertEqual(1, request.finished)
+
+    def test_result_streams(self):
+        idl = [ { "type": "interface", "name": "ExportService", "comment": "", "functions": [
+                    { "name": "export", "comment": "",
+                      "params": [ { "type": "int", "name": "n", "is_array": False } ],
+                      "returns": { "type": "int", "is_array": True, "optional": False } },
+                    { "name": "total", "comment": "", "params": [ ],
+                      "returns": { "type": "int", "is_array": False, "optional": False } } ] } ]
+        gate = threading.Event()
+        probes = [ ]
+        class ExportImpl(object):
+            def export(self, n):
+                for i in range(abs(n)):
+                    if i == 1:
+                        gate.wait(5)
+                    probes.append(barrister.current_deadline())
+                    yield i
+                if n < 0:
+                    yield u"bad"
+            def total(self):
+                return iter([ 1, 2 ])
+        server = barrister.Server(barrister.Contract(idl))
+        server.add_handler("ExportService", ExportImpl())
+        gate.set()
+
+        # only array functions may return iterators
+        resp = server.call({ "jsonrpc": "2.0", "id": "1", "method": "ExportService.total" })
+        self.assertEqual(barrister.runtime.ERR_INVALID_RESP, resp["error"]["code"])
+
+        # limits are held until the stream has been read
+        bulkheads = barrister.Bulkheads({ "ExportService": 1 })
+        admission = barrister.AdmissionController(max_in_flight=10)
+        server.set_bulkheads(bulkheads)
+        server.set_admission_controller(admission)
+        req = { "jsonrpc": "2.0", "id": "1", "method": "ExportService.export", "params": [ 2 ],
+                "timeout": 10 }
+        chunks = server.call_json_chunks(json.dumps(req))
+        next(chunks)
+        next(chunks)
+        self.assertTrue(probes[-1] is not None)
+        self.assertEqual(1, bulkheads.stats()["ExportService"]["active"])
+        self.assertEqual(1, admission.stats()["in_flight"])
+        chunks.close()
+        self.assertEqual(0, bulkheads.stats()["ExportService"]["active"])
+        self.assertEqual(0, admission.stats()["in_flight"])
+        server.set_bulkheads(None)
+        server.set_admission_controller(None)
+
+        req = { "jsonrpc": "2.0", "id": "1", "method": "ExportService.export", "params": [ 3 ] }
+        self.assertEqual([ 0, 1, 2 ], server.call(req)["result"])
+        chunks = server.call_json_chunks(json.dumps(req))
+        self.assertFalse(isinstance(chunks, list))
+        self.assertEqual([ 0, 1, 2 ], json.loads("".join(chunks))["result"])
+        resp = json.loads("".join(server.call_json_chunks(json.dumps(dict(req, params=[ -2 ])))))
+        self.assertEqual(barrister.runtime.ERR_INVALID_RESP, resp["error"]["code"])
+        self.assertEqual(barrister.runtime.ERR_INVALID_RESP,
+                         server.call(dict(req, params=[ -2 ]))["error"]["code"])
+        # batches are not streamed
+        chunks = server.call_json_chunks(json.dumps([ req ]))
+        self.assertEqual([ 0, 1, 2 ], json.loads(chunks[0])[0]["result"])
+
+        httpd = ThreadingHTTPServer(server)
+        t = threading.Thread(target=httpd.serve_forever)
+        t.start()
+        try:
+            url = "http://127.0.0.1:%d/" % httpd.server_address[1]
+            client = barrister.Client(barrister.PooledHttpTransport(url))
+            gate.clear()
+            items = client.call_stream("ExportService", "export", [ 3 ])
+            # the first element arrives while the handler is still producing the rest
+            self.assertEqual(0, next(items))
+            gate.set()
+            self.assertEqual([ 1, 2 ], list(items))
+            try:
+                list(client.call_stream("ExportService", "export", [ -1 ]))
+                self.fail("Expected RpcException for invalid element")
+            except barrister.RpcException as e:
+                self.assertEqual(barrister.runtime.ERR_INVALID_RESP, e.code)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            t.join()
+
+        client = barrister.Client(barrister.InProcTransport(server))
+        self.assertEqual([ 0, 1 ], list(client.call_stream("ExportService", "export", [ 2 ])))
+
+    def test_streaming_request_parser(self):
+        body = '[{"a": "x]}\\"{", "b": "\\u00e9"}, 1, "s,]", true, {"c": [1, {"d": 2}]}, null]'
+        data = body.encode("utf8")
+        for size in (1, 3, 1000):
+            chunks = [ data[i:i+size] for i in range(0, len(data), size) ]
+            self.assertEqual(json.loads(body), list(barrister.runtime.iter_json_requests(chunks)))
+        cases = [ ("[]", { }, barrister.runtime.ERR_INVALID_REQ),
+                  ("[1,]", { }, barrister.runtime.ERR_PARSE),
+                  ('[{"a": 1}', { }, barrister.runtime.ERR_PARSE),
+                  ('[{"a": [[1]]}]', { "max_depth": 2 }, barrister.runtime.ERR_INVALID_REQ),
+                  ('[{"a": 1}, {"b": 22}]', { "max_entry": 8 }, barrister.runtime.ERR_INVALID_REQ),
+                  ("[1, 2, 3]", { "max_body": 5 }, barrister.runtime.ERR_INVALID_REQ) ]
+        for body, limits, code in cases:
+            try:
+                list(barrister.runtime.iter_json_requests(list(body), **limits))
+                self.fail("Expected RpcException for: %s" % body)
+            except barrister.RpcException as e:
+                self.assertEqual(code, e.code)
+
+        # each request runs before the next one is read
+        events = [ ]
+        def chunks():
+            events.append("read")
+            yield '[{"jsonrpc": "2.0", "id": "1", "method": "UserService.countUsers"},'
+            events.append("read")
+            yield '{"jsonrpc": "2.0", "id": "2", "method": "UserService.countUsers"}, {"x'
+        def send(resp_json):
+            events.append(json.loads(resp_json).get("id"))
+        self.server.set_request_limits(max_entry=100)
+        self.server.call_json_stream(chunks(), send, { })
+        self.assertEqual([ "read", "1", "read", "2" ], events[:4])
+        self.assertEqual(None, events[4])
+
+        # a body that has already been read goes through the same parser and limits
+        sent = [ ]
+        self.server.call_json_streaming('[{"jsonrpc": "2.0", "id": "1", ' \
+                                        '"method": "UserService.countUsers"}, {"x": "%s"}]'
+                                        % ("y" * 100), sent.append)
+        self.assertEqual([ "1", None ], [ json.loads(r)["id"] for r in sent ])
+        self.assertEqual(barrister.runtime.ERR_INVALID_REQ, json.loads(sent[1])["error"]["code"])
+
+        httpd = ThreadingHTTPServer(self.server)
+        t = threading.Thread(target=httpd.serve_forever)
+        t.start()
+        try:
+            url = "http://127.0.0.1:%d/" % httpd.server_address[1]
+            transport = barrister.PooledHttpTransport(url)
+            reqs = [ { "jsonrpc": "2.0", "id": str(i), "method": "UserService.countUsers" }
+                     for i in range(3) ]
+            self.assertEqual([ "0", "1", "2" ],
+                             [ r["id"] for r in transport.request_stream(reqs) ])
+            reqs[1]["params"] = [ u"x" * 100 ]
+            resps = list(transport.request_stream(reqs))
+            self.assertEqual([ "0", None ], [ r["id"] for r in resps ])
+            self.assertEqual(barrister.runtime.ERR_INVALID_REQ, resps[1]["error"]["code"])
+            # the server closed the connection without reading the rest of the body
+            self.assertEqual(3, len(list(transport.request_stream(reqs[:1] * 3))))
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            t.join()
+
+    def test_server_timing(self):
+        self.server.set_timing(True)
+        self.client.UserService.countUsers()
+        timing = self.client.last_timing()
+        for phase in ("validate_request", "handler", "validate_response", "total",
+                      "round_trip", "network"):
+            self.assertTrue(phase in timing, phase)
+        self.assertTrue(timing["round_trip"] >= timing["total"])
+
+        batch = self.client.start_batch()
+        batch.UserService.countUsers()
+        self.assertTrue("handler" in batch.send()[0].timing)
+
+        httpd = ThreadingHTTPServer(self.server)
+        t = threading.Thread(target=httpd.serve_forever)
+        t.start()
+        try:
+            req = { "jsonrpc": "2.0", "id": "1", "method": "UserService.countUsers" }
+            conn = six.moves.http_client.HTTPConnection("127.0.0.1", httpd.server_address[1])
+            conn.request("POST", "/", json.dumps(req))
+            resp = conn.getresponse()
+            body = json.loads(resp.read().decode("utf8"))
+            conn.close()
+            header = resp.getheader("Server-Timing")
+            for phase in ("queue", "decode", "handler", "encode", "total"):
+                self.assertTrue(phase + ";dur=" in header, header)
+            self.assertTrue("queue" in body["timing"] and "decode" in body["timing"])
+
+            # the request is received when its request line arrives, not its body
+            data = json.dumps(req).encode("utf8")
+            sock = socket.create_connection(httpd.server_address)
+            sock.sendall(b"POST / HTTP/1.1\r\nHost: localhost\r\nContent-Length: " +
+                         str(len(data)).encode("utf8") + b"\r\n\r\n")
+            time.sleep(0.1)
+            sock.sendall(data)
+            resp = six.moves.http_client.HTTPResponse(sock)
+            resp.begin()
+            body = json.loads(resp.read().decode("utf8"))
+            sock.close()
+            self.assertTrue(body["timing"]["queue"] >= 100, body["timing"])
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            t.join()
+
+        contract = barrister.contract_from_file('./barrister/test/idl/runtime.json')
+        server = barrister.TwistedServer(contract)
+        server.add_handler("UserService", TwistedUserServiceImpl())
+        server.set_timing(True)
+        request = DummyRequest([ ])
+        request.method = b"POST"
+        request.content = six.BytesIO(json.dumps(req).encode("utf8"))
+        barrister.TwistedHttpResource(server).render(request)
+        header = request.responseHeaders.getRawHeaders(b"server-timing")[0]
+        header = header.decode("utf8") if isinstance(header, bytes) else header
+        for phase in ("queue", "decode", "validate_request", "handler", "validate_response",
+                      "encode", "total"):
+            self.assertTrue(phase + ";dur=" in header, header)
+        body = json.loads(b"".join(request.written).decode("utf8"))
+        self.assertTrue("handler" in body["timing"] and "decode" in body["timing"])
+
     def _test_bench(self):
         start = time.time()
         stop = start+1